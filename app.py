@@ -1,37 +1,319 @@
-from flask import Flask, render_template, request, redirect, flash, send_from_directory, session, url_for
+from flask import Flask, render_template, request, redirect, flash, send_from_directory, session, url_for, jsonify, g, send_file, Response, Request
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
-from datetime import datetime
-import pdfplumber
+import io
+import json
+import atexit
+import time
+from datetime import datetime, date
 import csv
 import sqlite3
+import re
+import queue
+import threading
+import multiprocessing
+from collections import deque
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import hashlib
 import hmac
 import secrets
 import base64
+import shutil
+import importlib.util
+import tempfile
+import unicodedata
+from functools import wraps, lru_cache
+from operator import itemgetter
+from dataclasses import dataclass, fields
+from typing import NamedTuple
+import click
+from markupsafe import escape
+# reportlab, PyPDF2 e pdfplumber são importados dentro das funções de PDF:
+# juntos custam ~130 ms em cada inicialização de worker que nunca imprime.
 from functools import wraps
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from PyPDF2 import PdfReader, PdfWriter
-from functools import wraps
+
+# ---------------- MÉTRICAS ----------------
+
+class Histograma:
+    """Histograma no formato do Prometheus, com uma série por combinação de rótulos."""
+
+    def __init__(self, nome, ajuda, rotulos, limites):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.rotulos = rotulos
+        self.limites = tuple(limites)
+        self._series = {}
+        self._trava = threading.Lock()
+
+    def observar(self, segundos, *valores):
+
+        faixa = bisect_left(self.limites, segundos)
+
+        with self._trava:
+            serie = self._series.get(valores)
+            if serie is None:
+                # contagem por faixa (não acumulada), soma, total
+                serie = self._series[valores] = [[0] * (len(self.limites) + 1), 0.0, 0]
+            serie[0][faixa] += 1
+            serie[1] += segundos
+            serie[2] += 1
+
+    def exportar(self):
+
+        with self._trava:
+            series = {valores: (list(faixas), soma, total) for valores, (faixas, soma, total) in self._series.items()}
+
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} histogram"]
+
+        for valores, (faixas, soma, total) in sorted(series.items()):
+            rotulos = ",".join(f'{rotulo}="{escapar_rotulo(valor)}"' for rotulo, valor in zip(self.rotulos, valores))
+            separador = "," if rotulos else ""
+            acumulado = 0
+
+            for limite, quantidade in zip(self.limites + (float("inf"),), faixas):
+                acumulado += quantidade
+                le = "+Inf" if limite == float("inf") else repr(limite)
+                linhas.append(f'{self.nome}_bucket{{{rotulos}{separador}le="{le}"}} {acumulado}')
+
+            linhas.append(f"{self.nome}_sum{{{rotulos}}} {soma!r}")
+            linhas.append(f"{self.nome}_count{{{rotulos}}} {total}")
+
+        return "\n".join(linhas) + "\n"
+
+
+def escapar_rotulo(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrica_requisicoes = Histograma(
+    "aih_http_request_duration_seconds",
+    "Tempo de resposta por view do Flask (até o início do corpo nas respostas em streaming).",
+    ("endpoint", "method", "status"),
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+metrica_sql = Histograma(
+    "aih_sql_statement_duration_seconds",
+    "Tempo de execute/executemany no SQLite por tipo de comando (sem o fetch das linhas seguintes).",
+    ("operacao",),
+    (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1),
+)
+metrica_pdf = Histograma(
+    "aih_pdf_stage_duration_seconds",
+    "Tempo de cada etapa de gerar_pdf_formulario (modelo, overlay, mesclagem, escrita).",
+    ("etapa",),
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+OPERACOES_SQL = {
+    "SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "PRAGMA", "BEGIN", "COMMIT", "ROLLBACK",
+    "CREATE", "DROP", "ALTER", "ANALYZE",
+}
+
+# Consultas da requisição atual, só preenchido quando o log de lentas está ligado
+consultas_requisicao = threading.local()
+
+
+def medir_sql(sql, inicio):
+
+    duracao = time.perf_counter() - inicio
+    palavra = sql.lstrip()[:8].split(None, 1)
+    operacao = palavra[0].upper() if palavra else ""
+
+    metrica_sql.observar(duracao, operacao if operacao in OPERACOES_SQL else "OUTRO")
+
+    consultas = getattr(consultas_requisicao, "lista", None)
+    if consultas is not None:
+        consultas.append((sql, duracao))
+
 
 # ---------------- BANCO ----------------
 
-def conectar_db():
-    caminho = os.path.abspath("aih.db")
+CAMINHO_DB = os.path.abspath(os.getenv("AIH_DB", "aih.db"))
+
+# PRAGMAs aplicados em toda conexão nova. WAL deixa leitores e o escritor
+# (aceitar/reprovar) trabalharem ao mesmo tempo; NORMAL é seguro com WAL.
+PRAGMAS_CONEXAO = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": int(os.getenv("AIH_DB_BUSY_TIMEOUT_MS", "10000")),
+    "mmap_size": int(os.getenv("AIH_DB_MMAP_BYTES", str(256 * 1024 * 1024))),
+    "cache_size": int(os.getenv("AIH_DB_CACHE_KIB", "-20000")),
+    "temp_store": "MEMORY",
+}
+
+
+# set_trace_callback só avisa que um comando começou, sem a duração; por isso
+# as conexões da aplicação medem o próprio execute/executemany.
+
+class CursorMedido(sqlite3.Cursor):
+
+    def execute(self, sql, parametros=()):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            medir_sql(sql, inicio)
+
+    def executemany(self, sql, parametros):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, parametros)
+        finally:
+            medir_sql(sql, inicio)
+
+
+class ConexaoMedida(sqlite3.Connection):
+
+    def cursor(self, factory=CursorMedido):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametros=()):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            medir_sql(sql, inicio)
+
+    def executemany(self, sql, parametros):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, parametros)
+        finally:
+            medir_sql(sql, inicio)
+
+
+def abrir_conexao():
+    """Conexão nova sem checar o schema (usada pelas próprias migrações)."""
 
     conn = sqlite3.connect(
-        caminho,
-        timeout=10,
-        check_same_thread=False
+        CAMINHO_DB,
+        timeout=PRAGMAS_CONEXAO["busy_timeout"] / 1000,
+        check_same_thread=False,
+        factory=ConexaoMedida,
     )
 
+    for pragma, valor in PRAGMAS_CONEXAO.items():
+        conn.execute(f"PRAGMA {pragma} = {valor}")
+
     conn.row_factory = sqlite3.Row
     return conn
 
 
-def criar_tabela():
+def conectar_db():
+    """Conexão nova; a primeira do processo aplica as migrações pendentes."""
+
+    if not esquema_pronto.is_set():
+        migrar_banco()
+
+    return abrir_conexao()
+
+
+class PoolConexoes:
+    """Pool pequeno e limitado de conexões reaproveitadas entre requisições."""
+
+    def __init__(self, tamanho_maximo=8, espera_maxima=10):
+        self.tamanho_maximo = tamanho_maximo
+        self.espera_maxima = espera_maxima
+        self._livres = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._abertas = 0
+        self.contadores = {
+            "aberturas": 0,
+            "reutilizacoes": 0,
+            "esperas": 0,
+            "pool_esgotado": 0,
+            "timeouts_lock": 0,
+            "descartes": 0,
+        }
+
+    def _incrementar(self, contador):
+        with self._lock:
+            self.contadores[contador] += 1
+
+    def adquirir(self):
+
+        try:
+            conn = self._livres.get_nowait()
+            self._incrementar("reutilizacoes")
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            pode_abrir = self._abertas < self.tamanho_maximo
+            if pode_abrir:
+                self._abertas += 1
+                self.contadores["aberturas"] += 1
+
+        if pode_abrir:
+            try:
+                return conectar_db()
+            except sqlite3.Error:
+                with self._lock:
+                    self._abertas -= 1
+                raise
+
+        self._incrementar("esperas")
+
+        try:
+            return self._livres.get(timeout=self.espera_maxima)
+        except queue.Empty:
+            self._incrementar("pool_esgotado")
+            raise sqlite3.OperationalError("Nenhuma conexão livre no pool")
+
+    def devolver(self, conn):
+
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self.descartar(conn)
+            return
+
+        self._livres.put(conn)
+
+    def descartar(self, conn):
+
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+        with self._lock:
+            self._abertas -= 1
+            self.contadores["descartes"] += 1
+
+    def registrar_timeout_lock(self):
+        self._incrementar("timeouts_lock")
+
+    def estatisticas(self):
+        with self._lock:
+            return dict(
+                self.contadores,
+                abertas=self._abertas,
+                livres=self._livres.qsize(),
+                tamanho_maximo=self.tamanho_maximo,
+            )
+
+
+pool_db = PoolConexoes(
+    tamanho_maximo=int(os.getenv("AIH_DB_POOL", "8")),
+    espera_maxima=int(os.getenv("AIH_DB_POOL_ESPERA", "10")),
+)
+
+
+def obter_db():
+    """Conexão da requisição atual; devolvida ao pool no teardown."""
+
+    if "db" not in g:
+        g.db = pool_db.adquirir()
+
+    return g.db
+
+
+def criar_tabela(conn):
 
-    conn = conectar_db()
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -105,12 +387,276 @@ def criar_tabela():
     )
     """)
 
-    conn.commit()
-    conn.close()
 
-def criar_tabela_usuarios():
+# Projeções nomeadas de aih: cada tela busca só as colunas que mostra. Os
+# textos longos da justificativa (sinais, condições, provas...) só são lidos
+# pelo detalhe e pela impressão.
+PROJECOES_AIH = {
+    "lista": (
+        "id", "nome_paciente", "prontuario", "arquivo_pdf", "necessita_apa",
+        "status", "data_solicitacao",
+    ),
+    "detalhe": None,
+    "impressao": None,
+}
+
+
+def projecao_aih(nome, caminho_layout=None):
+    """Lista de colunas (prefixadas com aih.) para usar no SELECT."""
+
+    if nome == "detalhe":
+        return "aih.*"
+
+    if nome == "impressao":
+        # o que o layout desenha, mais o id; muda junto com o layout
+        colunas = {"id"} | {campo.campo for campo in obter_layout(caminho_layout or CAMINHO_LAYOUT_AIH).campos if campo.campo}
+    else:
+        colunas = PROJECOES_AIH[nome]
+
+    return ", ".join(f"aih.{coluna}" for coluna in sorted(colunas, key=lambda coluna: (coluna != "id", coluna)))
+
+
+# ---------------- MODELO AIH ----------------
+
+# Uma NamedTuple por seção do formulário, na ordem das colunas de aih. As
+# datas já saem do banco como date/datetime; o que não estiver no formato
+# ISO fica como veio (formatar_data também trata os dois casos).
+
+class PacienteAih(NamedTuple):
+    nome_paciente: str | None = None
+    prontuario: str | None = None
+    cns: str | None = None
+    data_nascimento: date | str | None = None
+    sexo: str | None = None
+    raca_cor: str | None = None
+    etnia: str | None = None
+    nome_mae: str | None = None
+    telefone1: str | None = None
+    telefone2: str | None = None
+    responsavel: str | None = None
+    endereco: str | None = None
+    municipio: str | None = None
+    ibge: str | None = None
+    uf: str | None = None
+    cep: str | None = None
+
+
+class JustificativaAih(NamedTuple):
+    sinais: str | None = None
+    condicoes: str | None = None
+    provas: str | None = None
+    diagnostico: str | None = None
+    cid_principal: str | None = None
+    cid_secundario: str | None = None
+    cid_associado: str | None = None
+
+
+class ProcedimentoAih(NamedTuple):
+    descricao_procedimento: str | None = None
+    codigo_procedimento: str | None = None
+    clinica: str | None = None
+    carater: str | None = None
+    doc_prof: str | None = None
+    numero_doc_prof: str | None = None
+    nome_prof: str | None = None
+    data_solicitacao: date | str | None = None
+
+
+class CausaExternaAih(NamedTuple):
+    tipo_acidente: str | None = None
+    cnpj_seguradora: str | None = None
+    cnpj_empresa: str | None = None
+    numero_bilhete: str | None = None
+    cnae: str | None = None
+    serie: str | None = None
+    cbor: str | None = None
+    vinculo_empresa: str | None = None
+
+
+class AutorizacaoAih(NamedTuple):
+    nome_autorizador: str | None = None
+    orgao_emissor: str | None = None
+    doc_autorizador: str | None = None
+    numero_doc_autorizador: str | None = None
+    data_autorizacao: date | str | None = None
+    numero_autorizacao: str | None = None
+
+
+SECOES_AIH = {
+    "paciente": PacienteAih,
+    "justificativa": JustificativaAih,
+    "procedimento": ProcedimentoAih,
+    "causa_externa": CausaExternaAih,
+    "autorizacao": AutorizacaoAih,
+}
+
+
+@dataclass(slots=True)
+class Aih:
+    """Linha de aih com as colunas agrupadas por seção.
+
+    aih["coluna"] acha a coluna em qualquer seção, então Aih serve onde antes
+    ia um sqlite3.Row (desenhar_layout, templates antigos).
+    """
+
+    id: int | None = None
+    paciente: PacienteAih = PacienteAih()
+    justificativa: JustificativaAih = JustificativaAih()
+    procedimento: ProcedimentoAih = ProcedimentoAih()
+    causa_externa: CausaExternaAih = CausaExternaAih()
+    autorizacao: AutorizacaoAih = AutorizacaoAih()
+    arquivo_pdf: str | None = None
+    necessita_apa: str | None = None
+    status: str | None = None
+    usuario_aprovacao: str | None = None
+    data_aprovacao: datetime | str | None = None
+    usuario_reprovacao: str | None = None
+    data_reprovacao: datetime | str | None = None
+    paciente_id: int | None = None
+
+    def __getitem__(self, coluna):
+        secao, indice = LOCAL_COLUNA_AIH[coluna]
+
+        if secao is None:
+            return getattr(self, coluna)
+
+        return getattr(self, secao)[indice]
+
+    def get(self, coluna, padrao=None):
+        try:
+            return self[coluna]
+        except KeyError:
+            return padrao
+
+    def para_dict(self, colunas=None):
+        """coluna -> valor, datas em ISO (chave de impressão, JSON)."""
+
+        dados = {}
+
+        for coluna in colunas or COLUNAS_AIH:
+            valor = self[coluna]
+
+            if isinstance(valor, datetime):
+                valor = valor.isoformat(" ")
+            elif isinstance(valor, date):
+                valor = valor.isoformat()
+
+            dados[coluna] = valor
+
+        return dados
+
+
+def localizar_colunas_aih():
+    """coluna -> (seção ou None, posição na seção), na ordem da tabela."""
+
+    locais = {}
+
+    for campo in fields(Aih):
+        secao = SECOES_AIH.get(campo.name)
+
+        if secao is None:
+            locais[campo.name] = (None, None)
+        else:
+            locais.update((coluna, (campo.name, indice)) for indice, coluna in enumerate(secao._fields))
+
+    return locais
+
+
+LOCAL_COLUNA_AIH = localizar_colunas_aih()
+COLUNAS_AIH = tuple(LOCAL_COLUNA_AIH)
+
+
+def ler_data(valor):
+    if not valor:
+        return valor
+
+    try:
+        return date.fromisoformat(valor)
+    except (TypeError, ValueError):
+        return valor
+
+
+def ler_data_hora(valor):
+    if not valor:
+        return valor
+
+    try:
+        return datetime.fromisoformat(valor)
+    except (TypeError, ValueError):
+        return valor
+
+
+CONVERSORES_AIH = {
+    "data_nascimento": ler_data,
+    "data_solicitacao": ler_data,
+    "data_autorizacao": ler_data,
+    "data_aprovacao": ler_data_hora,
+    "data_reprovacao": ler_data_hora,
+}
+
+
+class PlanoAih:
+    """Como montar Aih a partir das linhas de uma consulta (uma vez por lista de colunas)."""
+
+    __slots__ = ("conversoes", "leitores")
+
+    def __init__(self, colunas):
+
+        posicao = {coluna: indice for indice, coluna in enumerate(colunas)}
+        ausente = len(colunas)  # montar() acrescenta um None no fim da linha
+
+        self.conversoes = tuple(
+            (posicao[coluna], conversor)
+            for coluna, conversor in CONVERSORES_AIH.items()
+            if coluna in posicao
+        )
+
+        leitores = []
+        for campo in fields(Aih):
+            secao = SECOES_AIH.get(campo.name)
+
+            if secao is None:
+                leitores.append(itemgetter(posicao.get(campo.name, ausente)))
+            elif not posicao.keys() & secao._fields:
+                # seção fora da projeção: a mesma instância vazia para todas as linhas
+                leitores.append(lambda valores, vazia=secao(): vazia)
+            else:
+                pegar = itemgetter(*(posicao.get(coluna, ausente) for coluna in secao._fields))
+                leitores.append(lambda valores, pegar=pegar, criar=secao._make: criar(pegar(valores)))
+
+        self.leitores = tuple(leitores)
+
+    def montar(self, linha):
+
+        valores = list(linha)
+        for indice, conversor in self.conversoes:
+            valores[indice] = conversor(valores[indice])
+        valores.append(None)
+
+        return Aih(*[ler(valores) for ler in self.leitores])
+
+
+@lru_cache(maxsize=64)
+def plano_aih(colunas):
+    return PlanoAih(colunas)
+
+
+def ler_aihs(cursor):
+    """Aih de cada linha de um cursor já executado sobre aih."""
+
+    cursor.row_factory = None
+    plano = plano_aih(tuple(coluna[0] for coluna in cursor.description))
+
+    for linha in cursor:
+        yield plano.montar(linha)
+
+
+def ler_aih(cursor):
+    return next(ler_aihs(cursor), None)
+
+
+def criar_tabela_usuarios(conn):
 
-    conn = conectar_db()
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -122,11 +668,14 @@ def criar_tabela_usuarios():
     )
     """)
 
-    conn.commit()
-    conn.close()
+
+# Custo atual do PBKDF2. Hashes gravados com outro valor são refeitos no
+# próximo login bem-sucedido (precisa_rehash).
+ITERACOES_SENHA = int(os.getenv("AIH_ITERACOES_SENHA", "120000"))
 
 
-def gerar_hash_senha(senha, iteracoes=120000):
+def gerar_hash_senha(senha, iteracoes=None):
+    iteracoes = iteracoes or ITERACOES_SENHA
     sal = secrets.token_hex(16)
     senha_hash = hashlib.pbkdf2_hmac(
         "sha256",
@@ -156,7 +705,15 @@ def verificar_senha(senha, senha_hash):
         return False
 
 
-def garantir_usuarios_padrao():
+def precisa_rehash(senha_hash):
+    try:
+        algoritmo, iteracoes, _ = senha_hash.split("$", 2)
+        return algoritmo != "pbkdf2_sha256" or int(iteracoes) != ITERACOES_SENHA
+    except (ValueError, TypeError, AttributeError):
+        return True
+
+
+def garantir_usuarios_padrao(conn):
     usuarios_padrao = [
         {
             "login": os.getenv("AIH_MEDICO_USER", "medico"),
@@ -170,7 +727,6 @@ def garantir_usuarios_padrao():
         },
     ]
 
-    conn = conectar_db()
     cursor = conn.cursor()
 
     for usuario in usuarios_padrao:
@@ -190,19 +746,16 @@ def garantir_usuarios_padrao():
                 ),
             )
 
-    conn.commit()
-    conn.close()
-
 
-def garantir_colunas_status():
+def garantir_colunas_status(conn):
     colunas_necessarias = {
         "usuario_aprovacao": "TEXT",
         "data_aprovacao": "TEXT",
         "usuario_reprovacao": "TEXT",
         "data_reprovacao": "TEXT",
+        "paciente_id": "INTEGER REFERENCES paciente (id)",
     }
 
-    conn = conectar_db()
     cursor = conn.cursor()
     cursor.execute("PRAGMA table_info(aih)")
     colunas_existentes = {coluna[1] for coluna in cursor.fetchall()}
@@ -211,792 +764,4558 @@ def garantir_colunas_status():
         if coluna not in colunas_existentes:
             cursor.execute(f"ALTER TABLE aih ADD COLUMN {coluna} {tipo}")
 
-    conn.commit()
-    conn.close()
 
+# Índices gerenciados da tabela aih. Índices "idx_aih_*" que não estiverem
+# aqui são removidos, e os que mudaram de definição são recriados.
+INDICES_AIH = {
+    "idx_aih_status_data": "aih (status, data_solicitacao)",
+    "idx_aih_data_solicitacao": "aih (data_solicitacao)",
+    "idx_aih_arquivo_pdf": "aih (arquivo_pdf)",
+    "idx_aih_paciente": "aih (paciente_id, data_solicitacao)",
+}
 
-# ---------------- CONFIG ----------------
 
-app = Flask(__name__)
-app.secret_key = os.getenv("SECRET_KEY", "aih_secret")
-UPLOAD_FOLDER = "uploads"
-ALLOWED_EXTENSIONS = {"pdf"}
+def garantir_indices(conn, manter=()):
+    """Deixa os idx_aih_* iguais a INDICES_AIH; os nomes em manter não são removidos."""
 
-app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+    cursor = conn.cursor()
 
-# ---------------- logo da santa casa ----------------
+    cursor.execute("""
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND tbl_name = 'aih' AND name GLOB 'idx_aih_*'
+    """)
+    existentes = {nome: sql for nome, sql in cursor.fetchall()}
 
-LOGO_CANDIDATOS = [
-    "logo_santa_casa.png",
-    "logo_santa_casa.jpg",
-    "logo_santa_casa.jpeg",
-    "logo_santa_casa.webp",
-    "logo_santa_casa.svg",
-]
+    alterou = False
 
-# Garante schema pronto mesmo quando a aplicação é iniciada via WSGI/flask run
-criar_tabela()
-garantir_colunas_status()
-criar_tabela_usuarios()
-garantir_usuarios_padrao()
+    for nome, sql in existentes.items():
+        if nome in manter and nome not in INDICES_AIH:
+            continue
+        if sql != f"CREATE INDEX {nome} ON {INDICES_AIH.get(nome)}":
+            cursor.execute(f"DROP INDEX {nome}")
+            alterou = True
 
-# ---------------- AUX ----------------
+    for nome, definicao in INDICES_AIH.items():
+        if existentes.get(nome) != f"CREATE INDEX {nome} ON {definicao}":
+            cursor.execute(f"CREATE INDEX {nome} ON {definicao}")
+            alterou = True
 
-def allowed_file(filename):
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    if alterou:
+        cursor.execute("ANALYZE aih")
 
 
-def login_required(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        if "usuario" not in session:
-            return redirect(url_for("login"))
-        return func(*args, **kwargs)
-    return wrapper
+# Busca textual nas justificativas clínicas. A tabela FTS5 usa aih como
+# conteúdo externo (não duplica o texto) e é mantida pelos gatilhos abaixo.
+COLUNAS_TEXTO_AIH = ["sinais", "condicoes", "provas", "diagnostico", "descricao_procedimento"]
 
 
-def admin_required(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        if "usuario" not in session:
-            return redirect(url_for("login"))
+def criar_indice_textual(conn):
 
-        if session.get("perfil") != "ADM":
-            flash("Acesso restrito ao administrador.")
-            return redirect(url_for("upload_aih"))
+    colunas = ", ".join(COLUNAS_TEXTO_AIH)
+    novos = ", ".join(f"new.{coluna}" for coluna in COLUNAS_TEXTO_AIH)
+    antigos = ", ".join(f"old.{coluna}" for coluna in COLUNAS_TEXTO_AIH)
 
-        return func(*args, **kwargs)
-    return wrapper
+    cursor = conn.cursor()
 
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'aih_fts'")
+    existia = cursor.fetchone() is not None
 
-@app.context_processor
-def injetar_logo_santa_casa():
-    static_dir = os.path.join(os.path.dirname(__file__), "static")
+    cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS aih_fts USING fts5(
+            {colunas},
+            content = 'aih',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    """)
 
-    for arquivo_logo in LOGO_CANDIDATOS:
-        if os.path.exists(os.path.join(static_dir, arquivo_logo)):
-            return {"logo_santa_casa": arquivo_logo}
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS aih_fts_insert AFTER INSERT ON aih BEGIN
+            INSERT INTO aih_fts (rowid, {colunas}) VALUES (new.id, {novos});
+        END
+    """)
 
-    return {"logo_santa_casa": None}
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS aih_fts_delete AFTER DELETE ON aih BEGIN
+            INSERT INTO aih_fts (aih_fts, rowid, {colunas}) VALUES ('delete', old.id, {antigos});
+        END
+    """)
 
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS aih_fts_update AFTER UPDATE OF {colunas} ON aih BEGIN
+            INSERT INTO aih_fts (aih_fts, rowid, {colunas}) VALUES ('delete', old.id, {antigos});
+            INSERT INTO aih_fts (rowid, {colunas}) VALUES (new.id, {novos});
+        END
+    """)
 
-# ---------------- IMPRIMIR PDF ----------------
+    # Banco antigo: indexa o que já estava cadastrado
+    if not existia:
+        cursor.execute("INSERT INTO aih_fts (aih_fts) VALUES ('rebuild')")
 
-#---------ADICIONA ESPAÇO NOS NUMEROS-------
 
-def desenhar_campos(c, valor, x_inicial, y, espacamento=15):
+COLUNAS_FTS_AIH = ", ".join(COLUNAS_TEXTO_AIH)
 
-    if not valor:
-        return
 
-    valor = "".join(filter(str.isdigit, valor))  # mantém só números
+def inserir_em_lote(conn, colunas, linhas):
+    """executemany de INSERTs em aih, indexando o texto no fim do lote.
 
-    for i, char in enumerate(valor):
-        c.drawString(x_inicial + (i * espacamento), y, char)
+    `colunas` são as de aih_completa: o paciente de cada linha passa por
+    gravar_paciente e a AIH entra com o paciente_id. O trigger aih_fts_insert custa mais que o próprio INSERT quando roda linha
+    a linha; aqui ele é removido e recriado dentro da mesma transação (DDL no
+    SQLite é transacional e o BEGIN IMMEDIATE segura as outras escritas), e
+    o lote entra no FTS num único INSERT ... SELECT. Quem chama faz o commit.
+    """
 
-#---------ADICIONA ESPAÇO NOS NUMEROS CEP-------
+    sql, montar_linha = insercao_aih(tuple(colunas))
 
-def desenhar_campos_cep(c, valor, x_inicial, y, espacamento=12):
+    conn.execute("BEGIN IMMEDIATE")
 
-    if not valor:
-        return
+    ultimo_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM aih").fetchone()[0]
+    sql_trigger = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'aih_fts_insert'"
+    ).fetchone()[0]
 
-    valor = "".join(filter(str.isdigit, valor))  # mantém só números
+    conn.execute("DROP TRIGGER aih_fts_insert")
+    conn.executemany(sql, [montar_linha(conn, valores) for valores in linhas])
+    conn.execute(f"""
+        INSERT INTO aih_fts (rowid, {COLUNAS_FTS_AIH})
+        SELECT id, {COLUNAS_FTS_AIH} FROM aih WHERE id > ?
+    """, (ultimo_id,))
+    conn.execute(sql_trigger)
 
-    for i, char in enumerate(valor):
-        c.drawString(x_inicial + (i * espacamento), y, char)
-#--------ARRUMA FORMATO DE DATA----------
 
-def formatar_data(data_iso):
+# Contagem de AIHs por status, clínica, caráter e dia da solicitação, mantida
+# pelos triggers a cada escrita em aih. O painel lê só esta tabela, que cresce
+# com o número de combinações, não com o número de AIHs.
+SEM_INFORMACAO = "(não informado)"
 
-    if not data_iso:
-        return ""
 
-    try:
-        return datetime.strptime(data_iso, "%Y-%m-%d").strftime("%d/%m/%Y")
-    except ValueError:
-        return data_iso
-    
-#----------ARRUMA O CAMPO SEXO--------   
+def chave_resumo(prefixo=""):
+    return ", ".join([
+        f"COALESCE({prefixo}status, 'Pendente')",
+        f"COALESCE(NULLIF(TRIM({prefixo}clinica), ''), '{SEM_INFORMACAO}')",
+        f"COALESCE(NULLIF(TRIM({prefixo}carater), ''), '{SEM_INFORMACAO}')",
+        f"COALESCE(substr({prefixo}data_solicitacao, 1, 10), '')",
+    ])
 
-def marcar_opcao(canvas, valor, esperado, x, y):
 
-    if (valor or "").upper() == esperado:
-        canvas.drawString(x, y, "X")
+CHAVE_RESUMO_AIH = chave_resumo()
 
-#--------------ARRUMA O CAMPO DE ESCRITA PARA PULAR LINHA-----------------
 
-from reportlab.pdfbase.pdfmetrics import stringWidth
+def criar_resumo_aih(conn):
 
-def draw_text_wrapped(canvas, texto, x, y, largura_max, altura_linha=12, fonte="Helvetica", tamanho=8):
+    novos = chave_resumo("new.")
+    antigos = chave_resumo("old.")
 
-    if not texto:
-        return
+    cursor = conn.cursor()
 
-    canvas.setFont(fonte, tamanho)
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'resumo_aih'")
+    existia = cursor.fetchone() is not None
 
-    palavras = texto.split(" ")
-    linha_atual = ""
-    y_atual = y
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS resumo_aih (
+        status TEXT NOT NULL,
+        clinica TEXT NOT NULL,
+        carater TEXT NOT NULL,
+        dia TEXT NOT NULL,
+        quantidade INTEGER NOT NULL,
+        PRIMARY KEY (status, clinica, carater, dia)
+    ) WITHOUT ROWID
+    """)
 
-    for palavra in palavras:
-        teste_linha = linha_atual + palavra + " "
-        largura = stringWidth(teste_linha, fonte, tamanho)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS resumo_aih_insert AFTER INSERT ON aih BEGIN
+            INSERT INTO resumo_aih (status, clinica, carater, dia, quantidade) VALUES ({novos}, 1)
+            ON CONFLICT DO UPDATE SET quantidade = quantidade + 1;
+        END
+    """)
 
-        if largura <= largura_max:
-            linha_atual = teste_linha
-        else:
-            canvas.drawString(x, y_atual, linha_atual)
-            y_atual -= altura_linha
-            linha_atual = palavra + " "
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS resumo_aih_delete AFTER DELETE ON aih BEGIN
+            UPDATE resumo_aih SET quantidade = quantidade - 1
+            WHERE (status, clinica, carater, dia) = ({antigos});
+            DELETE FROM resumo_aih
+            WHERE (status, clinica, carater, dia) = ({antigos}) AND quantidade <= 0;
+        END
+    """)
 
-    if linha_atual:
-        canvas.drawString(x, y_atual, linha_atual)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS resumo_aih_update
+        AFTER UPDATE OF status, clinica, carater, data_solicitacao ON aih BEGIN
+            UPDATE resumo_aih SET quantidade = quantidade - 1
+            WHERE (status, clinica, carater, dia) = ({antigos});
+            DELETE FROM resumo_aih
+            WHERE (status, clinica, carater, dia) = ({antigos}) AND quantidade <= 0;
+            INSERT INTO resumo_aih (status, clinica, carater, dia, quantidade) VALUES ({novos}, 1)
+            ON CONFLICT DO UPDATE SET quantidade = quantidade + 1;
+        END
+    """)
 
-#------------------------------
+    # Banco antigo: conta o que já estava cadastrado
+    if not existia:
+        cursor.execute(f"""
+            INSERT INTO resumo_aih (status, clinica, carater, dia, quantidade)
+            SELECT {CHAVE_RESUMO_AIH}, COUNT(*) FROM aih GROUP BY 1, 2, 3, 4
+            -- auditoria: varredura intencional
+        """)
 
-def gerar_pdf_aih(dados, saida):
 
-    modelo = "Modelo AIH.pdf"   # nome do seu arquivo modelo
+# Arquivos PDF enviados e a fila de extração de texto deles. A própria linha
+# é o job: sobrevive a reinícios e é reivindicada com um UPDATE atômico.
+def criar_tabela_arquivos(conn):
 
-    reader = PdfReader(modelo)
-    writer = PdfWriter()
+    cursor = conn.cursor()
 
-    # cria camada para escrever dados
-    temp = "temp_aih.pdf"
-
-    c = canvas.Canvas(temp, pagesize=A4)
-
-    # =============================
-    # EXEMPLO DE POSIÇÕES
-    # =============================
-
-    #---------CABEÇARIO--------
-
-    c.drawString(35, 745, "IRMANDADE DA SANTA CASA DE MISERICÓRDIA DE PORTO FELIZ")
-    c.drawString(474, 745, "2  0   7   9   9  2  5")
-    c.drawString(35, 720, "IRMANDADE DA SANTA CASA DE MISERICÓRDIA DE PORTO FELIZ")
-    c.drawString(474, 720, "2  0   7   9   9  2  5")
-
-    #---------INDENTIFICAÇÃO DO PACIENTE--------
-
-    c.drawString(35, 678, dados["nome_paciente"] or "")
-    c.drawString(468, 680, dados["prontuario"] or "")
-    desenhar_campos(c, dados["cns"], 42, 655, 17)
-    c.drawString(322, 655, formatar_data(dados["data_nascimento"]))
-    marcar_opcao(c, dados["sexo"], "M", 420, 655)
-    marcar_opcao(c, dados["sexo"], "F", 470, 655)
-    c.drawString(35, 632, dados["nome_mae"] or "")
-    desenhar_campos(c, dados["telefone1"], 417, 632)
-    desenhar_campos(c, dados["telefone2"], 417, 608)
-    c.drawString(35, 609, dados["responsavel"] or "")
-    c.drawString(35, 590, dados["endereco"] or "")
-    c.drawString(35, 565, dados["municipio"] or "")
-    c.drawString(510, 655, dados["raca_cor"] or "")
-    c.drawString(370, 565, dados["ibge"] or "")
-    c.drawString(450, 565, dados["uf"] or "")
-    desenhar_campos_cep(c, dados["cep"], 482, 565)
-
-    #---------JUSTIFICATIVA--------
-
-    draw_text_wrapped(
-    canvas=c,
-    texto=dados["sinais"],
-    x=35,
-    y=530,
-    largura_max=520,
-    altura_linha=11,
-    fonte="Helvetica",
-    tamanho=10
-)
-    draw_text_wrapped(
-    canvas=c,
-    texto=dados["condicoes"],
-    x=35,
-    y=420,
-    largura_max=520,
-    altura_linha=11,
-    fonte="Helvetica",
-    tamanho=10
-)
-    draw_text_wrapped(
-    canvas=c,
-    texto=dados["provas"],
-    x=35,
-    y=365,
-    largura_max=520,
-    altura_linha=11,
-    fonte="Helvetica",
-    tamanho=10
-)    
-    c.drawString(275, 315, dados["cid_principal"] or "")
-    c.drawString(380, 315, dados["cid_secundario"] or "")
-    c.drawString(480, 315, dados["cid_associado"] or "")
-
-
-    #---------INDENTIFICAÇÃO DO PROCEDIMENTO--------
-
-    c.drawString(35, 250, dados["clinica"] or "")
-    c.drawString(135, 250, dados["carater"] or "")
-    c.drawString(35, 315, dados["diagnostico"] or "")
-    c.drawString(35, 275, dados["descricao_procedimento"] or "")
-    c.drawString(405, 275, dados["codigo_procedimento"] or "")
-    c.drawString(306, 228, formatar_data(dados["data_solicitacao"]))
-    c.drawString(45, 40, formatar_data(dados["data_autorizacao"]))
-    c.drawString(35, 228, dados["nome_prof"] or "")
-    desenhar_campos(c, dados["numero_doc_prof"], 340, 250)
-    c.drawString(300, 250, dados["doc_prof"] or "")
-
-    #---------CAUSAS EXTERNAS--------
-
-    desenhar_campos(c, dados["cnpj_seguradora"], 182, 190)
-    desenhar_campos(c, dados["cnpj_empresa"], 182, 165)
-    c.drawString(425, 190, dados["numero_bilhete"] or "")
-    c.drawString(425, 165, dados["cnae"] or "")
-    c.drawString(515, 165, dados["cbor"] or "")
-    c.drawString(515, 190, dados["serie"] or "")
-
-
-    #---------Autorização--------
-
-    c.drawString(400, 90, dados["numero_autorizacao"] or "")
-    c.drawString(35, 100, dados["nome_autorizador"] or "")
-    c.drawString(300, 100, dados["orgao_emissor"] or "") 
-    desenhar_campos(c, dados["numero_doc_autorizador"], 157, 75) 
-    c.drawString(35, 75, dados["doc_autorizador"] or "")
-    
-
-    
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS arquivos_pdf (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        arquivo TEXT UNIQUE NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pendente',
+        tentativas INTEGER NOT NULL DEFAULT 0,
+        erro TEXT,
+        paginas INTEGER,
+        texto TEXT,
+        criado_em TEXT NOT NULL,
+        iniciado_em TEXT,
+        concluido_em TEXT,
+        sha256 TEXT,
+        tamanho INTEGER,
+        caminho TEXT
+    )
+    """)
 
-    c.save()
+    cursor.execute("PRAGMA table_info(arquivos_pdf)")
+    colunas_existentes = {coluna[1] for coluna in cursor.fetchall()}
 
-    # mistura modelo + texto
-    overlay = PdfReader(temp)
+    for coluna, tipo in {"sha256": "TEXT", "tamanho": "INTEGER", "caminho": "TEXT"}.items():
+        if coluna not in colunas_existentes:
+            cursor.execute(f"ALTER TABLE arquivos_pdf ADD COLUMN {coluna} {tipo}")
 
-    page = reader.pages[0]
-    page.merge_page(overlay.pages[0])
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_arquivos_pdf_status ON arquivos_pdf (status, id)")
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_arquivos_pdf_sha256 ON arquivos_pdf (sha256) WHERE sha256 IS NOT NULL"
+    )
 
-    writer.add_page(page)
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS arquivos_pdf_fts USING fts5(
+            texto,
+            content = 'arquivos_pdf',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    """)
 
-    with open(saida, "wb") as f:
-        writer.write(f)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS arquivos_pdf_fts_insert AFTER INSERT ON arquivos_pdf BEGIN
+            INSERT INTO arquivos_pdf_fts (rowid, texto) VALUES (new.id, new.texto);
+        END
+    """)
 
-    os.remove(temp)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS arquivos_pdf_fts_delete AFTER DELETE ON arquivos_pdf BEGIN
+            INSERT INTO arquivos_pdf_fts (arquivos_pdf_fts, rowid, texto) VALUES ('delete', old.id, old.texto);
+        END
+    """)
 
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS arquivos_pdf_fts_update AFTER UPDATE OF texto ON arquivos_pdf BEGIN
+            INSERT INTO arquivos_pdf_fts (arquivos_pdf_fts, rowid, texto) VALUES ('delete', old.id, old.texto);
+            INSERT INTO arquivos_pdf_fts (rowid, texto) VALUES (new.id, new.texto);
+        END
+    """)
 
 
+# Trilha de auditoria: só recebe INSERT (os triggers recusam UPDATE/DELETE).
+def criar_tabela_auditoria(conn):
 
-# ---------------- PDF ----------------
+    cursor = conn.cursor()
 
-def extrair_texto_pdf(caminho):
-    texto = ""
-    try:
-        with pdfplumber.open(caminho) as pdf:
-            for pagina in pdf.pages:
-                texto += pagina.extract_text() or ""
-    except Exception as exc:
-        app.logger.warning("Falha ao extrair texto do PDF %s: %s", caminho, exc)
-    return texto
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS auditoria (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        momento TEXT NOT NULL,
+        evento TEXT NOT NULL,
+        aih_id INTEGER,
+        usuario TEXT,
+        ip TEXT,
+        detalhes TEXT
+    )
+    """)
 
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_auditoria_aih ON auditoria (aih_id, momento)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_auditoria_usuario ON auditoria (usuario, momento)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_auditoria_momento ON auditoria (momento)")
 
-# ---------------- LOG ----------------
+    for operacao in ("UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS auditoria_sem_{operacao.lower()} BEFORE {operacao} ON auditoria BEGIN
+                SELECT RAISE(ABORT, 'auditoria é somente inclusão');
+            END
+        """)
 
-def registrar_log_aceite(arquivo, usuario, ip):
 
-    log_file = "logs_aceite.csv"
-    data_hora = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-    arquivo_existe = os.path.exists(log_file)
+# ---------------- PACIENTES ----------------
 
-    with open(log_file, "a", newline="", encoding="utf-8") as csvfile:
+# A identificação do paciente fica em "paciente", uma linha por pessoa
+# (mesmo CNS ou, sem CNS, mesmo prontuário), e aih aponta para ela por
+# paciente_id. As leituras usam a visão aih_completa com o alias aih, que
+# devolve as colunas de sempre. Em aih, as colunas antigas do paciente ficam
+# NULL depois da migração 2 (DROP COLUMN reescreveria a tabela uma vez por
+# coluna).
 
-        writer = csv.writer(csvfile)
+COLUNAS_PACIENTE = PacienteAih._fields
+COLUNAS_PACIENTE_SQL = ", ".join(COLUNAS_PACIENTE)
+MARCADORES_PACIENTE = ", ".join("?" * len(COLUNAS_PACIENTE))
+ATUALIZAR_PACIENTE = ", ".join(f"{coluna} = COALESCE(?, {coluna})" for coluna in COLUNAS_PACIENTE)
+COMPLETAR_PACIENTE = ", ".join(f"{coluna} = COALESCE({coluna}, ?)" for coluna in COLUNAS_PACIENTE)
+LIMPAR_PACIENTE_AIH = ", ".join(f"{coluna} = NULL" for coluna in COLUNAS_PACIENTE)
 
-        if not arquivo_existe:
-            writer.writerow(["arquivo", "usuario", "ip", "data_hora"])
 
-        writer.writerow([arquivo, usuario, ip, data_hora])
+def criar_tabela_paciente(conn):
 
+    cursor = conn.cursor()
 
-# ---------------- LOGIN ----------------
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS paciente (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome_paciente TEXT,
+        prontuario TEXT,
+        cns TEXT,
+        data_nascimento TEXT,
+        sexo TEXT,
+        raca_cor TEXT,
+        etnia TEXT,
+        nome_mae TEXT,
+        telefone1 TEXT,
+        telefone2 TEXT,
+        responsavel TEXT,
+        endereco TEXT,
+        municipio TEXT,
+        ibge TEXT,
+        uf TEXT,
+        cep TEXT
+    )
+    """)
 
-@app.route("/login", methods=["GET", "POST"])
-def login():
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_paciente_cns ON paciente (cns) WHERE cns IS NOT NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_paciente_prontuario ON paciente (prontuario)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_paciente_nome ON paciente (nome_paciente COLLATE NOCASE)")
+
+
+def criar_visao_aih(conn, transicao=False):
+    """(Re)cria aih_completa: aih com as colunas do paciente na ordem de sempre.
+
+    Durante a migração 2 (transicao) as AIHs ainda sem paciente_id mostram o
+    que está na própria aih; depois a visão vira um JOIN simples, que o
+    planejador pode percorrer pelo índice de paciente (ordem por nome).
+    """
+
+    expressoes = []
+    for coluna in COLUNAS_AIH:
+        if coluna not in COLUNAS_PACIENTE:
+            expressoes.append(f"aih.{coluna}")
+        elif transicao:
+            expressoes.append(f"COALESCE(paciente.{coluna}, aih.{coluna}) AS {coluna}")
+        else:
+            expressoes.append(f"paciente.{coluna}")
+
+    juncao = "LEFT JOIN" if transicao else "JOIN"
+
+    conn.execute("DROP VIEW IF EXISTS aih_completa")
+    conn.execute(f"""
+        CREATE VIEW aih_completa AS
+        SELECT {", ".join(expressoes)}
+        FROM aih {juncao} paciente ON paciente.id = aih.paciente_id
+    """)
+
+
+def gravar_paciente(conn, dados, sobrescrever=True):
+    """id do paciente de `dados` (coluna -> valor), cadastrando se for novo.
+
+    Mesmo CNS é o mesmo paciente; se um dos lados não tem CNS, vale o
+    prontuário. Com sobrescrever, os valores preenchidos substituem os do
+    cadastro (a AIH nova é a mais recente); sem, só completam o que falta.
+    Valores vazios nunca apagam nada. Quem chama faz o commit.
+    """
+
+    valores = {}
+    for coluna in COLUNAS_PACIENTE:
+        valor = dados[coluna]
+        valores[coluna] = (valor.strip() if isinstance(valor, str) else valor) or None
+
+    cns = valores["cns"]
+    prontuario = valores["prontuario"]
+    linha = None
+
+    if cns:
+        linha = conn.execute("SELECT id FROM paciente WHERE cns = ?", (cns,)).fetchone()
+
+    if linha is None and prontuario:
+        linha = conn.execute("""
+            SELECT id FROM paciente
+            WHERE prontuario = ? AND (cns IS NULL OR ? IS NULL)
+            ORDER BY id
+            LIMIT 1
+        """, (prontuario, cns)).fetchone()
+
+    if linha is None:
+        try:
+            return conn.execute(
+                f"INSERT INTO paciente ({COLUNAS_PACIENTE_SQL}) VALUES ({MARCADORES_PACIENTE})",
+                tuple(valores.values()),
+            ).lastrowid
+        except sqlite3.IntegrityError:
+            # o mesmo CNS foi cadastrado por outra conexão entre o SELECT e o INSERT
+            linha = conn.execute("SELECT id FROM paciente WHERE cns = ?", (cns,)).fetchone()
+            if linha is None:
+                raise
+
+    if sobrescrever:
+        conn.execute(f"UPDATE paciente SET {ATUALIZAR_PACIENTE} WHERE id = ?", (*valores.values(), linha[0]))
+    else:
+        conn.execute(f"UPDATE paciente SET {COMPLETAR_PACIENTE} WHERE id = ?", (*valores.values(), linha[0]))
+
+    indice_pacientes.marcar_alterado(linha[0])
+    return linha[0]
+
+
+@lru_cache(maxsize=16)
+def insercao_aih(colunas):
+    """(INSERT em aih, montar_linha(conn, valores)) para linhas com as colunas de aih_completa."""
+
+    posicao = {coluna: indice for indice, coluna in enumerate(colunas)}
+    da_aih = [coluna for coluna in colunas if coluna not in COLUNAS_PACIENTE]
+    pegar_aih = itemgetter(*(posicao[coluna] for coluna in da_aih)) if da_aih else lambda valores: ()
+    nomes = da_aih + ["paciente_id"]
+
+    def montar_linha(conn, valores):
+        paciente = {coluna: valores[posicao[coluna]] if coluna in posicao else None for coluna in COLUNAS_PACIENTE}
+        linha = pegar_aih(valores)
+        if len(da_aih) == 1:
+            linha = (linha,)
+        return (*linha, gravar_paciente(conn, paciente))
+
+    return f"INSERT INTO aih ({', '.join(nomes)}) VALUES ({', '.join('?' * len(nomes))})", montar_linha
+
+
+def inserir_aih(conn, colunas, valores):
+    """Uma AIH (colunas de aih_completa) com o seu paciente; devolve o id. Quem chama faz o commit."""
+
+    sql, montar_linha = insercao_aih(tuple(colunas))
+    return conn.execute(sql, montar_linha(conn, valores)).lastrowid
+
+
+# Migração 2: separa os pacientes das AIHs já cadastradas. Vai da AIH mais
+# nova para a mais antiga completando o cadastro, então prevalecem os dados
+# mais recentes (inclusive os das AIHs gravadas durante a migração).
+
+# Índices de aih que a busca da lista usa nas AIHs ainda sem paciente_id;
+# só saem em concluir_pacientes.
+INDICES_AIH_PACIENTE_ANTIGOS = ("idx_aih_prontuario", "idx_aih_cns", "idx_aih_nome_paciente")
+
+
+def preparar_pacientes(conn):
+
+    criar_tabela_paciente(conn)
+    garantir_colunas_status(conn)
+    garantir_indices(conn, manter=INDICES_AIH_PACIENTE_ANTIGOS)
+    criar_visao_aih(conn, transicao=True)
+    separar_apa_arquivos(conn)
+
+
+def contar_aihs_sem_paciente(conn):
+    return conn.execute("SELECT COUNT(*) FROM aih WHERE paciente_id IS NULL").fetchone()[0]
+
+
+def separar_pacientes(conn, depois_de, tamanho):
+
+    linhas = conn.execute(f"""
+        SELECT id, {COLUNAS_PACIENTE_SQL} FROM aih
+        WHERE id < COALESCE(?, 9223372036854775807) AND paciente_id IS NULL
+        ORDER BY id DESC
+        LIMIT ?
+    """, (depois_de, tamanho)).fetchall()
+
+    if not linhas:
+        return depois_de, 0
+
+    conn.executemany(
+        f"UPDATE aih SET paciente_id = ?, {LIMPAR_PACIENTE_AIH} WHERE id = ?",
+        [(gravar_paciente(conn, linha, sobrescrever=False), linha["id"]) for linha in linhas],
+    )
+
+    return linhas[-1]["id"], len(linhas)
+
+
+# ANALYZE de tabela vazia não grava nada, e sem estatísticas o planejador
+# prefere varrer aih e ordenar a percorrer paciente pelo nome. Num banco novo
+# vão estas (cerca de 4 AIHs por paciente), até o primeiro ANALYZE de verdade.
+ESTATISTICAS_INICIAIS_PACIENTE = [
+    ("aih", "idx_aih_paciente", "10000 4 1"),
+    ("paciente", "idx_paciente_cns", "2500 1"),
+    ("paciente", "idx_paciente_prontuario", "2500 1"),
+    ("paciente", "idx_paciente_nome", "2500 2"),
+]
+
+
+def concluir_pacientes(conn):
+
+    criar_visao_aih(conn)
+    garantir_indices(conn)
+
+    # idx_aih_paciente foi analisado com paciente_id ainda todo NULL
+    conn.execute("ANALYZE aih")
+    conn.execute("ANALYZE paciente")
+
+    if not conn.execute("SELECT 1 FROM sqlite_stat1 WHERE tbl = 'paciente'").fetchone():
+        conn.execute("DELETE FROM sqlite_stat1 WHERE tbl = 'aih' AND idx = 'idx_aih_paciente'")
+        conn.executemany("INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (?, ?, ?)", ESTATISTICAS_INICIAIS_PACIENTE)
+        conn.execute("ANALYZE sqlite_schema")
+
+
+# ---------------- MIGRAÇÕES ----------------
+
+# A versão do schema fica em PRAGMA user_version e cada migração aplicada
+# ganha uma linha em "migracoes" (quando, quanto tempo, quantas linhas). Com o
+# banco em dia, iniciar o processo custa só a leitura do PRAGMA. Mudou o schema
+# (ou INDICES_AIH)? Acrescente uma migração no fim de MIGRACOES.
+#
+# Migração simples: função(conn), roda inteira numa transação junto com o novo
+# user_version. Migração longa (backfill, cópia de tabela): MigracaoEmLotes,
+# em transações curtas com pausa entre elas para as escritas do app passarem.
+
+TAMANHO_LOTE_MIGRACAO = int(os.getenv("AIH_MIGRACAO_LOTE", "2000"))
+PAUSA_LOTE_MIGRACAO = int(os.getenv("AIH_MIGRACAO_PAUSA_MS", "50")) / 1000
+
+
+class MigracaoEmLotes:
+    """Migração feita em lotes, retomável e sem segurar o banco por minutos.
+
+    lote(conn, depois_de, tamanho) processa até `tamanho` linhas seguintes à
+    chave depois_de (None no primeiro lote) e devolve (última chave, linhas
+    processadas); zero linhas encerra a migração. O progresso é gravado
+    em migracoes junto com cada lote: se o processo cair, a próxima execução
+    continua de onde parou, e vários processos podem dividir os lotes.
+    preparar(conn) roda antes do primeiro lote e precisa ser idempotente;
+    concluir(conn) roda na transação final; total(conn) estima as linhas.
+    """
+
+    def __init__(self, lote, total=None, preparar=None, concluir=None):
+        self.lote = lote
+        self.total = total
+        self.preparar = preparar
+        self.concluir = concluir
+
+
+def migrar_esquema_base(conn):
+    """Schema anterior às migrações; idempotente, serve também a bancos já existentes."""
+
+    criar_tabela(conn)
+    garantir_colunas_status(conn)
+    garantir_indices(conn)
+    criar_indice_textual(conn)
+    criar_resumo_aih(conn)
+    criar_tabela_arquivos(conn)
+    criar_tabela_auditoria(conn)
+    criar_tabela_usuarios(conn)
+    garantir_usuarios_padrao(conn)
+
+
+RE_APA_NOME = re.compile(r"_APA_(SIM|NAO)")
+
+
+def apa_do_nome(nome):
+    """APA gravada no nome dos arquivos enviados antes de arquivos_pdf.necessita_apa."""
+
+    achado = RE_APA_NOME.search(nome)
+    return achado.group(1) if achado else None
+
+
+def separar_apa_arquivos(conn):
+    """APA dos PDFs em arquivos_pdf.necessita_apa; antes só existia no nome ("..._APA_SIM_...").
+
+    Idempotente: também roda no preparar da migração 2, porque vindo da
+    versão 1 a migração 3 só é aplicada depois do backfill de pacientes e os
+    uploads já precisam da coluna.
+    """
+
+    if "necessita_apa" in {linha[1] for linha in conn.execute("PRAGMA table_info(arquivos_pdf)")}:
+        return
+
+    conn.execute("ALTER TABLE arquivos_pdf ADD COLUMN necessita_apa TEXT")
+    conn.execute("""
+        UPDATE arquivos_pdf SET necessita_apa = CASE
+            WHEN arquivo GLOB '*_APA_SIM*' THEN 'SIM'
+            WHEN arquivo GLOB '*_APA_NAO*' THEN 'NAO'
+        END
+    """)
+
+
+MIGRACOES = [
+    (1, "esquema base", migrar_esquema_base),
+    (2, "pacientes separados de aih", MigracaoEmLotes(
+        separar_pacientes, total=contar_aihs_sem_paciente, preparar=preparar_pacientes, concluir=concluir_pacientes,
+    )),
+    (3, "APA dos PDFs fora do nome do arquivo", separar_apa_arquivos),
+]
+
+VERSAO_ESQUEMA = MIGRACOES[-1][0]
+
+esquema_pronto = threading.Event()
+_migracao_lock = threading.Lock()
+
+
+def versao_banco(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def criar_tabela_migracoes(conn):
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS migracoes (
+        versao INTEGER PRIMARY KEY,
+        descricao TEXT NOT NULL,
+        iniciada_em TEXT NOT NULL,
+        concluida_em TEXT,
+        duracao_ms REAL,
+        linhas INTEGER NOT NULL DEFAULT 0,
+        progresso INTEGER
+    )
+    """)
+
+
+def concluir_migracao(conn, versao, inicio, linhas=0):
+
+    conn.execute("""
+        UPDATE migracoes SET concluida_em = ?, duracao_ms = ?, linhas = ?
+        WHERE versao = ?
+    """, (
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        round((time.perf_counter() - inicio) * 1000, 1),
+        linhas,
+        versao,
+    ))
+    conn.execute(f"PRAGMA user_version = {int(versao)}")
+
+
+def iniciar_migracao(conn, versao, descricao, migracao, inicio):
+    """Primeira transação: registra a migração e aplica a simples inteira (ou o preparar).
+
+    Devolve False se outro processo já tinha aplicado a versão.
+    """
+
+    conn.execute("BEGIN IMMEDIATE")
+
+    try:
+        # Outro processo pode ter migrado enquanto esperávamos o lock
+        if versao_banco(conn) >= versao:
+            conn.rollback()
+            return False
+
+        criar_tabela_migracoes(conn)
+        conn.execute("""
+            INSERT INTO migracoes (versao, descricao, iniciada_em) VALUES (?, ?, ?)
+            ON CONFLICT (versao) DO NOTHING
+        """, (versao, descricao, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+        if not isinstance(migracao, MigracaoEmLotes):
+            migracao(conn)
+            concluir_migracao(conn, versao, inicio)
+        elif migracao.preparar:
+            migracao.preparar(conn)
+
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    return True
+
+
+def aplicar_migracao(conn, versao, descricao, migracao, avisar=None, tamanho_lote=None, pausa=None):
+    """Aplica uma migração; devolve {"ms", "linhas", "lotes"} ou None se outro processo já aplicou."""
+
+    tamanho_lote = tamanho_lote or TAMANHO_LOTE_MIGRACAO
+    pausa = PAUSA_LOTE_MIGRACAO if pausa is None else pausa
+    inicio = time.perf_counter()
+
+    if not iniciar_migracao(conn, versao, descricao, migracao, inicio):
+        return None
+
+    if not isinstance(migracao, MigracaoEmLotes):
+        return {"ms": (time.perf_counter() - inicio) * 1000, "linhas": 0, "lotes": 0}
+
+    total = migracao.total(conn) if migracao.total else None
+    lotes = 0
+
+    while True:
+
+        marco = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            if versao_banco(conn) >= versao:
+                conn.rollback()
+                break
+
+            depois_de, linhas = conn.execute(
+                "SELECT progresso, linhas FROM migracoes WHERE versao = ?", (versao,)
+            ).fetchone()
+            ultima, feitas = migracao.lote(conn, depois_de, tamanho_lote)
+
+            if feitas:
+                conn.execute(
+                    "UPDATE migracoes SET progresso = ?, linhas = linhas + ? WHERE versao = ?",
+                    (ultima, feitas, versao),
+                )
+            else:
+                if migracao.concluir:
+                    migracao.concluir(conn)
+                concluir_migracao(conn, versao, inicio, linhas)
+
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+        if not feitas:
+            break
+
+        lotes += 1
+        if avisar:
+            avisar(versao, linhas + feitas, total, (time.perf_counter() - marco) * 1000)
+
+        time.sleep(pausa)
+
+    linhas = conn.execute("SELECT linhas FROM migracoes WHERE versao = ?", (versao,)).fetchone()[0]
+    return {"ms": (time.perf_counter() - inicio) * 1000, "linhas": linhas, "lotes": lotes}
+
+
+def simular_migracao(conn, migracao, tamanho_lote=None):
+    """Roda a migração (ou só o primeiro lote) e desfaz; devolve o tempo medido e o estimado."""
+
+    tamanho_lote = tamanho_lote or TAMANHO_LOTE_MIGRACAO
+    inicio = time.perf_counter()
+
+    conn.execute("BEGIN IMMEDIATE")
+
+    try:
+        if not isinstance(migracao, MigracaoEmLotes):
+            migracao(conn)
+            ms = (time.perf_counter() - inicio) * 1000
+            return {"ms": ms, "estimado_ms": ms, "linhas": None}
+
+        if migracao.preparar:
+            migracao.preparar(conn)
+
+        total = migracao.total(conn) if migracao.total else None
+        marco = time.perf_counter()
+        _, feitas = migracao.lote(conn, None, tamanho_lote)
+        ms_lote = (time.perf_counter() - marco) * 1000
+        ms = (time.perf_counter() - inicio) * 1000
+
+        lotes = -(-total // feitas) if total and feitas else 1
+        return {
+            "ms": ms,
+            "estimado_ms": (marco - inicio) * 1000 + lotes * (ms_lote + PAUSA_LOTE_MIGRACAO * 1000),
+            "linhas": total,
+        }
+    finally:
+        conn.rollback()
+
+
+def migracoes_pendentes(conn):
+    versao = versao_banco(conn)
+    return [item for item in MIGRACOES if item[0] > versao]
+
+
+def migrar_em_segundo_plano(pendentes):
+
+    conn = abrir_conexao()
+
+    try:
+        for versao, descricao, migracao in pendentes:
+            resultado = aplicar_migracao(conn, versao, descricao, migracao)
+            if resultado:
+                app.logger.info(
+                    "Migração %s (%s) aplicada: %d linha(s) em %.0f ms",
+                    versao, descricao, resultado["linhas"], resultado["ms"],
+                )
+    except Exception:
+        app.logger.exception("Migração em segundo plano interrompida; continua no próximo início")
+    finally:
+        conn.close()
+
+
+def migrar_banco(online=True, avisar=None):
+    """Aplica as migrações pendentes e devolve as versões aplicadas aqui.
+
+    Com online, a partir da primeira MigracaoEmLotes que tenha linhas a
+    processar o restante segue numa thread e o processo já atende: o preparar
+    dela roda antes, e o código precisa tolerar o backfill pela metade. A CLI
+    (flask migrar) passa online=False e espera tudo.
+    """
+
+    aplicadas = []
+
+    with _migracao_lock:
+
+        if esquema_pronto.is_set():
+            return aplicadas
+
+        conn = abrir_conexao()
+
+        try:
+            pendentes = migracoes_pendentes(conn)
+
+            for posicao, (versao, descricao, migracao) in enumerate(pendentes):
+
+                if online and isinstance(migracao, MigracaoEmLotes):
+                    if not iniciar_migracao(conn, versao, descricao, migracao, time.perf_counter()):
+                        continue
+
+                    # banco novo (nada a migrar): mais rápido terminar aqui mesmo
+                    if migracao.total is None or migracao.total(conn):
+                        threading.Thread(
+                            target=migrar_em_segundo_plano, args=(pendentes[posicao:],),
+                            daemon=True, name="migracoes",
+                        ).start()
+                        break
+
+                if aplicar_migracao(conn, versao, descricao, migracao, avisar):
+                    aplicadas.append(versao)
+        finally:
+            conn.close()
+
+        esquema_pronto.set()
+
+    return aplicadas
+
+
+# ---------------- CONFIG ----------------
+
+app = Flask(__name__)
+app.secret_key = os.getenv("SECRET_KEY", "aih_secret")
+UPLOAD_FOLDER = "uploads"
+ALLOWED_EXTENSIONS = {"pdf"}
+
+app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+
+# Limite do corpo da requisição por endpoint (RequisicaoAih); o Werkzeug
+# responde 413 antes de ler o corpo inteiro. As demais rotas só recebem
+# formulários pequenos e ficam no MAX_CONTENT_LENGTH.
+LIMITE_UPLOAD_BYTES = int(os.getenv("AIH_UPLOAD_MAX_MB", "50")) * 1024 * 1024
+LIMITE_IMPORTACAO_BYTES = int(os.getenv("AIH_IMPORTACAO_MAX_MB", "500")) * 1024 * 1024
+LIMITES_CORPO = {
+    "upload_aih": LIMITE_UPLOAD_BYTES,
+    "nova_aih": LIMITE_UPLOAD_BYTES,
+    "importar": LIMITE_IMPORTACAO_BYTES,
+}
+app.config["MAX_CONTENT_LENGTH"] = 1024 * 1024
+
+
+@app.teardown_appcontext
+def liberar_db(exc):
+
+    conn = g.pop("db", None)
+
+    if isinstance(exc, sqlite3.OperationalError) and "locked" in str(exc):
+        pool_db.registrar_timeout_lock()
+
+    if conn is None:
+        return
+
+    if isinstance(exc, sqlite3.Error):
+        pool_db.descartar(conn)
+    else:
+        pool_db.devolver(conn)
+
+
+# ---------------- MEDIÇÃO DE REQUISIÇÕES ----------------
+
+# Requisições acima deste tempo vão para o log com o SQL que rodaram (0 desliga)
+LIMITE_REQUISICAO_LENTA_MS = float(os.getenv("AIH_LOG_LENTAS_MS", "0"))
+MAXIMO_SQL_POR_LENTA = 50
+
+requisicoes_lentas = deque(maxlen=100)
+
+
+@app.before_request
+def iniciar_medicao():
+
+    g.inicio_requisicao = time.perf_counter()
+
+    if LIMITE_REQUISICAO_LENTA_MS:
+        consultas_requisicao.lista = []
+
+
+@app.after_request
+def registrar_medicao(resposta):
+
+    inicio = g.pop("inicio_requisicao", None)
+    consultas = getattr(consultas_requisicao, "lista", None)
+    consultas_requisicao.lista = None
+
+    if inicio is None:
+        return resposta
+
+    duracao = time.perf_counter() - inicio
+    endpoint = request.endpoint or "desconhecido"
+    metrica_requisicoes.observar(duracao, endpoint, request.method, str(resposta.status_code))
+
+    if consultas is not None and duracao * 1000 >= LIMITE_REQUISICAO_LENTA_MS:
+        lenta = {
+            "momento": datetime.now().isoformat(timespec="seconds"),
+            "endpoint": endpoint,
+            "metodo": request.method,
+            "caminho": request.full_path.rstrip("?"),
+            "status": resposta.status_code,
+            "ms": round(duracao * 1000, 2),
+            "sql_total": len(consultas),
+            "sql_ms": round(sum(tempo for _, tempo in consultas) * 1000, 2),
+            "sql": [
+                {"sql": " ".join(sql.split())[:500], "ms": round(tempo * 1000, 3)}
+                for sql, tempo in sorted(consultas, key=lambda item: -item[1])[:MAXIMO_SQL_POR_LENTA]
+            ],
+        }
+        requisicoes_lentas.append(lenta)
+        app.logger.warning("Requisição lenta: %s", json.dumps(lenta, ensure_ascii=False))
+
+    return resposta
+
+# ---------------- logo da santa casa ----------------
+
+LOGO_CANDIDATOS = [
+    "logo_santa_casa.png",
+    "logo_santa_casa.jpg",
+    "logo_santa_casa.jpeg",
+    "logo_santa_casa.webp",
+    "logo_santa_casa.svg",
+]
+
+# ---------------- AUX ----------------
+
+def allowed_file(filename):
+    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+# ---------------- UPLOADS ----------------
+
+PASTA_RECEBENDO = os.path.join(UPLOAD_FOLDER, ".recebendo")
+
+
+class ArquivoRecebido:
+    """Destino do multipart: grava cada bloco direto no disco e já calcula o SHA-256.
+
+    O arquivo parcial fica em uploads/.recebendo (mesmo sistema de arquivos,
+    então mover_para é um rename) e é apagado no close se ninguém o aproveitou.
+    """
+
+    def __init__(self, limite=LIMITE_UPLOAD_BYTES):
+        os.makedirs(PASTA_RECEBENDO, exist_ok=True)
+        self._arquivo = tempfile.NamedTemporaryFile(dir=PASTA_RECEBENDO, suffix=".parte", delete=False)
+        self._hash = hashlib.sha256()
+        self.limite = limite
+        self.tamanho = 0
+        self.inicio = time.perf_counter()
+        self.fim = self.inicio
+
+    def write(self, dados):
+        self.tamanho += len(dados)
+        # sem Content-Length (chunked) o Werkzeug não sabe o tamanho de antemão
+        if self.limite is not None and self.tamanho > self.limite:
+            self.close()
+            raise RequestEntityTooLarge()
+
+        self._hash.update(dados)
+        self.fim = time.perf_counter()
+        return self._arquivo.write(dados)
+
+    def __getattr__(self, nome):
+        return getattr(self._arquivo, nome)
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def metricas(self):
+        segundos = max(self.fim - self.inicio, 1e-6)
+        return {
+            "bytes": self.tamanho,
+            "segundos": round(segundos, 4),
+            "mb_por_segundo": round(self.tamanho / segundos / (1024 * 1024), 2),
+        }
+
+    def mover_para(self, destino):
+        self._arquivo.close()
+        os.replace(self._arquivo.name, destino)
+
+    def close(self):
+        self._arquivo.close()
+        if os.path.exists(self._arquivo.name):
+            os.remove(self._arquivo.name)
+
+
+class RequisicaoAih(Request):
+
+    @property
+    def max_content_length(self):
+        """LIMITES_CORPO do endpoint; nas outras rotas, o MAX_CONTENT_LENGTH."""
+
+        endpoint = self.url_rule.endpoint if self.url_rule else None
+        if endpoint in LIMITES_CORPO:
+            return LIMITES_CORPO[endpoint]
+
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return ArquivoRecebido(self.max_content_length)
+
+
+app.request_class = RequisicaoAih
+
+
+def receber_upload(file):
+    """ArquivoRecebido do upload, copiando em blocos se veio de outro tipo de stream."""
+
+    if isinstance(file.stream, ArquivoRecebido):
+        return file.stream
+
+    recebido = ArquivoRecebido()
+    for bloco in iter(lambda: file.stream.read(64 * 1024), b""):
+        recebido.write(bloco)
+
+    return recebido
+
+
+class ArmazenamentoPdf:
+    """PDFs enviados em uploads/AAAA/MM/hh/, com hh = início do SHA-256.
+
+    O nome público do arquivo (o que vai em aih.arquivo_pdf e na URL) é único
+    e arquivos_pdf.caminho guarda onde ele está, então nenhuma pasta cresce
+    sem limite e achar um arquivo é uma consulta pela chave. Arquivos antigos,
+    ainda soltos na raiz de uploads/, têm caminho NULL até `flask organizar-uploads`.
+    """
+
+    def __init__(self, pasta):
+        self.pasta = pasta
+
+    def nome(self, prefixo, sha256):
+        # o conteúdo já é deduplicado por hash, então o prefixo do hash torna o nome único
+        return f"{prefixo}_{sha256[:12]}.pdf"
+
+    def relativo(self, arquivo, sha256, quando=None):
+        quando = quando or datetime.now()
+        return f"{quando:%Y}/{quando:%m}/{sha256[:2]}/{arquivo}"
+
+    def absoluto(self, relativo):
+        return os.path.join(self.pasta, *relativo.split("/"))
+
+    def guardar(self, recebido, relativo):
+        destino = self.absoluto(relativo)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        recebido.mover_para(destino)
+
+    def localizar(self, conn, arquivo):
+        """Caminho relativo a uploads/ do arquivo, ou None se não está registrado."""
+
+        item = conn.execute("SELECT caminho FROM arquivos_pdf WHERE arquivo = ?", (arquivo,)).fetchone()
+
+        if item is None:
+            return None
+
+        return item["caminho"] or arquivo
+
+
+armazenamento_pdf = ArmazenamentoPdf(UPLOAD_FOLDER)
+
+metricas_upload = deque(maxlen=200)
+
+
+def salvar_upload(conn, file, prefixo, necessita_apa=None):
+    """Grava o PDF enviado e o registra (e enfileira) em arquivos_pdf.
+
+    Se um arquivo com o mesmo conteúdo já existe, nada é gravado e o nome do
+    existente é devolvido; a resposta de APA, se veio, substitui a anterior.
+    Retorna (nome do arquivo, métricas do upload). Quem chama faz o commit e
+    depois extrator.avisar().
+    """
+
+    recebido = receber_upload(file)
+    metricas = recebido.metricas()
+    metricas["sha256"] = recebido.sha256
+
+    existente = conn.execute(
+        "SELECT arquivo, caminho, necessita_apa FROM arquivos_pdf WHERE sha256 = ?", (recebido.sha256,)
+    ).fetchone()
+
+    metricas["apa_alterada"] = False
+
+    if existente:
+        nome_arquivo = existente["arquivo"]
+        metricas["apa_alterada"] = bool(necessita_apa) and necessita_apa != existente["necessita_apa"]
+        caminho = existente["caminho"] or nome_arquivo
+
+        if os.path.exists(armazenamento_pdf.absoluto(caminho)):
+            recebido.close()
+            metricas["duplicado"] = True
+        else:
+            # o arquivo sumiu do disco: o mesmo conteúdo volta para o lugar registrado
+            armazenamento_pdf.guardar(recebido, caminho)
+            metricas["duplicado"] = False
+
+    else:
+        nome_arquivo = armazenamento_pdf.nome(prefixo, recebido.sha256)
+        caminho = armazenamento_pdf.relativo(nome_arquivo, recebido.sha256)
+
+        armazenamento_pdf.guardar(recebido, caminho)
+        enfileirar_extracao(conn, nome_arquivo, recebido.sha256, recebido.tamanho, caminho)
+        metricas["duplicado"] = False
+
+    if necessita_apa:
+        conn.execute("UPDATE arquivos_pdf SET necessita_apa = ? WHERE arquivo = ?", (necessita_apa, nome_arquivo))
+
+    metricas["arquivo"] = nome_arquivo
+    metricas["necessita_apa"] = necessita_apa
+    metricas["recebido_em"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    metricas_upload.append(metricas)
+
+    auditar(
+        "upload",
+        arquivo=nome_arquivo,
+        sha256=recebido.sha256,
+        bytes=recebido.tamanho,
+        duplicado=metricas["duplicado"],
+    )
+
+    app.logger.info(
+        "Upload %s: %d bytes em %.3fs (%.2f MB/s)%s",
+        nome_arquivo, metricas["bytes"], metricas["segundos"], metricas["mb_por_segundo"],
+        " — duplicado" if metricas["duplicado"] else "",
+    )
+
+    return nome_arquivo, metricas
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_grande_demais(exc):
+
+    mensagem = f"Arquivo maior que o limite de {request.max_content_length // (1024 * 1024)} MB"
+
+    if request.endpoint == "importar" or request.accept_mimetypes.best == "application/json":
+        return jsonify({"erro": mensagem}), 413
+
+    # a página do formulário volta com a mensagem, sem redirecionar
+    flash(mensagem)
+
+    if request.endpoint == "nova_aih":
+        return render_template("nova_aih.html", hoje=datetime.now().strftime("%Y-%m-%d")), 413
+
+    if request.endpoint == "upload_aih":
+        return render_template("upload.html"), 413
+
+    return mensagem, 413
+
+
+def login_required(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if "usuario" not in session:
+            return redirect(url_for("login"))
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def admin_required(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if "usuario" not in session:
+            return redirect(url_for("login"))
+
+        if session.get("perfil") != "ADM":
+            flash("Acesso restrito ao administrador.")
+            return redirect(url_for("upload_aih"))
+
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@app.before_request
+def iniciar_extrator():
+    if os.getenv("AIH_EXTRATOR", "1") == "1":
+        extrator.iniciar()
+
+
+@app.context_processor
+def injetar_logo_santa_casa():
+    static_dir = os.path.join(os.path.dirname(__file__), "static")
+
+    for arquivo_logo in LOGO_CANDIDATOS:
+        if os.path.exists(os.path.join(static_dir, arquivo_logo)):
+            return {"logo_santa_casa": arquivo_logo}
+
+    return {"logo_santa_casa": None}
+
+
+# ---------------- IMPRIMIR PDF ----------------
+
+#--------ARRUMA FORMATO DE DATA----------
+
+def formatar_data(data_iso):
+
+    if not data_iso:
+        return ""
+
+    if isinstance(data_iso, date):
+        return data_iso.strftime("%d/%m/%Y")
+
+    try:
+        return datetime.strptime(data_iso, "%Y-%m-%d").strftime("%d/%m/%Y")
+    except ValueError:
+        return data_iso
+
+#--------------LAYOUT DOS FORMULÁRIOS-----------------
+
+# Posições, fontes e tipo de cada campo ficam no JSON do layout; o mesmo
+# renderizador serve para outros formulários do SUS com outro modelo/JSON.
+CAMINHO_LAYOUT_AIH = os.path.join("layouts", "aih.json")
+
+RE_NAO_DIGITOS = re.compile(r"\D")
+
+
+@lru_cache(maxsize=8192)
+def largura_texto(texto, fonte, tamanho):
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+
+    return stringWidth(texto, fonte, tamanho)
+
+
+class CampoLayout:
+    """Item do layout com tudo que não depende dos dados já calculado."""
+
+    __slots__ = (
+        "tipo", "campo", "texto", "x", "y", "fonte", "tamanho", "espacamento",
+        "espaco_caractere", "esperado", "formato", "largura_max", "altura_linha",
+    )
+
+    def __init__(self, spec, fonte, tamanho):
+        self.tipo = spec.get("tipo", "texto")
+        self.campo = spec.get("campo")
+        self.texto = spec.get("texto", "")
+        self.x = spec["x"]
+        self.y = spec["y"]
+        self.fonte = spec.get("fonte", fonte)
+        self.tamanho = spec.get("tamanho", tamanho)
+        self.espacamento = spec.get("espacamento", 15)
+        self.esperado = spec.get("esperado")
+        self.formato = spec.get("formato")
+        self.largura_max = spec.get("largura_max")
+        self.altura_linha = spec.get("altura_linha", 12)
+
+        # Se todos os dígitos têm a mesma largura na fonte, a sequência sai num
+        # único drawString com espaçamento entre caracteres, e não um por dígito
+        larguras = {largura_texto(digito, self.fonte, self.tamanho) for digito in "0123456789"}
+        self.espaco_caractere = self.espacamento - larguras.pop() if len(larguras) == 1 else None
+
+
+class LayoutFormulario:
+
+    __slots__ = ("modelo", "campos", "versao")
+
+    def __init__(self, modelo, campos, versao):
+        self.modelo = modelo
+        self.campos = campos
+        self.versao = versao
+
+
+def carregar_layout(caminho):
+
+    with open(caminho, encoding="utf-8") as f:
+        spec = json.load(f)
+
+    fonte = spec.get("fonte", "Helvetica")
+    tamanho = spec.get("tamanho", 12)
+
+    campos = [CampoLayout(item, fonte, tamanho) for item in spec["campos"]]
+
+    # Agrupa por fonte para o setFont sair uma vez por grupo
+    campos.sort(key=lambda campo: (campo.fonte, campo.tamanho))
+
+    return LayoutFormulario(spec["modelo"], tuple(campos), os.stat(caminho).st_mtime_ns)
+
+
+_layouts = {}
+
+
+def obter_layout(caminho):
+
+    layout = _layouts.get(caminho)
+
+    if layout is None or layout.versao != os.stat(caminho).st_mtime_ns:
+        layout = carregar_layout(caminho)
+        _layouts[caminho] = layout
+
+    return layout
+
+
+def desenhar_digitos(c, campo, valor):
+
+    digitos = RE_NAO_DIGITOS.sub("", valor)  # mantém só números
+
+    if campo.espaco_caractere is not None:
+        c.drawString(campo.x, campo.y, digitos, charSpace=campo.espaco_caractere)
+        return
+
+    for i, char in enumerate(digitos):
+        c.drawString(campo.x + (i * campo.espacamento), campo.y, char)
+
+
+def desenhar_paragrafo(c, campo, texto):
+
+    fonte, tamanho = campo.fonte, campo.tamanho
+    largura_espaco = largura_texto(" ", fonte, tamanho)
+
+    linha_atual = ""
+    largura_atual = 0.0
+    y_atual = campo.y
+
+    for palavra in texto.split(" "):
+        largura_palavra = largura_texto(palavra, fonte, tamanho) + largura_espaco
+
+        if largura_atual + largura_palavra <= campo.largura_max:
+            linha_atual += palavra + " "
+            largura_atual += largura_palavra
+        else:
+            c.drawString(campo.x, y_atual, linha_atual)
+            y_atual -= campo.altura_linha
+            linha_atual = palavra + " "
+            largura_atual = largura_palavra
+
+    if linha_atual:
+        c.drawString(campo.x, y_atual, linha_atual)
+
+
+def desenhar_layout(c, layout, dados):
+
+    fonte_atual = None
+
+    for campo in layout.campos:
+
+        if (campo.fonte, campo.tamanho) != fonte_atual:
+            fonte_atual = (campo.fonte, campo.tamanho)
+            c.setFont(*fonte_atual)
+
+        if campo.tipo == "fixo":
+            c.drawString(campo.x, campo.y, campo.texto)
+            continue
+
+        valor = dados[campo.campo]
+
+        if not valor:
+            continue
+
+        if campo.tipo == "texto":
+            if campo.formato == "data":
+                valor = formatar_data(valor)
+            c.drawString(campo.x, campo.y, valor)
+
+        elif campo.tipo == "digitos":
+            desenhar_digitos(c, campo, valor)
+
+        elif campo.tipo == "opcao":
+            if valor.upper() == campo.esperado:
+                c.drawString(campo.x, campo.y, "X")
+
+        elif campo.tipo == "paragrafo":
+            desenhar_paragrafo(c, campo, valor)
+
+#------------------------------
+
+# PdfReader lê o arquivo sob demanda e não é thread-safe: cada thread guarda
+# as suas páginas de modelo já pré-compiladas, recarregadas se o arquivo mudar.
+_cache_modelo = threading.local()
+
+
+def obter_pagina_modelo(caminho):
+    from PyPDF2 import PageObject, PdfReader, PdfWriter
+
+    versao = os.stat(caminho).st_mtime_ns
+    modelos = _cache_modelo.__dict__.setdefault("modelos", {})
+
+    if caminho not in modelos or modelos[caminho][0] != versao:
+        with open(caminho, "rb") as f:
+            original = PdfReader(io.BytesIO(f.read())).pages[0]
+
+        # Pré-compila uma vez: o conteúdo do modelo passa a ser um único
+        # fluxo isolado entre q/Q, pronto para receber camadas por cima
+        pagina = PageObject.create_blank_page(
+            width=original.mediabox.width,
+            height=original.mediabox.height,
+        )
+        pagina.merge_page(original)
+
+        writer = PdfWriter()
+        writer.add_page(pagina)
+        compilado = io.BytesIO()
+        writer.write(compilado)
+        compilado.seek(0)
+
+        modelos[caminho] = (versao, PdfReader(compilado).pages[0])
+
+    return modelos[caminho][1]
+
+
+def empilhar_camada(modelo, camada):
+    """Página nova com a camada desenhada por cima do modelo pré-compilado.
+
+    Os fluxos do modelo e da camada entram por referência, sem serem
+    reinterpretados (merge_page reinterpreta e reescreve o conteúdo inteiro a
+    cada chamada). Só cai no merge_page se algum nome de recurso colidir. A
+    página do modelo em cache não é alterada.
+    """
+
+    from PyPDF2 import PageObject
+    from PyPDF2.generic import ArrayObject, DictionaryObject, NameObject
+
+    recursos_modelo = modelo["/Resources"].get_object()
+    recursos_camada = camada["/Resources"].get_object()
+
+    recursos = DictionaryObject()
+
+    for tipo in set(recursos_modelo) | set(recursos_camada):
+
+        do_modelo = recursos_modelo.get(tipo, DictionaryObject()).get_object()
+        da_camada = recursos_camada.get(tipo, DictionaryObject()).get_object()
+
+        if tipo == "/ProcSet":
+            recursos[NameObject(tipo)] = ArrayObject(dict.fromkeys(list(do_modelo) + list(da_camada)))
+            continue
+
+        if set(do_modelo) & set(da_camada):
+            page = PageObject.create_blank_page(width=modelo.mediabox.width, height=modelo.mediabox.height)
+            page.merge_page(modelo)
+            page.merge_page(camada)
+            return page
+
+        combinado = DictionaryObject(do_modelo)
+        combinado.update(da_camada)
+        recursos[NameObject(tipo)] = combinado
+
+    def fluxos(pagina):
+        conteudo = pagina.get("/Contents")
+        if conteudo is None:
+            return []
+        if isinstance(conteudo.get_object(), ArrayObject):
+            return list(conteudo.get_object())
+        return [conteudo]
+
+    page = PageObject(None)
+
+    for chave, valor in modelo.items():
+        if chave not in ("/Contents", "/Resources", "/Parent"):
+            page[NameObject(chave)] = valor
+
+    page[NameObject("/Resources")] = recursos
+    page[NameObject("/Contents")] = ArrayObject(fluxos(modelo) + fluxos(camada))
+
+    return page
+
+
+def renderizar_camada(layout, dados):
+    """PDF (bytes) só com os dados do formulário, sem o modelo."""
+
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    camada = io.BytesIO()
+
+    c = canvas.Canvas(camada, pagesize=A4)
+    desenhar_layout(c, layout, dados)
+    c.save()
+
+    return camada.getvalue()
+
+
+def gerar_pdf_formulario(caminho_layout, dados):
+    """Gera o formulário preenchido em memória a partir do layout.
+
+    Retorna (BytesIO com o PDF, tempos em ms de cada etapa).
+    """
+
+    from PyPDF2 import PdfReader, PdfWriter
+
+    tempos = {}
+    marco = time.perf_counter()
+
+    def medir(etapa):
+        nonlocal marco
+        agora = time.perf_counter()
+        tempos[etapa] = (agora - marco) * 1000
+        marco = agora
+
+    layout = obter_layout(caminho_layout)
+    modelo = obter_pagina_modelo(layout.modelo)
+    medir("modelo")
+
+    # cria camada para escrever dados
+    camada = io.BytesIO(renderizar_camada(layout, dados))
+    medir("overlay")
+
+    # mistura modelo + texto
+    page = empilhar_camada(modelo, PdfReader(camada).pages[0])
+
+    writer = PdfWriter()
+    writer.add_page(page)
+    medir("mesclagem")
+
+    saida = io.BytesIO()
+    writer.write(saida)
+    saida.seek(0)
+    medir("escrita")
+
+    for etapa, duracao in tempos.items():
+        metrica_pdf.observar(duracao / 1000, etapa)
+
+    return saida, tempos
+
+
+def gerar_pdf_aih(dados):
+    return gerar_pdf_formulario(CAMINHO_LAYOUT_AIH, dados)
+
+
+# ---------------- CACHE DE IMPRESSÃO ----------------
+
+_versoes_formulario = {}
+
+
+def versao_formulario(caminho_layout):
+    """Hash do layout + modelo; muda sempre que um dos dois arquivos muda."""
+
+    layout = obter_layout(caminho_layout)
+    marca = (caminho_layout, layout.versao, os.stat(layout.modelo).st_mtime_ns)
+
+    if marca not in _versoes_formulario:
+        resumo = hashlib.sha256()
+        for caminho in (caminho_layout, layout.modelo):
+            with open(caminho, "rb") as f:
+                resumo.update(f.read())
+        _versoes_formulario[marca] = resumo.hexdigest()
+
+    return _versoes_formulario[marca]
+
+
+def chave_impressao(dados, caminho_layout=CAMINHO_LAYOUT_AIH):
+    """Endereço do PDF impresso: hash do conteúdo da linha + versão do formulário."""
+
+    resumo = hashlib.sha256(versao_formulario(caminho_layout).encode())
+    resumo.update(json.dumps(dados, sort_keys=True, default=str).encode())
+    return resumo.hexdigest()
+
+
+class CacheImpressao:
+    """PDFs impressos em disco, por AIH e endereçados pelo conteúdo.
+
+    Um acerto custa um stat. O último uso fica no atime do arquivo (gravado
+    explicitamente, não depende de como o disco está montado) e, quando o
+    total passa do limite, os menos usados são apagados até 90% do limite.
+    """
+
+    def __init__(self, pasta, limite_bytes):
+        self.pasta = pasta
+        self.limite_bytes = limite_bytes
+        self._lock = threading.Lock()
+        self._total = None
+
+    def caminho(self, aih_id, chave):
+        return os.path.join(self.pasta, str(aih_id), f"{chave}.pdf")
+
+    def obter(self, aih_id, chave):
+
+        caminho = self.caminho(aih_id, chave)
+
+        try:
+            info = os.stat(caminho)
+        except FileNotFoundError:
+            return None
+
+        try:
+            os.utime(caminho, (time.time(), info.st_mtime))
+        except OSError:
+            pass
+
+        return caminho, info
+
+    def guardar(self, aih_id, chave, conteudo):
+
+        caminho = self.caminho(aih_id, chave)
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+
+        temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporario, "wb") as f:
+            f.write(conteudo)
+        os.replace(temporario, caminho)
+
+        with self._lock:
+            if self._total is None:
+                self._total = self._medir()
+            else:
+                self._total += len(conteudo)
+
+            if self._total > self.limite_bytes:
+                self._despejar()
+
+        return caminho, os.stat(caminho)
+
+    def invalidar(self, aih_id):
+
+        shutil.rmtree(os.path.join(self.pasta, str(aih_id)), ignore_errors=True)
+
+        with self._lock:
+            self._total = None
+
+    def _arquivos(self):
+        for raiz, _, arquivos in os.walk(self.pasta):
+            for nome in arquivos:
+                caminho = os.path.join(raiz, nome)
+                try:
+                    yield caminho, os.stat(caminho)
+                except FileNotFoundError:
+                    pass
+
+    def _medir(self):
+        return sum(info.st_size for _, info in self._arquivos())
+
+    def _despejar(self):
+
+        arquivos = sorted(self._arquivos(), key=lambda item: item[1].st_atime)
+        total = sum(info.st_size for _, info in arquivos)
+        alvo = self.limite_bytes * 0.9
+
+        for caminho, info in arquivos:
+            if total <= alvo:
+                break
+            try:
+                os.remove(caminho)
+                total -= info.st_size
+                os.rmdir(os.path.dirname(caminho))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                pass  # pasta da AIH ainda tem outras versões
+
+        self._total = total
+
+
+cache_impressao = CacheImpressao(
+    os.getenv("AIH_CACHE_IMPRESSAO", "cache_impressao"),
+    int(os.getenv("AIH_CACHE_IMPRESSAO_MB", "256")) * 1024 * 1024,
+)
+
+
+# ---------------- IMPRESSÃO EM LOTE ----------------
+
+class EscritorPdfContinuo:
+    """Escreve um PDF de várias páginas aos pedaços, sem montá-lo em memória.
+
+    Os objetos do modelo (fluxo de conteúdo, fontes, imagens) são gravados uma
+    única vez e referenciados por todas as páginas; cada página acrescenta só a
+    sua camada. Em memória ficam apenas os deslocamentos da tabela xref e a
+    lista de páginas.
+    """
+
+    def __init__(self, modelo):
+        self.modelo = modelo
+        self.deslocamento = 0
+        self.deslocamentos = {}
+        self.proximo_numero = 1
+        self.paginas = []
+        self.objetos_modelo = {}
+        self.objetos_unicos = {}
+        self.numero_raiz = self._reservar()
+
+    def _reservar(self):
+        numero = self.proximo_numero
+        self.proximo_numero += 1
+        return numero
+
+    def _gravar(self, saida, numero, objeto):
+        from PyPDF2.generic import IndirectObject
+
+        dados = io.BytesIO()
+        dados.write(f"{numero} 0 obj\n".encode())
+        objeto.write_to_stream(dados, None)
+        dados.write(b"\nendobj\n")
+
+        self.deslocamentos[numero] = self.deslocamento
+        self.deslocamento += dados.tell()
+        saida.append(dados.getvalue())
+
+        return IndirectObject(numero, 0, None)
+
+    def _copiar(self, objeto, saida, objetos_pagina):
+        from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, StreamObject
+
+        if isinstance(objeto, IndirectObject):
+
+            # Objetos do modelo: gravados na primeira vez, depois só referência
+            if objeto.pdf is self.modelo.pdf:
+                chave = objeto.idnum
+                if chave not in self.objetos_modelo:
+                    numero = self._reservar()
+                    self.objetos_modelo[chave] = IndirectObject(numero, 0, None)
+                    self._gravar(saida, numero, self._copiar(objeto.get_object(), saida, objetos_pagina))
+                return self.objetos_modelo[chave]
+
+            chave = objeto.idnum
+            if chave not in objetos_pagina:
+                objetos_pagina[chave] = self._indireto(self._copiar(objeto.get_object(), saida, objetos_pagina), saida)
+            return objetos_pagina[chave]
+
+        if isinstance(objeto, StreamObject):
+            copia = StreamObject()
+            copia._data = objeto._data
+            for chave, valor in objeto.items():
+                if chave != "/Length":
+                    copia[NameObject(chave)] = self._copiar(valor, saida, objetos_pagina)
+            return copia
+
+        if isinstance(objeto, DictionaryObject):
+            copia = DictionaryObject()
+            for chave, valor in objeto.items():
+                copia[NameObject(chave)] = self._copiar(valor, saida, objetos_pagina)
+            return copia
+
+        if isinstance(objeto, ArrayObject):
+            return ArrayObject(self._copiar(valor, saida, objetos_pagina) for valor in objeto)
+
+        return objeto
+
+    def _indireto(self, objeto, saida):
+        from PyPDF2.generic import StreamObject
+
+        # Objetos repetidos em toda camada (fonte Helvetica, codificação...)
+        # são gravados uma vez só
+        if not isinstance(objeto, StreamObject):
+            serializado = io.BytesIO()
+            objeto.write_to_stream(serializado, None)
+            chave = serializado.getvalue()
+
+            if chave not in self.objetos_unicos:
+                self.objetos_unicos[chave] = self._gravar(saida, self._reservar(), objeto)
+            return self.objetos_unicos[chave]
+
+        return self._gravar(saida, self._reservar(), objeto)
+
+    def cabecalho(self):
+        dados = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+        self.deslocamento += len(dados)
+        return dados
+
+    def adicionar_pagina(self, camada):
+        """Grava uma página (modelo + camada) e devolve os bytes escritos."""
+
+        from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, StreamObject
+
+        page = empilhar_camada(self.modelo, camada)
+
+        saida = []
+        objetos_pagina = {}
+
+        pagina = DictionaryObject()
+        for chave, valor in page.items():
+            if chave != "/Parent":
+                pagina[NameObject(chave)] = self._copiar(valor, saida, objetos_pagina)
+
+        # Fluxos de conteúdo precisam ser objetos indiretos (o merge_page do
+        # caso de colisão de nomes devolve o fluxo direto)
+        conteudo = pagina.get("/Contents")
+        if isinstance(conteudo, StreamObject):
+            pagina[NameObject("/Contents")] = self._indireto(conteudo, saida)
+        elif isinstance(conteudo, ArrayObject):
+            pagina[NameObject("/Contents")] = ArrayObject(
+                item if isinstance(item, IndirectObject) else self._indireto(item, saida)
+                for item in conteudo
+            )
+
+        pagina[NameObject("/Parent")] = IndirectObject(self.numero_raiz, 0, None)
+        self.paginas.append(self._gravar(saida, self._reservar(), pagina))
+
+        return b"".join(saida)
+
+    def finalizar(self):
+        """Grava a árvore de páginas, o catálogo e a tabela xref."""
+
+        from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject
+
+        saida = []
+
+        raiz = DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): ArrayObject(self.paginas),
+            NameObject("/Count"): NumberObject(len(self.paginas)),
+        })
+        self._gravar(saida, self.numero_raiz, raiz)
+
+        catalogo = self._gravar(saida, self._reservar(), DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): IndirectObject(self.numero_raiz, 0, None),
+        }))
+
+        inicio_xref = self.deslocamento
+        linhas = [f"xref\n0 {self.proximo_numero}\n", "0000000000 65535 f \n"]
+        linhas.extend(f"{self.deslocamentos[numero]:010d} 00000 n \n" for numero in range(1, self.proximo_numero))
+        linhas.append(f"trailer\n<< /Size {self.proximo_numero} /Root {catalogo.idnum} 0 R >>\n")
+        linhas.append(f"startxref\n{inicio_xref}\n%%EOF\n")
+
+        saida.append("".join(linhas).encode())
+        return b"".join(saida)
+
+
+_pool_impressao = None
+_pool_impressao_lock = threading.Lock()
+
+
+def obter_pool_impressao():
+    """Pool de processos para desenhar as camadas (criado no primeiro lote)."""
+
+    global _pool_impressao
+
+    with _pool_impressao_lock:
+        if _pool_impressao is None:
+            _pool_impressao = ProcessPoolExecutor(
+                max_workers=int(os.getenv("AIH_PROCESSOS_IMPRESSAO", str(os.cpu_count() or 1))),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+    return _pool_impressao
+
+
+def renderizar_camada_lote(caminho_layout, dados):
+    # Executado nos processos do pool; cada processo guarda o seu layout
+    return renderizar_camada(obter_layout(caminho_layout), dados)
+
+
+TAMANHO_BLOCO_LOTE = 100
+
+
+def ler_aihs_por_id(ids, caminho_layout=CAMINHO_LAYOUT_AIH):
+    """Linhas das AIHs na ordem dos ids, lidas em blocos; ids inexistentes somem."""
+
+    projecao = projecao_aih("impressao", caminho_layout)
+    conn = conectar_db()
+
+    try:
+        for inicio in range(0, len(ids), TAMANHO_BLOCO_LOTE):
+            bloco = ids[inicio:inicio + TAMANHO_BLOCO_LOTE]
+            cursor = conn.execute(f"""
+                SELECT {projecao} FROM json_each(?) AS lista
+                JOIN aih_completa AS aih ON aih.id = lista.value
+                ORDER BY lista.key
+            """, (json.dumps(bloco),))
+
+            yield from ler_aihs(cursor)
+    finally:
+        conn.close()
+
+
+def renderizar_camadas(ids, caminho_layout, processos):
+    """Camadas das AIHs na ordem dos ids, com no máximo 2x processos em voo."""
+
+    linhas = ler_aihs_por_id(ids, caminho_layout)
+
+    if processos <= 1:
+        layout = obter_layout(caminho_layout)
+        for dados in linhas:
+            yield renderizar_camada(layout, dados)
+        return
+
+    pool = obter_pool_impressao()
+    pendentes = deque()
+
+    try:
+        for dados in linhas:
+            pendentes.append(pool.submit(renderizar_camada_lote, caminho_layout, dados))
+
+            if len(pendentes) >= processos * 2:
+                yield pendentes.popleft().result()
+
+        while pendentes:
+            yield pendentes.popleft().result()
+    finally:
+        for futuro in pendentes:
+            futuro.cancel()
+
+
+def gerar_lote_pdf(ids, caminho_layout=CAMINHO_LAYOUT_AIH, processos=None):
+    """Gera um único PDF com uma página por AIH, entregue aos pedaços (bytes)."""
+
+    from PyPDF2 import PdfReader
+
+    if processos is None:
+        processos = int(os.getenv("AIH_PROCESSOS_IMPRESSAO", str(os.cpu_count() or 1)))
+
+    layout = obter_layout(caminho_layout)
+    escritor = EscritorPdfContinuo(obter_pagina_modelo(layout.modelo))
+
+    yield escritor.cabecalho()
+
+    for camada in renderizar_camadas(ids, caminho_layout, processos):
+        yield escritor.adicionar_pagina(PdfReader(io.BytesIO(camada)).pages[0])
+
+    yield escritor.finalizar()
+
+
+def selecionar_ids_lote(conn, status=None, data_inicio=None, data_fim=None):
+    """Ids das AIHs do filtro, pela data de solicitação; usa os índices de aih."""
+
+    data_inicio = data_inicio or "0000-00-00"
+    data_fim = data_fim or "9999-99-99"
+
+    if status:
+        cursor = conn.execute("""
+            SELECT id FROM aih
+            WHERE status = ? AND data_solicitacao BETWEEN ? AND ?
+            ORDER BY data_solicitacao, id
+        """, (status, data_inicio, data_fim))
+    else:
+        cursor = conn.execute("""
+            SELECT id FROM aih
+            WHERE data_solicitacao BETWEEN ? AND ?
+            ORDER BY data_solicitacao, id
+        """, (data_inicio, data_fim))
+
+    return [linha[0] for linha in cursor]
+
+
+# ---------------- PDF ----------------
+
+def extrair_texto_pdf(caminho):
+    """Texto e número de páginas do PDF. Roda no pool de extração."""
+
+    import pdfplumber
+
+    with pdfplumber.open(caminho) as pdf:
+        texto = "\n".join(pagina.extract_text() or "" for pagina in pdf.pages)
+        return texto, len(pdf.pages)
+
+
+MAXIMO_TENTATIVAS_EXTRACAO = 3
+
+
+def enfileirar_extracao(conn, arquivo, sha256=None, tamanho=None, caminho=None):
+    """Coloca o arquivo na fila; quem chama faz o commit e depois extrator.avisar()."""
+
+    conn.execute(
+        "INSERT OR IGNORE INTO arquivos_pdf (arquivo, criado_em, sha256, tamanho, caminho) VALUES (?, ?, ?, ?, ?)",
+        (arquivo, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), sha256, tamanho, caminho),
+    )
+
+
+_pool_extracao = None
+_pool_extracao_lock = threading.Lock()
+
+
+def obter_pool_extracao():
+
+    global _pool_extracao
+
+    with _pool_extracao_lock:
+        if _pool_extracao is None:
+            _pool_extracao = ProcessPoolExecutor(
+                max_workers=int(os.getenv("AIH_PROCESSOS_EXTRACAO", "1")),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+    return _pool_extracao
+
+
+def processar_proxima_extracao(em_processo=True):
+    """Extrai o próximo PDF pendente. Retorna False se a fila está vazia."""
+
+    agora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    conn = conectar_db()
+
+    try:
+        job = conn.execute("""
+            UPDATE arquivos_pdf
+            SET status = 'processando', tentativas = tentativas + 1, iniciado_em = ?, erro = NULL
+            WHERE id = (
+                SELECT id FROM arquivos_pdf WHERE status = 'pendente' ORDER BY id LIMIT 1
+            )
+            RETURNING id, arquivo, caminho, tentativas
+        """, (agora,)).fetchone()
+        conn.commit()
+
+        if job is None:
+            return False
+
+        caminho = armazenamento_pdf.absoluto(job["caminho"] or job["arquivo"])
+
+        try:
+            if em_processo:
+                futuro = obter_pool_extracao().submit(extrair_texto_pdf, caminho)
+        except RuntimeError:
+            # pool encerrado (o processo está saindo): o job volta intacto para a fila
+            conn.execute(
+                "UPDATE arquivos_pdf SET status = 'pendente', tentativas = tentativas - 1 WHERE id = ?",
+                (job["id"],),
+            )
+            conn.commit()
+            return False
+
+        try:
+            if em_processo:
+                texto, paginas = futuro.result()
+            else:
+                texto, paginas = extrair_texto_pdf(caminho)
+
+        except Exception as exc:
+            app.logger.warning("Falha ao extrair texto do PDF %s: %s", caminho, exc)
+
+            proximo = "erro" if job["tentativas"] >= MAXIMO_TENTATIVAS_EXTRACAO else "pendente"
+            conn.execute(
+                "UPDATE arquivos_pdf SET status = ?, erro = ? WHERE id = ?",
+                (proximo, str(exc)[:500], job["id"]),
+            )
+
+        else:
+            conn.execute("""
+                UPDATE arquivos_pdf
+                SET status = 'concluido', texto = ?, paginas = ?, concluido_em = ?
+                WHERE id = ?
+            """, (texto, paginas, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job["id"]))
+
+        conn.commit()
+        return True
+
+    finally:
+        conn.close()
+
+
+def recuperar_extracoes_travadas(minutos=10):
+    """Jobs que ficaram 'processando' (processo caiu no meio) voltam para a fila."""
+
+    limite = datetime.fromtimestamp(time.time() - minutos * 60).strftime("%Y-%m-%d %H:%M:%S")
+
+    conn = conectar_db()
+    conn.execute(
+        "UPDATE arquivos_pdf SET status = 'pendente' WHERE status = 'processando' AND iniciado_em < ?",
+        (limite,),
+    )
+    conn.commit()
+    conn.close()
+
+
+class ExtratorPdf:
+    """Thread que esvazia a fila de extração fora do caminho das requisições.
+
+    Acorda quando avisada (upload neste processo) ou a cada intervalo (uploads
+    de outros workers, jobs que sobraram de uma execução anterior).
+    """
+
+    def __init__(self, intervalo=30):
+        self.intervalo = intervalo
+        self._acordar = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def iniciar(self):
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            self._thread = threading.Thread(target=self._executar, name="extrator-pdf", daemon=True)
+            self._thread.start()
+
+    def avisar(self):
+        self._acordar.set()
+
+    def _executar(self):
+
+        recuperar_extracoes_travadas()
+
+        while True:
+            try:
+                processou = processar_proxima_extracao()
+            except Exception:
+                app.logger.exception("Erro na fila de extração de PDF")
+                processou = False
+
+            if not processou:
+                self._acordar.wait(self.intervalo)
+                self._acordar.clear()
+
+
+extrator = ExtratorPdf()
+
+
+# ---------------- LOG ----------------
+
+class RegistroAuditoria:
+    """Eventos de auditoria vão para uma fila em memória e uma thread os grava
+    em lote na tabela auditoria, numa transação por lote.
+
+    registrar() não toca no disco; se a fila lotar (banco travado por muito
+    tempo), o evento é gravado na hora para não se perder.
+    """
+
+    def __init__(self, tamanho_lote=500, intervalo=1.0, tamanho_fila=10000):
+        self.tamanho_lote = tamanho_lote
+        self.intervalo = intervalo
+        self._fila = queue.Queue(maxsize=tamanho_fila)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def registrar(self, evento, aih_id=None, usuario=None, ip=None, **detalhes):
+
+        linha = (
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            evento,
+            aih_id,
+            usuario,
+            ip,
+            json.dumps(detalhes, ensure_ascii=False) if detalhes else None,
+        )
+
+        self._iniciar()
+
+        try:
+            self._fila.put(linha, timeout=0.5)
+        except queue.Full:
+            self.gravar([linha])
+
+    def _iniciar(self):
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._executar, name="auditoria", daemon=True)
+                self._thread.start()
+
+    def _executar(self):
+        while True:
+            lote = [self._fila.get()]
+            time.sleep(self.intervalo)
+            self._descarregar_fila(lote)
+
+    def _descarregar_fila(self, lote):
+
+        while len(lote) < self.tamanho_lote:
+            try:
+                lote.append(self._fila.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            for tentativa in range(3):
+                try:
+                    self.gravar(lote)
+                    break
+                except sqlite3.OperationalError:
+                    if tentativa == 2:
+                        raise
+                    time.sleep(self.intervalo * (tentativa + 1))
+        except sqlite3.Error:
+            app.logger.exception("Falha ao gravar %d evento(s) de auditoria", len(lote))
+        finally:
+            for _ in lote:
+                self._fila.task_done()
+
+    def gravar(self, linhas):
+
+        conn = conectar_db()
+        try:
+            conn.executemany("""
+                INSERT INTO auditoria (momento, evento, aih_id, usuario, ip, detalhes)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, linhas)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def descarregar(self):
+        """Espera tudo o que já foi registrado chegar ao banco."""
+        self._fila.join()
+
+
+auditoria = RegistroAuditoria()
+atexit.register(auditoria.descarregar)
+
+
+def auditar(evento, aih_id=None, **detalhes):
+    """Registra um evento da requisição atual (usuário da sessão e IP)."""
+
+    auditoria.registrar(
+        evento,
+        aih_id=aih_id,
+        usuario=session.get("usuario"),
+        ip=request.remote_addr,
+        **detalhes,
+    )
+
+
+def consultar_auditoria(conn, aih_id=None, usuario=None, inicio=None, fim=None, limite=100, antes_de=None):
+    """Eventos mais recentes primeiro; antes_de (id) pagina para trás."""
+
+    condicoes = []
+    valores = []
+
+    for condicao, valor in (
+        ("aih_id = ?", aih_id),
+        ("usuario = ?", usuario),
+        ("momento >= ?", inicio),
+        ("momento <= ?", fim),
+        ("id < ?", antes_de),
+    ):
+        if valor is not None:
+            condicoes.append(condicao)
+            valores.append(valor)
+
+    condicoes_sql = ("WHERE " + " AND ".join(condicoes)) if condicoes else ""
+
+    cursor = conn.execute(f"""
+        SELECT id, momento, evento, aih_id, usuario, ip, detalhes
+        FROM auditoria
+        {condicoes_sql}
+        ORDER BY momento DESC, id DESC
+        LIMIT ?
+    """, (*valores, limite))
+
+    eventos = []
+    for item in cursor.fetchall():
+        evento = dict(item)
+        evento["detalhes"] = json.loads(evento["detalhes"]) if evento["detalhes"] else {}
+        eventos.append(evento)
+
+    return eventos
+
+
+@app.route("/admin/auditoria")
+@admin_required
+def admin_auditoria():
+
+    aih_id = request.args.get("aih_id")
+    fim = request.args.get("fim") or None
+
+    # fim só com a data inclui o dia inteiro
+    if fim and len(fim) == 10:
+        fim += " 23:59:59"
+
+    eventos = consultar_auditoria(
+        obter_db(),
+        aih_id=int(aih_id) if aih_id and aih_id.isdigit() else None,
+        usuario=request.args.get("usuario") or None,
+        inicio=request.args.get("inicio") or None,
+        fim=fim,
+        limite=ler_inteiro(request.args.get("limite"), 100, 1, 1000),
+        antes_de=ler_inteiro(request.args.get("antes_de"), None, 1),
+    )
+
+    return jsonify({"eventos": eventos})
+
+
+@app.cli.command("importar-log-aceite")
+@click.argument("arquivo_csv", default="logs_aceite.csv", type=click.Path(exists=True, dir_okay=False))
+def importar_log_aceite_cli(arquivo_csv):
+    """Copia o antigo logs_aceite.csv para a tabela de auditoria."""
+
+    linhas = []
+
+    with open(arquivo_csv, newline="", encoding="utf-8") as csvfile:
+        for item in csv.DictReader(csvfile):
+            momento = datetime.strptime(item["data_hora"], "%d/%m/%Y %H:%M:%S")
+            linhas.append((
+                momento.strftime("%Y-%m-%d %H:%M:%S"),
+                "aceite_legado",
+                None,
+                item["usuario"],
+                item["ip"],
+                json.dumps({"arquivo": item["arquivo"]}, ensure_ascii=False),
+            ))
+
+    auditoria.gravar(linhas)
+    click.echo(f"{len(linhas)} evento(s) importado(s)")
+
+
+# ---------------- LOGIN ----------------
+
+class SobrecargaLogin(Exception):
+    """Fila de verificação de senhas cheia."""
+
+
+class VerificadorSenhas:
+    """Executa o PBKDF2 num pool pequeno de threads, com fila limitada.
+
+    No máximo `concorrencia` hashes rodam ao mesmo tempo (o hashlib solta o
+    GIL, então o resto da aplicação continua atendendo) e no máximo
+    `tamanho_fila` logins esperam por eles; acima disso o login é recusado
+    na hora em vez de prender mais um worker.
+    """
+
+    def __init__(self, concorrencia=2, tamanho_fila=16, espera_maxima=5):
+        self.espera_maxima = espera_maxima
+        self._executor = ThreadPoolExecutor(max_workers=concorrencia, thread_name_prefix="senha")
+        self._vagas = threading.BoundedSemaphore(concorrencia + tamanho_fila)
+
+    def executar(self, funcao, *args):
+
+        if not self._vagas.acquire(timeout=self.espera_maxima):
+            raise SobrecargaLogin()
+
+        try:
+            return self._executor.submit(funcao, *args).result()
+        finally:
+            self._vagas.release()
+
+
+verificador_senhas = VerificadorSenhas(
+    concorrencia=int(os.getenv("AIH_LOGIN_CONCORRENCIA", "2")),
+    tamanho_fila=int(os.getenv("AIH_LOGIN_FILA", "16")),
+)
+
+@lru_cache(maxsize=1)
+def hash_ficticio():
+    """Verificado quando o login não existe, para a resposta levar o mesmo tempo."""
+    return gerar_hash_senha(secrets.token_hex(16))
+
+
+class ControleTentativas:
+    """Falhas de login por chave (login ou IP), com bloqueio exponencial.
+
+    As primeiras `tolerancia` falhas são livres; depois cada falha dobra o
+    bloqueio, até `bloqueio_maximo` segundos. A contagem recomeça quando a
+    última falha tem mais de `janela` segundos (padrão: o bloqueio máximo).
+    Fica em memória, por processo.
+    """
+
+    def __init__(self, tolerancia, bloqueio_maximo=900, janela=None):
+        self.tolerancia = tolerancia
+        self.bloqueio_maximo = bloqueio_maximo
+        self.janela = bloqueio_maximo if janela is None else janela
+        self._falhas = {}  # chave -> (falhas, liberado_em, última falha)
+        self._lock = threading.Lock()
+
+    def bloqueado_por(self, chave):
+        """Segundos restantes de bloqueio da chave (0 se liberada)."""
+
+        with self._lock:
+            _, liberado_em, _ = self._falhas.get(chave, (0, 0, 0))
+            return max(0, liberado_em - time.monotonic())
+
+    def registrar_falha(self, chave):
+
+        agora = time.monotonic()
+
+        with self._lock:
+            falhas, _, ultima = self._falhas.get(chave, (0, 0, agora))
+            if agora - ultima > self.janela:
+                falhas = 0
+            falhas += 1
+
+            excesso = falhas - self.tolerancia
+            bloqueio = min(2 ** excesso, self.bloqueio_maximo) if excesso > 0 else 0
+            self._falhas[chave] = (falhas, agora + bloqueio, agora)
+
+            if len(self._falhas) > 10000:
+                self._podar(agora)
+
+    def limpar(self, chave):
+        with self._lock:
+            self._falhas.pop(chave, None)
+
+    def aliviar(self, chave):
+        """Login certo vindo da chave: a contagem cai pela metade.
+
+        Para o IP, que pode ser de uma estação ou NAT compartilhados; zerar
+        deixaria quem tem uma conta válida apagar o próprio rastro de erros.
+        """
+
+        with self._lock:
+            item = self._falhas.get(chave)
+            if item is None:
+                return
+
+            falhas, liberado_em, ultima = item
+            if falhas // 2:
+                self._falhas[chave] = (falhas // 2, liberado_em, ultima)
+            else:
+                del self._falhas[chave]
+
+    def _podar(self, agora):
+        # esquece quem não está bloqueado e não erra há mais que a janela
+        for chave, (_, liberado_em, ultima) in list(self._falhas.items()):
+            if liberado_em < agora and ultima + self.janela < agora:
+                del self._falhas[chave]
+
+    def ativos(self):
+        agora = time.monotonic()
+        with self._lock:
+            return sum(1 for _, liberado_em, _ in self._falhas.values() if liberado_em > agora)
+
+
+tentativas_por_login = ControleTentativas(tolerancia=int(os.getenv("AIH_LOGIN_TOLERANCIA", "5")))
+tentativas_por_ip = ControleTentativas(tolerancia=int(os.getenv("AIH_LOGIN_TOLERANCIA_IP", "20")))
+
+
+class JanelaLatencias:
+    """Últimas N latências (ms) e contadores de resultado, para percentis."""
+
+    def __init__(self, tamanho=1000):
+        self._amostras = deque(maxlen=tamanho)
+        self._lock = threading.Lock()
+        self.contadores = {}
+
+    def registrar(self, resultado, milissegundos):
+        with self._lock:
+            self._amostras.append(milissegundos)
+            self.contadores[resultado] = self.contadores.get(resultado, 0) + 1
+
+    def percentis(self, *quantis):
+
+        with self._lock:
+            amostras = sorted(self._amostras)
+
+        if not amostras:
+            return {f"p{round(q * 100)}": None for q in quantis}
+
+        return {
+            f"p{round(q * 100)}": round(amostras[min(len(amostras) - 1, int(q * len(amostras)))], 2)
+            for q in quantis
+        }
+
+
+latencias_login = JanelaLatencias()
+
+
+def autenticar(conn, login, senha, ip):
+    """Valida login e senha. Retorna (usuario, resultado, segundos de bloqueio)."""
+
+    bloqueio = max(tentativas_por_login.bloqueado_por(login), tentativas_por_ip.bloqueado_por(ip))
+    if bloqueio:
+        return None, "bloqueado", bloqueio
+
+    usuario = conn.execute(
+        "SELECT id, login, senha_hash, perfil FROM usuarios WHERE login = ?",
+        (login,),
+    ).fetchone()
+
+    senha_hash = usuario["senha_hash"] if usuario else hash_ficticio()
+    valida = verificador_senhas.executar(verificar_senha, senha, senha_hash) and usuario is not None
+
+    if not valida:
+        tentativas_por_login.registrar_falha(login)
+        tentativas_por_ip.registrar_falha(ip)
+        return None, "falha", 0
+
+    tentativas_por_login.limpar(login)
+    tentativas_por_ip.aliviar(ip)
+
+    if precisa_rehash(usuario["senha_hash"]):
+        conn.execute(
+            "UPDATE usuarios SET senha_hash = ? WHERE id = ?",
+            (verificador_senhas.executar(gerar_hash_senha, senha), usuario["id"]),
+        )
+        conn.commit()
+
+    return usuario, "sucesso", 0
+
+
+@app.route("/login", methods=["GET", "POST"])
+def login():
+
+    if request.method == "POST":
+
+        login = request.form.get("login") or ""
+        senha = request.form.get("senha") or ""
+
+        inicio = time.perf_counter()
+
+        try:
+            usuario, resultado, bloqueio = autenticar(obter_db(), login, senha, request.remote_addr)
+        except SobrecargaLogin:
+            usuario, resultado, bloqueio = None, "sobrecarga", 5
+
+        latencias_login.registrar(resultado, (time.perf_counter() - inicio) * 1000)
+        auditoria.registrar("login_" + resultado, usuario=login, ip=request.remote_addr)
+
+        if usuario:
+            session["usuario"] = usuario["login"]
+            session["perfil"] = usuario["perfil"]        
+            return redirect(url_for("upload_aih"))
+
+        if resultado == "falha":
+            flash("Usuário ou senha inválidos")
+        else:
+            flash(f"Muitas tentativas de login. Tente novamente em {int(bloqueio) + 1} segundos.")
+            return render_template("login.html"), 429, {"Retry-After": str(int(bloqueio) + 1)}
+
+    return render_template("login.html")
+
+
+@app.route("/admin/login")
+@admin_required
+def admin_login():
+    return jsonify({
+        "latencia_ms": latencias_login.percentis(0.5, 0.9, 0.99),
+        "resultados": dict(latencias_login.contadores),
+        "bloqueios_ativos": {
+            "login": tentativas_por_login.ativos(),
+            "ip": tentativas_por_ip.ativos(),
+        },
+        "iteracoes_pbkdf2": ITERACOES_SENHA,
+    })
+
+
+@app.route("/logout")
+def logout():
+    if "usuario" in session:
+        auditar("logout")
+    session.clear()
+    return redirect(url_for("login"))
+
+# ---------------- ADMIN USUÁRIOS ----------------
+
+@app.route("/admin/usuarios", methods=["GET", "POST"])
+def admin_usuarios():
+
+    if "usuario" not in session:
+        return redirect(url_for("login"))
+
+    if session.get("perfil") != "ADM":
+        flash("Acesso restrito ao administrador.")
+        return redirect(url_for("upload_aih"))
+
+    if request.method == "POST":
+        novo_login = (request.form.get("login") or "").strip()
+        nova_senha = request.form.get("senha") or ""
+        perfil = (request.form.get("perfil") or "").strip().upper()
+
+        perfis_validos = {"ADM", "MEDICO", "SECRETARIA"}
+
+        if not novo_login or not nova_senha:
+            flash("Informe login e senha para cadastrar o usuário.")
+            return redirect(url_for("admin_usuarios"))
+
+        if perfil not in perfis_validos:
+            flash("Perfil inválido. Escolha ADM, MEDICO ou SECRETARIA.")
+            return redirect(url_for("admin_usuarios"))
+
+        conn = obter_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM usuarios WHERE login = ?", (novo_login,))
+        existente = cursor.fetchone()
+
+        if existente:
+            flash("Já existe um usuário com esse login.")
+            return redirect(url_for("admin_usuarios"))
+
+        cursor.execute(
+            """
+            INSERT INTO usuarios (login, senha_hash, perfil)
+            VALUES (?, ?, ?)
+            """,
+            (novo_login, gerar_hash_senha(nova_senha), perfil),
+        )
+
+        conn.commit()
+
+        flash("Usuário cadastrado com sucesso.")
+        return redirect(url_for("admin_usuarios"))
+
+    conn = obter_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, login, perfil FROM usuarios ORDER BY login ASC")
+    usuarios = cursor.fetchall()
+
+    return render_template("admin_usuarios.html", usuarios=usuarios)
+
+
+@app.route("/admin/db")
+@admin_required
+def admin_db():
+    return jsonify(pool_db.estatisticas())
+
+
+@app.route("/admin/uploads")
+@admin_required
+def admin_uploads():
+
+    recentes = list(metricas_upload)
+    gravados = [item for item in recentes if not item["duplicado"]]
+
+    return jsonify({
+        "limite_bytes": LIMITE_UPLOAD_BYTES,
+        "uploads": len(recentes),
+        "duplicados": len(recentes) - len(gravados),
+        "bytes_gravados": sum(item["bytes"] for item in gravados),
+        "mb_por_segundo_medio": round(
+            sum(item["mb_por_segundo"] for item in recentes) / len(recentes), 2
+        ) if recentes else None,
+        "recentes": recentes[::-1],
+    })
+
+
+@app.route("/admin/lentas")
+@admin_required
+def admin_lentas():
+    return jsonify({
+        "limite_ms": LIMITE_REQUISICAO_LENTA_MS or None,
+        "requisicoes": list(requisicoes_lentas)[::-1],
+    })
+
+
+# Exposto sem sessão para o Prometheus; com AIH_METRICAS_TOKEN exige "Authorization: Bearer <token>"
+TOKEN_METRICAS = os.getenv("AIH_METRICAS_TOKEN")
+
+
+@app.route("/metrics")
+def metricas():
+
+    if TOKEN_METRICAS and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {TOKEN_METRICAS}"
+    ):
+        return Response("não autorizado\n", status=401, mimetype="text/plain")
+
+    corpo = "".join(
+        histograma.exportar() for histograma in (metrica_requisicoes, metrica_sql, metrica_pdf)
+    )
+    return Response(corpo, mimetype="text/plain; version=0.0.4")
+
+# ---------------- NOVA AIH ----------------
+@app.route("/nova_aih", methods=["GET","POST"])
+@login_required
+def nova_aih():
+
+    if request.method == "POST":
+
+        # -------- SALVAR PDF --------
+        file = request.files.get("file")
+        necessita_apa = request.form.get("apa")
+
+        arquivo_pdf = None
+
+        # Garante valor padrão
+        if necessita_apa not in ["SIM", "NAO"]:
+            necessita_apa = "NAO"
+
+        if file and file.filename != "" and allowed_file(file.filename):
+
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+            arquivo_pdf = f"aih_{timestamp}"
+
+# -------- SALVAR BANCO --------
+        conn = obter_db()
+        cursor = conn.cursor()
+
+        if arquivo_pdf:
+            arquivo_pdf, _ = salvar_upload(conn, file, arquivo_pdf, necessita_apa)
+
+        paciente_id = gravar_paciente(conn, {coluna: request.form.get(coluna) for coluna in COLUNAS_PACIENTE})
+
+        cursor.execute("""
+INSERT INTO aih (
+    paciente_id,
+
+    sinais, condicoes, provas, diagnostico,
+    cid_principal, cid_secundario, cid_associado,
+
+    descricao_procedimento, codigo_procedimento, clinica, carater,
+    doc_prof, numero_doc_prof, nome_prof, data_solicitacao,
+
+    tipo_acidente, cnpj_seguradora, cnpj_empresa, numero_bilhete,
+    cnae, serie, cbor, vinculo_empresa,
+
+    nome_autorizador, orgao_emissor, doc_autorizador,
+    numero_doc_autorizador, data_autorizacao, numero_autorizacao,
+
+    arquivo_pdf, necessita_apa
+)
+VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+""", (
+
+    paciente_id,
+
+    request.form.get("sinais"),
+    request.form.get("condicoes"),
+    request.form.get("provas"),
+    request.form.get("diagnostico"),
+
+    request.form.get("cid_principal"),
+    request.form.get("cid_secundario"),
+    request.form.get("cid_associado"),
+
+    request.form.get("descricao_procedimento"),
+    request.form.get("codigo_procedimento"),
+    request.form.get("clinica"),
+    request.form.get("carater"),
+
+    request.form.get("doc_prof"),
+    request.form.get("numero_doc_prof"),
+    request.form.get("nome_prof"),
+    request.form.get("data_solicitacao"),
+
+    request.form.get("tipo_acidente"),
+    request.form.get("cnpj_seguradora"),
+    request.form.get("cnpj_empresa"),
+    request.form.get("numero_bilhete"),
+
+    request.form.get("cnae"),
+    request.form.get("serie"),
+    request.form.get("cbor"),
+    request.form.get("vinculo_empresa"),
+
+    request.form.get("nome_autorizador"),
+    request.form.get("orgao_emissor"),
+    request.form.get("doc_autorizador"),
+    request.form.get("numero_doc_autorizador"),
+    request.form.get("data_autorizacao"),
+    request.form.get("numero_autorizacao"),
+
+    arquivo_pdf,
+    necessita_apa
+))
+
+
+        conn.commit()
+        extrator.avisar()
+        auditar("aih_criada", cursor.lastrowid, arquivo=arquivo_pdf)
+
+        flash("AIH salva com sucesso!")
+        return redirect("/lista")
+
+    indice_pacientes.aquecer()
+
+    return render_template(
+    "nova_aih.html",
+    hoje=datetime.now().strftime("%Y-%m-%d")
+)
+
+
+#-------------------ROTA AIH----------------
+
+@app.route("/aih")
+@login_required
+def listar_aih_completa():
+
+    conn = obter_db()
+    cursor = conn.cursor()
+
+    projecao = projecao_aih("lista")
+    cursor.execute(f"SELECT {projecao} FROM aih_completa AS aih ORDER BY id DESC -- auditoria: varredura intencional")
+    lista = list(ler_aihs(cursor))
+
+
+    return render_template("aih_lista.html", lista=lista)
+
+
+
+
+# ---------------- UPLOAD PDF ----------------
+
+@app.route("/", methods=["GET", "POST"])
+@login_required
+def upload_aih():
 
     if request.method == "POST":
 
-        login = request.form.get("login")
-        senha = request.form.get("senha")
+        file = request.files.get("file")
+        apa = request.form.get("apa")
+
+        if not file or file.filename == "":
+            flash("Selecione um arquivo")
+            return redirect(request.url)
+
+        if not allowed_file(file.filename):
+            flash("Apenas PDF permitido")
+            return redirect(request.url)
+
+        if apa not in ["SIM", "NAO"]:
+            flash("Informe se necessita de APA")
+            return redirect(request.url)
+
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+        conn = obter_db()
+        nome_arquivo, metricas = salvar_upload(conn, file, f"aih_{timestamp}", apa)
+        conn.commit()
+        extrator.avisar()
+
+        if request.accept_mimetypes.best == "application/json":
+            return jsonify({
+                "arquivo": nome_arquivo,
+                "extracao": url_for("status_extracao", arquivo=nome_arquivo),
+                "upload": metricas,
+            }), 200 if metricas["duplicado"] else 202
+
+        if metricas["duplicado"] and metricas["apa_alterada"]:
+            flash("Este PDF já havia sido enviado; o arquivo existente foi mantido com a nova resposta de APA")
+        elif metricas["duplicado"]:
+            flash("Este PDF já havia sido enviado; o arquivo existente foi mantido")
+        else:
+            flash("AIH enviada com sucesso")
+
+    return render_template("upload.html")
+
+
+# ---------------- LISTAGEM ----------------
+
+# Colunas da tabela de lista.html (mesma ordem) -> expressão SQL usada no
+# ORDER BY. Só entra na query o que estiver aqui, nunca o valor vindo do cliente.
+COLUNAS_ORDENACAO_LISTA = {
+    0: "nome_paciente COLLATE NOCASE",
+    2: "data_solicitacao",
+    3: "status",
+    4: "data_solicitacao",
+}
+
+# Prefixo no nome e igualdade nos identificadores: todos usam índice de
+# paciente, e as AIHs de cada paciente achado vêm pelo idx_aih_paciente
+FILTRO_BUSCA_LISTA = """WHERE aih.paciente_id IN (
+    SELECT id FROM paciente WHERE nome_paciente LIKE ? ESCAPE '\\' OR prontuario = ? OR cns = ?
+)"""
+
+# Durante a migração 2 as AIHs ainda sem paciente_id são achadas pelas
+# próprias colunas, com os índices antigos de aih (INDICES_AIH_PACIENTE_ANTIGOS)
+FILTRO_BUSCA_LISTA_TRANSICAO = """WHERE aih.id IN (
+    SELECT id FROM aih WHERE paciente_id IN (
+        SELECT id FROM paciente WHERE nome_paciente LIKE ? ESCAPE '\\' OR prontuario = ? OR cns = ?
+    )
+    UNION ALL
+    SELECT id FROM aih
+    WHERE paciente_id IS NULL AND (nome_paciente LIKE ? ESCAPE '\\' OR prontuario = ? OR cns = ?)
+)"""
+
+pacientes_separados = threading.Event()
+
+
+def pacientes_em_transicao(conn):
+    """True enquanto a migração 2 não terminou (neste ou em outro processo)."""
+
+    if pacientes_separados.is_set():
+        return False
+
+    if versao_banco(conn) >= 2:
+        pacientes_separados.set()
+        return False
+
+    return True
+
+TAMANHO_MAXIMO_PAGINA = 100
+
+
+def formatar_item_lista(item, hoje):
+
+    # -------- APA --------
+    apa = "Sim" if item.necessita_apa == "SIM" else "Não"
+
+    # -------- STATUS --------
+    status = item.status or "Pendente"
+
+    # -------- DATA / DIAS NO SISTEMA --------
+    data_hora = "-"
+    dias_sistema = "-"
+
+    data_envio = item.procedimento.data_solicitacao
+
+    # fora do formato AAAA-MM-DD a data continua str e a linha fica sem data
+    if isinstance(data_envio, date):
+
+        data_hora = data_envio.strftime("%d/%m/%Y")
+
+        if status == "Pendente":
+            dias_sistema = f"{(hoje - data_envio).days} dia(s)"
+        else:
+            dias_sistema = "✔ Finalizada"
+
+    return {
+        "arquivo": item.arquivo_pdf,
+        "paciente": item.paciente.nome_paciente,
+        "id": item.id,
+        "apa": apa,
+        "status": status,
+        "data_hora": data_hora,
+        "dias": dias_sistema
+    }
+
+
+def ler_inteiro(valor, padrao, minimo=0, maximo=None):
+    try:
+        numero = int(valor)
+    except (TypeError, ValueError):
+        return padrao
+
+    numero = max(numero, minimo)
+
+    if maximo is not None:
+        numero = min(numero, maximo)
+
+    return numero
+
+
+@app.route("/lista")
+@login_required
+def listar_aih():
+    # As linhas são carregadas sob demanda por /lista/dados (DataTables serverSide)
+    return render_template("lista.html")
+
+
+@app.route("/lista/dados")
+@login_required
+def listar_aih_dados():
+
+    draw = ler_inteiro(request.args.get("draw"), 0)
+    inicio = ler_inteiro(request.args.get("start"), 0)
+    tamanho = ler_inteiro(request.args.get("length"), 10, 1, TAMANHO_MAXIMO_PAGINA)
+    busca = (request.args.get("search[value]") or "").strip()
+
+    coluna = ler_inteiro(request.args.get("order[0][column]"), -1, -1)
+    direcao = "ASC" if request.args.get("order[0][dir]") == "asc" else "DESC"
+
+    # "Dias no sistema" cresce quando a data de envio diminui
+    if coluna == 4:
+        direcao = "DESC" if direcao == "ASC" else "ASC"
+
+    ordenacao = COLUNAS_ORDENACAO_LISTA.get(coluna)
+    if ordenacao:
+        ordem_sql = f"{ordenacao} {direcao}, id DESC"
+    else:
+        ordem_sql = "id DESC"
+
+    filtro_sql = ""
+    parametros = []
+
+    conn = obter_db()
+    cursor = conn.cursor()
+
+    if busca:
+        prefixo = busca.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        parametros = [prefixo + "%", busca, busca]
+        filtro_busca = FILTRO_BUSCA_LISTA
+
+        if pacientes_em_transicao(conn):
+            filtro_busca = FILTRO_BUSCA_LISTA_TRANSICAO
+            parametros = parametros * 2
+
+        filtro_sql = filtro_busca
+
+    cursor.execute("SELECT COUNT(*) FROM aih -- auditoria: varredura intencional")
+    total = cursor.fetchone()[0]
+
+    if busca:
+        cursor.execute(f"SELECT COUNT(*) FROM aih_completa AS aih {filtro_busca}", parametros)
+        filtrados = cursor.fetchone()[0]
+    else:
+        filtrados = total
+
+    projecao = projecao_aih("lista")
+    cursor.execute(f"""
+        SELECT {projecao}
+        FROM aih_completa AS aih
+        {filtro_sql}
+        ORDER BY {ordem_sql}
+        LIMIT ? OFFSET ?
+    """, parametros + [tamanho, inicio])
+
+    hoje = date.today()
+
+    return jsonify({
+        "draw": draw,
+        "recordsTotal": total,
+        "recordsFiltered": filtrados,
+        "data": [formatar_item_lista(item, hoje) for item in ler_aihs(cursor)],
+    })
+
+
+# ---------------- BUSCA TEXTUAL ----------------
+
+# Marcadores do snippet(); trocados por <mark> só depois de escapar o texto
+MARCA_INICIO = "\x02"
+MARCA_FIM = "\x03"
+
+
+def montar_consulta_fts(texto):
+    # Cada palavra vira um termo entre aspas com prefixo: nada do que o
+    # usuário digitar é interpretado como sintaxe do FTS5
+    return " ".join(f'"{termo}"*' for termo in re.findall(r"\w+", texto))
+
+
+def destacar_trecho(trecho):
+    return str(escape(trecho or "")).replace(MARCA_INICIO, "<mark>").replace(MARCA_FIM, "</mark>")
+
+
+@app.route("/busca")
+@login_required
+def busca():
+    return render_template("busca.html")
+
+
+@app.route("/busca/dados")
+@login_required
+def busca_dados():
+
+    texto = (request.args.get("q") or "").strip()
+    pagina = ler_inteiro(request.args.get("pagina"), 1, 1)
+    tamanho = ler_inteiro(request.args.get("tamanho"), 20, 1, TAMANHO_MAXIMO_PAGINA)
+
+    resposta = {"q": texto, "pagina": pagina, "tamanho": tamanho, "total": 0, "resultados": []}
+
+    consulta = montar_consulta_fts(texto)
+    if not consulta:
+        return jsonify(resposta)
+
+    conn = obter_db()
+    cursor = conn.cursor()
+
+    if request.args.get("fonte") == "pdf":
+        return jsonify(buscar_texto_pdfs(cursor, consulta, pagina, tamanho, resposta))
+
+    cursor.execute("SELECT COUNT(*) FROM aih_fts WHERE aih_fts MATCH ?", (consulta,))
+    resposta["total"] = cursor.fetchone()[0]
+
+    cursor.execute("""
+        SELECT aih.id, aih.nome_paciente, aih.status, aih.data_solicitacao,
+               snippet(aih_fts, -1, ?, ?, '…', 16) AS trecho,
+               aih_fts.rank AS relevancia
+        FROM aih_fts
+        JOIN aih_completa AS aih ON aih.id = aih_fts.rowid
+        WHERE aih_fts MATCH ?
+        ORDER BY aih_fts.rank
+        LIMIT ? OFFSET ?
+    """, (MARCA_INICIO, MARCA_FIM, consulta, tamanho, (pagina - 1) * tamanho))
+
+    for item in cursor.fetchall():
+        resposta["resultados"].append({
+            "id": item["id"],
+            "paciente": item["nome_paciente"],
+            "status": item["status"] or "Pendente",
+            "data_hora": formatar_data(item["data_solicitacao"]) or "-",
+            "trecho": destacar_trecho(item["trecho"]),
+            "relevancia": item["relevancia"],
+        })
+
+    return jsonify(resposta)
+
+
+def buscar_texto_pdfs(cursor, consulta, pagina, tamanho, resposta):
+    """Mesma busca, sobre o texto extraído dos PDFs enviados."""
+
+    cursor.execute("SELECT COUNT(*) FROM arquivos_pdf_fts WHERE arquivos_pdf_fts MATCH ?", (consulta,))
+    resposta["total"] = cursor.fetchone()[0]
+
+    cursor.execute("""
+        SELECT arquivos_pdf.arquivo, arquivos_pdf.concluido_em,
+               aih.id, aih.status, aih.data_solicitacao,
+               (SELECT nome_paciente FROM aih_completa WHERE aih_completa.id = aih.id) AS nome_paciente,
+               snippet(arquivos_pdf_fts, 0, ?, ?, '…', 16) AS trecho,
+               arquivos_pdf_fts.rank AS relevancia
+        FROM arquivos_pdf_fts
+        JOIN arquivos_pdf ON arquivos_pdf.id = arquivos_pdf_fts.rowid
+        LEFT JOIN aih ON aih.arquivo_pdf = arquivos_pdf.arquivo
+        WHERE arquivos_pdf_fts MATCH ?
+        ORDER BY arquivos_pdf_fts.rank
+        LIMIT ? OFFSET ?
+    """, (MARCA_INICIO, MARCA_FIM, consulta, tamanho, (pagina - 1) * tamanho))
+
+    for item in cursor.fetchall():
+        resposta["resultados"].append({
+            "id": item["id"],
+            "arquivo": item["arquivo"],
+            "paciente": item["nome_paciente"] or item["arquivo"],
+            "status": (item["status"] or "Pendente") if item["id"] else "PDF enviado",
+            "data_hora": formatar_data(item["data_solicitacao"] or item["concluido_em"]) or "-",
+            "trecho": destacar_trecho(item["trecho"]),
+            "relevancia": item["relevancia"],
+        })
+
+    return resposta
+
+
+# ---------------- PAINEL ----------------
+
+# (nome, de, até) em dias desde a solicitação; até None = sem limite
+FAIXAS_IDADE = [
+    ("0 a 2 dias", 0, 2),
+    ("3 a 7 dias", 3, 7),
+    ("8 a 15 dias", 8, 15),
+    ("16 a 30 dias", 16, 30),
+    ("mais de 30 dias", 31, None),
+]
+
+
+def faixa_idade(dia, hoje):
+
+    try:
+        dias = (hoje - datetime.strptime(dia, "%Y-%m-%d").date()).days
+    except ValueError:
+        return "sem data"
+
+    for nome, de, ate in FAIXAS_IDADE:
+        if dias >= de and (ate is None or dias <= ate):
+            return nome
+
+    return FAIXAS_IDADE[0][0]
+
+
+def resumo_painel(conn):
+    """Totais do painel, lidos de resumo_aih (nunca da tabela aih)."""
+
+    por_status = {
+        linha["status"]: linha["total"]
+        for linha in conn.execute(
+            "SELECT status, SUM(quantidade) AS total FROM resumo_aih GROUP BY status"
+        )
+    }
+
+    def agrupado(coluna):
+        return [
+            dict(linha)
+            for linha in conn.execute(f"""
+                SELECT {coluna} AS valor,
+                       SUM(quantidade) AS total,
+                       SUM(CASE WHEN status = 'Pendente' THEN quantidade ELSE 0 END) AS pendentes
+                FROM resumo_aih
+                GROUP BY {coluna}
+                ORDER BY total DESC, valor
+            """)
+        ]
+
+    hoje = datetime.now().date()
+    faixas = {nome: 0 for nome, _, _ in FAIXAS_IDADE}
+
+    for linha in conn.execute("""
+        SELECT dia, SUM(quantidade) AS total
+        FROM resumo_aih
+        WHERE status = 'Pendente'
+        GROUP BY dia
+    """):
+        nome = faixa_idade(linha["dia"], hoje)
+        faixas[nome] = faixas.get(nome, 0) + linha["total"]
+
+    return {
+        "total": sum(por_status.values()),
+        "por_status": por_status,
+        "por_clinica": agrupado("clinica"),
+        "por_carater": agrupado("carater"),
+        "pendentes_por_idade": [{"faixa": nome, "total": total} for nome, total in faixas.items()],
+    }
+
+
+@app.route("/painel")
+@login_required
+def painel():
+    return render_template("painel.html", resumo=resumo_painel(obter_db()))
+
+
+@app.route("/painel/dados")
+@login_required
+def painel_dados():
+    return jsonify(resumo_painel(obter_db()))
+
+
+#----------------LISTA CADASTROS----------------
+
+@app.route("/listar_cadastros")
+@login_required
+def listar_cadastros():
+
+    conn = obter_db()
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT id, nome_paciente, prontuario FROM aih_completa ORDER BY id DESC -- auditoria: varredura intencional")
+    dados = cursor.fetchall()
+
+
+    return render_template("listar_cadastros.html", dados=dados)
+
+#-----------------VER DETALHES DA AIH-----------------
+
+@app.route("/ver_aih/<int:id>")
+@login_required
+def ver_aih(id):
+
+    conn = obter_db()
+    cursor = conn.cursor()
+
+    projecao = projecao_aih("detalhe")
+    cursor.execute(f"SELECT {projecao} FROM aih_completa AS aih WHERE id = ?", (id,))
+    dados = ler_aih(cursor)
+
+    if not dados:
+        return "AIH não encontrada"
+
+    return render_template("ver_aih.html", dados=dados)
+
+
+#-----------------HISTÓRICO DO PACIENTE-----------------
+
+def ler_historico_paciente(conn, paciente_id):
+    """AIHs do paciente, da mais recente para a mais antiga (pelo idx_aih_paciente)."""
+
+    projecao = projecao_aih("lista")
+    cursor = conn.execute(f"""
+        SELECT {projecao} FROM aih_completa AS aih
+        WHERE aih.paciente_id = ?
+        ORDER BY aih.data_solicitacao DESC, aih.id DESC
+    """, (paciente_id,))
+
+    return list(ler_aihs(cursor))
+
+
+@app.route("/paciente/<int:paciente_id>")
+@login_required
+def historico_paciente(paciente_id):
+
+    lista = ler_historico_paciente(obter_db(), paciente_id)
+
+    if not lista:
+        return "Paciente não encontrado"
+
+    titulo = f"AIHs de {lista[0].paciente.nome_paciente or 'paciente sem nome'}"
+    return render_template("aih_lista.html", lista=lista, titulo=titulo)
+
+
+@app.route("/paciente/<int:paciente_id>/dados")
+@login_required
+def historico_paciente_dados(paciente_id):
+
+    conn = obter_db()
+    paciente = conn.execute(
+        f"SELECT id, {COLUNAS_PACIENTE_SQL} FROM paciente WHERE id = ?", (paciente_id,)
+    ).fetchone()
+
+    if not paciente:
+        return jsonify({"erro": "Paciente não encontrado"}), 404
+
+    hoje = date.today()
+
+    return jsonify({
+        "paciente": dict(paciente),
+        "aihs": [formatar_item_lista(item, hoje) for item in ler_historico_paciente(conn, paciente_id)],
+    })
+
+
+
+# ---------------- AUTOCOMPLETAR ----------------
+
+# Sugestões por prefixo para os campos de nova_aih.html. Cada índice é um
+# par de listas ordenadas (chave normalizada, valor) percorrido com bisect:
+# acha o começo do prefixo em O(log n) e lê só as chaves que o têm. CID-10 e
+# SIGTAP vêm de arquivos locais em PASTA_REFERENCIAS (os do DATASUS servem
+# como estão; na falta deles, as amostras cid10.csv e sigtap.csv) e os
+# pacientes vêm da tabela paciente. As respostas ficam num lru_cache que
+# troca de chave quando o arquivo ou o índice de pacientes muda.
+
+PASTA_REFERENCIAS = os.getenv("AIH_REFERENCIAS", "referencias")
+
+# tipo -> arquivos aceitos, em ordem de preferência
+ARQUIVOS_REFERENCIA = {
+    "cid": ("CID-10-SUBCATEGORIAS.CSV", "cid10.csv"),
+    "procedimento": ("tb_procedimento.txt", "sigtap.csv"),
+}
+
+LIMITE_AUTOCOMPLETAR = 10
+MINIMO_PREFIXO_PACIENTE = 2
+VALIDADE_INDICE_PACIENTES = int(os.getenv("AIH_AUTOCOMPLETAR_VALIDADE_S", "300"))
+
+# acima disso é mais barato reler a tabela paciente do que inserir um a um
+LIMITE_ATUALIZACAO_INCREMENTAL = 1000
+
+RE_NAO_ALFANUMERICO = re.compile(r"[^0-9A-Z]+")
+
+
+def normalizar_texto(texto):
+    """Maiúsculas sem acento, com a pontuação virando um espaço."""
+
+    texto = unicodedata.normalize("NFKD", texto or "").encode("ascii", "ignore").decode("ascii")
+    return RE_NAO_ALFANUMERICO.sub(" ", texto.upper()).strip()
+
+
+def normalizar_codigo(texto):
+    """Só letras e números: "A09.0" e "04.07.02.002-2" viram "A090" e "0407020022"."""
+
+    return normalizar_texto(texto).replace(" ", "")
+
+
+def chaves_descricao(texto):
+    """A descrição a partir de cada palavra, para achar "aguda" em "Apendicite aguda"."""
+
+    palavras = normalizar_texto(texto).split()
+    return [" ".join(palavras[posicao:]) for posicao, palavra in enumerate(palavras) if posicao == 0 or len(palavra) >= 3]
+
+
+def variantes_prefixo(texto):
+    return [prefixo for prefixo in dict.fromkeys((normalizar_texto(texto), normalizar_codigo(texto))) if prefixo]
+
+
+class IndicePrefixo:
+    """Chaves ordenadas com os seus valores; busca por prefixo com bisect."""
+
+    __slots__ = ("chaves", "valores")
+
+    def __init__(self, pares=()):
+        pares = sorted(pares)
+        self.chaves = [chave for chave, _ in pares]
+        self.valores = [valor for _, valor in pares]
+
+    def adicionar(self, chave, valor):
+
+        posicao = bisect_left(self.chaves, chave)
+        fim = posicao
+        while fim < len(self.chaves) and self.chaves[fim] == chave:
+            if self.valores[fim] == valor:
+                return
+            fim += 1
+
+        self.chaves.insert(posicao, chave)
+        self.valores.insert(posicao, valor)
+
+    def buscar(self, prefixos, limite):
+        """Valores (sem repetir) das chaves que começam com algum dos prefixos."""
+
+        achados = {}
+
+        for prefixo in prefixos:
+            posicao = bisect_left(self.chaves, prefixo)
+            while posicao < len(self.chaves) and len(achados) < limite:
+                if not self.chaves[posicao].startswith(prefixo):
+                    break
+                achados.setdefault(self.valores[posicao], None)
+                posicao += 1
+
+        return list(achados)
+
+
+# -------- CID-10 E SIGTAP --------
+
+def localizar_referencia(tipo):
+
+    for nome in ARQUIVOS_REFERENCIA[tipo]:
+        caminho = os.path.join(PASTA_REFERENCIAS, nome)
+        if os.path.exists(caminho):
+            return caminho
+
+    return None
+
+
+def ler_referencia(caminho):
+    """(código, descrição) de um arquivo de referência.
+
+    .txt é o layout de largura fixa do SIGTAP (código nas posições 1-10,
+    nome nas 11-260); os demais são CSV com ";" e cabeçalho, com a descrição
+    na coluna DESCRICAO (arquivo do DATASUS) ou na segunda. Linhas com # no
+    começo são comentários. Os arquivos do DATASUS vêm em latin-1.
+    """
+
+    with open(caminho, "rb") as f:
+        bruto = f.read()
+
+    try:
+        texto = bruto.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        texto = bruto.decode("latin-1")
+
+    linhas = [linha for linha in texto.splitlines() if linha.strip() and not linha.startswith("#")]
+
+    if caminho.lower().endswith(".txt"):
+        return [(linha[:10].strip(), linha[10:260].strip()) for linha in linhas]
+
+    leitor = csv.reader(linhas, delimiter=";")
+    cabecalho = [coluna.strip().upper() for coluna in next(leitor, [])]
+    coluna = cabecalho.index("DESCRICAO") if "DESCRICAO" in cabecalho else 1
+
+    return [(linha[0].strip(), linha[coluna].strip()) for linha in leitor if len(linha) > coluna and linha[0].strip()]
 
-        conn = conectar_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT login, senha_hash, perfil FROM usuarios WHERE login = ?",
-            (login,),
-        )
-        usuario = cursor.fetchone()
-        conn.close()
 
-        if usuario and verificar_senha(senha or "", usuario["senha_hash"]):
-            session["usuario"] = usuario["login"]
-            session["perfil"] = usuario["perfil"]        
-            return redirect(url_for("upload_aih"))
+class TabelaReferencia(NamedTuple):
+    itens: tuple
+    indice: IndicePrefixo
+    versao: tuple
 
-        flash("Usuário ou senha inválidos")
 
-    return render_template("login.html")
+def carregar_referencia(tipo, caminho):
 
+    itens = []
+    for codigo, descricao in ler_referencia(caminho):
+        # subcategorias do DATASUS vêm sem ponto ("A090")
+        if tipo == "cid" and len(codigo) == 4 and "." not in codigo:
+            codigo = f"{codigo[:3]}.{codigo[3:]}"
+        itens.append({"codigo": codigo, "descricao": descricao})
 
-@app.route("/logout")
-def logout():
-    session.clear()
-    return redirect(url_for("login"))
+    pares = []
+    for posicao, item in enumerate(itens):
+        pares.append((normalizar_codigo(item["codigo"]), posicao))
+        pares.extend((chave, posicao) for chave in chaves_descricao(item["descricao"]))
 
-# ---------------- ADMIN USUÁRIOS ----------------
+    return TabelaReferencia(tuple(itens), IndicePrefixo(pares), (caminho, os.stat(caminho).st_mtime_ns))
 
-@app.route("/admin/usuarios", methods=["GET", "POST"])
-def admin_usuarios():
 
-    if "usuario" not in session:
-        return redirect(url_for("login"))
+_referencias = {}
 
-    if session.get("perfil") != "ADM":
-        flash("Acesso restrito ao administrador.")
-        return redirect(url_for("upload_aih"))
 
-    if request.method == "POST":
-        novo_login = (request.form.get("login") or "").strip()
-        nova_senha = request.form.get("senha") or ""
-        perfil = (request.form.get("perfil") or "").strip().upper()
+def obter_referencia(tipo):
+    """Tabela do tipo, relida quando o arquivo muda; None sem arquivo."""
 
-        perfis_validos = {"ADM", "MEDICO", "SECRETARIA"}
+    caminho = localizar_referencia(tipo)
+    if caminho is None:
+        return None
 
-        if not novo_login or not nova_senha:
-            flash("Informe login e senha para cadastrar o usuário.")
-            return redirect(url_for("admin_usuarios"))
+    tabela = _referencias.get(tipo)
 
-        if perfil not in perfis_validos:
-            flash("Perfil inválido. Escolha ADM, MEDICO ou SECRETARIA.")
-            return redirect(url_for("admin_usuarios"))
+    if tabela is None or tabela.versao != (caminho, os.stat(caminho).st_mtime_ns):
+        tabela = carregar_referencia(tipo, caminho)
+        _referencias[tipo] = tabela
 
-        conn = conectar_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM usuarios WHERE login = ?", (novo_login,))
-        existente = cursor.fetchone()
+    return tabela
 
-        if existente:
-            conn.close()
-            flash("Já existe um usuário com esse login.")
-            return redirect(url_for("admin_usuarios"))
 
-        cursor.execute(
-            """
-            INSERT INTO usuarios (login, senha_hash, perfil)
-            VALUES (?, ?, ?)
-            """,
-            (novo_login, gerar_hash_senha(nova_senha), perfil),
+@lru_cache(maxsize=2048)
+def sugestoes_referencia(tipo, prefixos, versao):
+    """Itens cujo código ou descrição começa com um dos prefixos (versao só entra na chave do cache)."""
+
+    tabela = _referencias[tipo]
+    return tuple(tabela.itens[posicao] for posicao in tabela.indice.buscar(prefixos, LIMITE_AUTOCOMPLETAR))
+
+
+# -------- PACIENTES --------
+
+def chaves_paciente(nome, prontuario, cns):
+    chaves = (normalizar_texto(nome), normalizar_codigo(prontuario), normalizar_codigo(cns))
+    return [chave for chave in chaves if chave]
+
+
+class IndicePacientes:
+    """Nome, prontuário e CNS de todos os pacientes num IndicePrefixo.
+
+    A cada busca entram os pacientes novos (id maior que o último lido) e os
+    que gravar_paciente alterou neste processo. A chave antiga de quem mudou
+    de nome fica até a próxima recarga, por isso a busca confere o prefixo no
+    cadastro atual; alterações de outros processos entram na recarga, feita a
+    cada VALIDADE_INDICE_PACIENTES segundos. geracao muda junto com o índice.
+    """
+
+    __slots__ = ("indice", "ultimo_id", "alterados", "carregado_em", "geracao", "trava")
+
+    def __init__(self):
+        self.indice = None
+        self.ultimo_id = 0
+        self.alterados = set()
+        self.carregado_em = 0.0
+        self.geracao = 0
+        self.trava = threading.Lock()
+
+    def marcar_alterado(self, paciente_id):
+
+        if self.indice is None:
+            return
+
+        with self.trava:
+            self.alterados.add(paciente_id)
+
+    def recarregar(self, conn):
+
+        linhas = conn.execute(
+            "SELECT id, nome_paciente, prontuario, cns FROM paciente -- auditoria: varredura intencional"
+        ).fetchall()
+
+        self.indice = IndicePrefixo(
+            (chave, linha[0]) for linha in linhas for chave in chaves_paciente(*linha[1:])
         )
+        self.ultimo_id = max((linha[0] for linha in linhas), default=0)
+        self.alterados.clear()
+        self.carregado_em = time.monotonic()
+        self.geracao += 1
+
+    def atualizar(self, conn):
+        """Põe o índice em dia com o banco e devolve a geração."""
+
+        with self.trava:
+
+            if self.indice is None or time.monotonic() - self.carregado_em > VALIDADE_INDICE_PACIENTES:
+                self.recarregar(conn)
+                return self.geracao
+
+            novos = conn.execute(
+                "SELECT id, nome_paciente, prontuario, cns FROM paciente WHERE id > ? ORDER BY id",
+                (self.ultimo_id,),
+            ).fetchall()
+
+            if self.alterados:
+                # CROSS JOIN fixa a ordem: com JOIN o planejador prefere varrer paciente
+                novos += conn.execute("""
+                    SELECT paciente.id, nome_paciente, prontuario, cns
+                    FROM json_each(?) AS lista
+                    CROSS JOIN paciente ON paciente.id = lista.value
+                """, (json.dumps(sorted(self.alterados)),)).fetchall()
+                self.alterados.clear()
+
+            if len(novos) > LIMITE_ATUALIZACAO_INCREMENTAL:
+                self.recarregar(conn)
+            elif novos:
+                for linha in novos:
+                    for chave in chaves_paciente(*linha[1:]):
+                        self.indice.adicionar(chave, linha[0])
+                self.ultimo_id = max(self.ultimo_id, *(linha[0] for linha in novos))
+                self.geracao += 1
+
+            return self.geracao
+
+    def buscar(self, prefixos, limite):
+
+        with self.trava:
+            return self.indice.buscar(prefixos, limite)
+
+    def aquecer(self):
+        """Carrega o índice numa thread, para a primeira busca não pagar a leitura da tabela."""
+
+        if self.indice is not None:
+            return
+
+        def carregar():
+            conn = conectar_db()
+            try:
+                self.atualizar(conn)
+            finally:
+                conn.close()
+
+        threading.Thread(target=carregar, daemon=True).start()
+
+
+indice_pacientes = IndicePacientes()
+
+
+@lru_cache(maxsize=1024)
+def sugestoes_paciente(prefixos, geracao):
+    """Pacientes cujo nome, prontuário ou CNS começa com um dos prefixos.
+
+    geracao só entra na chave do cache. Busca o dobro do limite no índice
+    porque algumas chaves podem ser de dados que o paciente já não tem.
+    """
+
+    ids = indice_pacientes.buscar(prefixos, LIMITE_AUTOCOMPLETAR * 2)
+
+    cursor = obter_db().execute("""
+        SELECT paciente.id, nome_paciente, prontuario, cns, data_nascimento
+        FROM json_each(?) AS lista
+        CROSS JOIN paciente ON paciente.id = lista.value
+        ORDER BY lista.key
+    """, (json.dumps(ids),))
+
+    itens = []
+    for linha in cursor:
+        chaves = chaves_paciente(linha["nome_paciente"], linha["prontuario"], linha["cns"])
+        if any(chave.startswith(prefixo) for chave in chaves for prefixo in prefixos):
+            itens.append(dict(linha))
+
+    return tuple(itens[:LIMITE_AUTOCOMPLETAR])
+
+
+@app.route("/autocompletar/<any(cid, procedimento):tipo>")
+@login_required
+def autocompletar_referencia(tipo):
+
+    tabela = obter_referencia(tipo)
+    prefixos = tuple(variantes_prefixo(request.args.get("q", "")[:80]))
+
+    if tabela is None or not prefixos:
+        return jsonify({"itens": []})
+
+    return jsonify({"itens": list(sugestoes_referencia(tipo, prefixos, tabela.versao))})
+
+
+@app.route("/autocompletar/paciente")
+@login_required
+def autocompletar_paciente():
+    """Ao escolher um paciente, nova_aih.html preenche o cadastro por /paciente/<id>/dados."""
+
+    prefixos = tuple(variantes_prefixo(request.args.get("q", "")[:80]))
+
+    if not prefixos or max(map(len, prefixos)) < MINIMO_PREFIXO_PACIENTE:
+        return jsonify({"itens": []})
+
+    geracao = indice_pacientes.atualizar(obter_db())
+
+    return jsonify({"itens": list(sugestoes_paciente(prefixos, geracao))})
+
+
+
+# ---------------- ACEITAR ----------------
+
+@app.route("/aceitar/<int:id>", methods=["POST"])
+@login_required
+def aceitar_aih(id):
+
+    if session.get("perfil") != "SECRETARIA":
+        return redirect(url_for("listar_aih"))
+
+    conn = obter_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        UPDATE aih
+        SET status = 'Aceita',
+            usuario_aprovacao = ?,
+            data_aprovacao = ?
+        WHERE id = ?
+    """, (
+        session.get("usuario"),
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        id
+    ))
+
+    conn.commit()
+    cache_impressao.invalidar(id)
+    auditar("aih_aceita", id)
+
+    return redirect(url_for("listar_aih"))
+
+
+# ---------------- REPROVAR ----------------
+
+@app.route("/reprovar/<int:id>", methods=["POST"])
+@login_required
+def reprovar_aih(id):
+
+    if session.get("perfil") != "SECRETARIA":
+        return redirect(url_for("listar_aih"))
+
+    conn = obter_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        UPDATE aih
+        SET status = 'Reprovada',
+            usuario_reprovacao = ?,
+            data_reprovacao = ?
+        WHERE id = ?
+    """, (
+        session.get("usuario"),
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        id
+    ))
+
+    conn.commit()
+    cache_impressao.invalidar(id)
+    auditar("aih_reprovada", id)
+
+    return redirect(url_for("listar_aih"))
+
+
+# ---------------- AVALIAR EM LOTE ----------------
+
+# status -> colunas de quem/quando da avaliação
+AVALIACOES = {
+    "aceitar": ("Aceita", "usuario_aprovacao", "data_aprovacao", "aih_aceita"),
+    "reprovar": ("Reprovada", "usuario_reprovacao", "data_reprovacao", "aih_reprovada"),
+}
+
+
+def avaliar_em_lote(conn, ids, acao, usuario, esperado="Pendente"):
+    """Aplica a avaliação a vários ids numa transação só.
+
+    Concorrência otimista: só muda quem ainda está com o status `esperado`
+    (NULL conta como Pendente); quem foi avaliado por outra pessoa nesse meio
+    tempo volta como "conflito" com o status atual. Retorna os resultados na
+    ordem dos ids.
+    """
+
+    novo_status, coluna_usuario, coluna_data, _ = AVALIACOES[acao]
+    agora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # BEGIN IMMEDIATE pega o lock de escrita antes da leitura, então ninguém
+    # muda esses status entre a conferência e o UPDATE
+    conn.execute("BEGIN IMMEDIATE")
+
+    try:
+        atuais = {
+            linha["id"]: linha["status"]
+            for linha in conn.execute("""
+                SELECT aih.id, COALESCE(aih.status, 'Pendente') AS status
+                FROM json_each(?) AS lista
+                JOIN aih ON aih.id = lista.value
+            """, (json.dumps(ids),))
+        }
+
+        alterar = [id for id in ids if atuais.get(id) == esperado]
+
+        cursor = conn.executemany(f"""
+            UPDATE aih
+            SET status = ?, {coluna_usuario} = ?, {coluna_data} = ?
+            WHERE id = ? AND COALESCE(status, 'Pendente') = ?
+        """, [(novo_status, usuario, agora, id, esperado) for id in alterar])
+
+        if cursor.rowcount != len(alterar):
+            raise sqlite3.OperationalError("status mudou durante a avaliação em lote")
+
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    resultados = []
+    for id in ids:
+        if id not in atuais:
+            resultados.append({"id": id, "resultado": "nao_encontrada"})
+        elif atuais[id] != esperado:
+            resultados.append({"id": id, "resultado": "conflito", "status_atual": atuais[id]})
+        else:
+            resultados.append({"id": id, "resultado": "alterada", "status_atual": novo_status})
+
+    return resultados
+
+
+@app.route("/avaliar_lote", methods=["POST"])
+@login_required
+def avaliar_lote():
+
+    if session.get("perfil") != "SECRETARIA":
+        return jsonify({"erro": "Apenas a secretaria pode avaliar AIHs"}), 403
+
+    dados = request.get_json(silent=True) or request.form
+    acao = dados.get("acao")
+
+    if isinstance(dados.get("ids"), list):
+        ids = ler_ids(str(valor) for valor in dados["ids"])
+    else:
+        ids = ler_ids(request.form.getlist("ids"))
+
+    if acao not in AVALIACOES or not ids:
+        return jsonify({"erro": "Informe a ação (aceitar/reprovar) e os ids"}), 400
+
+    if len(ids) > 1000:
+        return jsonify({"erro": "No máximo 1000 AIHs por lote"}), 400
+
+    resultados = avaliar_em_lote(
+        obter_db(), ids, acao, session.get("usuario"), dados.get("esperado") or "Pendente"
+    )
+
+    evento = AVALIACOES[acao][3]
+    for item in resultados:
+        if item["resultado"] == "alterada":
+            cache_impressao.invalidar(item["id"])
+            auditar(evento, item["id"], lote=True)
+
+    return jsonify({
+        "acao": acao,
+        "alteradas": sum(item["resultado"] == "alterada" for item in resultados),
+        "resultados": resultados,
+    })
+
+
+# ---------------- IMPORTAR ----------------
+
+# Colunas de aih_completa que a importação não aceita (o id e o paciente_id
+# são do banco e os PDFs não vêm junto com os registros).
+COLUNAS_FORA_IMPORTACAO = {"id", "arquivo_pdf", "paciente_id"}
+COLUNAS_DATA_IMPORTACAO = {"data_nascimento", "data_solicitacao", "data_autorizacao"}
+STATUS_VALIDOS = {"Pendente", "Aceita", "Reprovada"}
+TAMANHO_LOTE_IMPORTACAO = 5000
+PASTA_IMPORTACOES = "importacoes"
+
+
+def colunas_importacao(conn):
+    return [
+        linha["name"]
+        for linha in conn.execute("PRAGMA table_info(aih_completa)")
+        if linha["name"] not in COLUNAS_FORA_IMPORTACAO
+    ]
+
+
+def ler_registros_importacao(texto, formato):
+    """Gera (número da linha, registro) de um arquivo CSV ou JSON lines.
+
+    Linhas JSON inválidas chegam como (número, ValueError) para irem ao
+    arquivo de rejeitados sem interromper a leitura.
+    """
+
+    if formato == "jsonl":
+        for numero, linha in enumerate(texto, 1):
+            if not linha.strip():
+                continue
+            try:
+                registro = json.loads(linha)
+                if not isinstance(registro, dict):
+                    raise ValueError("a linha não é um objeto JSON")
+            except ValueError as exc:
+                yield numero, ValueError(f"JSON inválido: {exc}")
+                continue
+            yield numero, registro
+        return
+
+    cabecalho = texto.readline()
+    delimitador = ";" if cabecalho.count(";") > cabecalho.count(",") else ","
+    campos = next(csv.reader([cabecalho], delimiter=delimitador))
+
+    leitor = csv.DictReader(texto, fieldnames=[campo.strip() for campo in campos], delimiter=delimitador)
+    for registro in leitor:
+        yield leitor.line_num + 1, registro
+
+
+def normalizar_data(valor):
+    """AAAA-MM-DD ou DD/MM/AAAA -> AAAA-MM-DD (strptime é lento demais por linha)."""
+
+    try:
+        if "/" in valor:
+            dia, mes, ano = valor.split("/")
+            if len(ano) != 4:
+                raise ValueError
+            return date(int(ano), int(mes), int(dia)).isoformat()
+
+        if len(valor) != 10:
+            raise ValueError
+        return date.fromisoformat(valor).isoformat()
+
+    except ValueError:
+        raise ValueError(f"data inválida: {valor!r}") from None
+
+
+def validar_registro_aih(registro, colunas):
+    """Tupla de valores na ordem de `colunas`, ou ValueError com o motivo."""
+
+    valores = dict.fromkeys(colunas)
+
+    for chave, valor in registro.items():
+
+        if chave not in valores:
+            raise ValueError(f"coluna desconhecida: {chave}")
+
+        if valor is not None and not isinstance(valor, str):
+            valor = str(valor)
+        valores[chave] = (valor or "").strip() or None
+
+    if not valores["nome_paciente"]:
+        raise ValueError("nome_paciente é obrigatório")
+
+    for coluna in COLUNAS_DATA_IMPORTACAO:
+        if valores.get(coluna):
+            valores[coluna] = normalizar_data(valores[coluna])
+
+    valores["status"] = valores.get("status") or "Pendente"
+    if valores["status"] not in STATUS_VALIDOS:
+        raise ValueError(f"status inválido: {valores['status']!r}")
+
+    valores["necessita_apa"] = (valores.get("necessita_apa") or "NAO").upper()
+    if valores["necessita_apa"] not in ("SIM", "NAO"):
+        raise ValueError(f"necessita_apa inválido: {valores['necessita_apa']!r}")
+
+    return tuple(valores[coluna] for coluna in colunas)
+
+
+def importar_aihs(conn, registros, rejeitados):
+    """Valida e insere os registros em lotes (um executemany e um commit por lote).
+
+    `registros` vem de ler_registros_importacao; cada linha recusada vai para
+    `rejeitados` (texto, JSON lines) com o número da linha e o motivo.
+    Retorna os totais e a vazão.
+    """
+
+    colunas = colunas_importacao(conn)
+
+    totais = {"lidas": 0, "inseridas": 0, "rejeitadas": 0}
+    inicio = time.perf_counter()
+
+    def rejeitar(numero, motivo, registro):
+        totais["rejeitadas"] += 1
+        rejeitados.write(json.dumps(
+            {"linha": numero, "erro": motivo, "registro": registro}, ensure_ascii=False, default=str
+        ) + "\n")
+
+    def gravar(lote):
+
+        try:
+            inserir_em_lote(conn, colunas, [valores for _, valores, _ in lote])
+            conn.commit()
+            totais["inseridas"] += len(lote)
+            return
+        except sqlite3.DatabaseError:
+            conn.rollback()
+
+        # o lote falhou inteiro: grava linha a linha para achar a culpada
+        for numero, valores, registro in lote:
+            try:
+                inserir_aih(conn, colunas, valores)
+                totais["inseridas"] += 1
+            except sqlite3.DatabaseError as exc:
+                rejeitar(numero, str(exc), registro)
+        conn.commit()
+
+    lote = []
+
+    for numero, registro in registros:
+
+        totais["lidas"] += 1
+
+        if isinstance(registro, Exception):
+            rejeitar(numero, str(registro), None)
+            continue
+
+        try:
+            lote.append((numero, validar_registro_aih(registro, colunas), registro))
+        except ValueError as exc:
+            rejeitar(numero, str(exc), registro)
+            continue
+
+        if len(lote) >= TAMANHO_LOTE_IMPORTACAO:
+            gravar(lote)
+            lote = []
+
+    if lote:
+        gravar(lote)
+
+    segundos = time.perf_counter() - inicio
+    totais["segundos"] = round(segundos, 3)
+    totais["linhas_por_segundo"] = round(totais["lidas"] / segundos) if segundos else None
+    return totais
+
+
+def formato_importacao(nome, formato=None):
+
+    formato = formato or nome.rsplit(".", 1)[-1].lower()
+    if formato in ("json", "ndjson"):
+        formato = "jsonl"
+
+    if formato not in ("csv", "jsonl"):
+        raise ValueError("Formato não suportado (use CSV ou JSON lines)")
+
+    return formato
+
+
+@app.route("/importar", methods=["POST"])
+@admin_required
+def importar():
+
+    arquivo = request.files.get("arquivo")
+    if not arquivo or not arquivo.filename:
+        return jsonify({"erro": "Envie o arquivo no campo 'arquivo'"}), 400
+
+    try:
+        formato = formato_importacao(arquivo.filename, request.form.get("formato"))
+    except ValueError as exc:
+        return jsonify({"erro": str(exc)}), 400
+
+    os.makedirs(PASTA_IMPORTACOES, exist_ok=True)
+    nome_rejeitados = f"rejeitados_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(4)}.jsonl"
+    caminho_rejeitados = os.path.join(PASTA_IMPORTACOES, nome_rejeitados)
+
+    texto = io.TextIOWrapper(arquivo.stream, encoding="utf-8-sig", newline="")
+
+    with open(caminho_rejeitados, "w", encoding="utf-8") as rejeitados:
+        totais = importar_aihs(obter_db(), ler_registros_importacao(texto, formato), rejeitados)
+
+    if totais["rejeitadas"]:
+        totais["rejeitados"] = url_for("baixar_rejeitados", nome=nome_rejeitados)
+    else:
+        os.remove(caminho_rejeitados)
+
+    auditar("importacao", arquivo=arquivo.filename, **{
+        chave: totais[chave] for chave in ("lidas", "inseridas", "rejeitadas")
+    })
+
+    return jsonify(totais)
+
+
+@app.route("/importar/rejeitados/<nome>")
+@admin_required
+def baixar_rejeitados(nome):
+    return send_from_directory(PASTA_IMPORTACOES, nome, as_attachment=True)
+
+
+@app.cli.command("importar-aihs")
+@click.argument("arquivo", type=click.Path(exists=True, dir_okay=False))
+@click.option("--formato", type=click.Choice(["csv", "jsonl"]), default=None, help="Padrão: pela extensão.")
+@click.option("--rejeitados", type=click.Path(dir_okay=False), default=None,
+              help="Padrão: <arquivo>.rejeitados.jsonl")
+def importar_aihs_cli(arquivo, formato, rejeitados):
+    """Importa AIHs de um CSV ou JSON lines."""
+
+    try:
+        formato = formato_importacao(arquivo, formato)
+    except ValueError as exc:
+        raise click.UsageError(str(exc))
+
+    rejeitados = rejeitados or arquivo + ".rejeitados.jsonl"
+    conn = conectar_db()
+
+    with open(arquivo, encoding="utf-8-sig", newline="") as texto, \
+            open(rejeitados, "w", encoding="utf-8") as saida_rejeitados:
+        totais = importar_aihs(conn, ler_registros_importacao(texto, formato), saida_rejeitados)
+
+    conn.close()
+
+    if not totais["rejeitadas"]:
+        os.remove(rejeitados)
+
+    click.echo(
+        f"{totais['inseridas']} inserida(s), {totais['rejeitadas']} rejeitada(s) de "
+        f"{totais['lidas']} linha(s) em {totais['segundos']}s ({totais['linhas_por_segundo']} linhas/s)"
+    )
+    if totais["rejeitadas"]:
+        click.echo(f"Rejeitadas em {rejeitados}")
+
+
+# ---------------- EXPORTAR ----------------
+
+TAMANHO_BLOCO_EXPORTACAO = 1000
+LINHAS_POR_GRUPO_PARQUET = 10000
+FORMATOS_EXPORTACAO = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "jsonl": ("application/x-ndjson; charset=utf-8", "jsonl"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
 
-        conn.commit()
-        conn.close()
+def parquet_disponivel():
+    return importlib.util.find_spec("pyarrow") is not None
 
-        flash("Usuário cadastrado com sucesso.")
-        return redirect(url_for("admin_usuarios"))
 
-    conn = conectar_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, login, perfil FROM usuarios ORDER BY login ASC")
-    usuarios = cursor.fetchall()
-    conn.close()
+def colunas_exportacao(conn, pedidas=None):
+    """Colunas pedidas (na ordem pedida), validadas contra aih_completa."""
 
-    return render_template("admin_usuarios.html", usuarios=usuarios)
+    existentes = [linha["name"] for linha in conn.execute("PRAGMA table_info(aih_completa)")]
 
-# ---------------- NOVA AIH ----------------
-@app.route("/nova_aih", methods=["GET","POST"])
-@login_required
-def nova_aih():
+    if not pedidas:
+        return existentes
 
-    if request.method == "POST":
+    desconhecidas = [coluna for coluna in pedidas if coluna not in existentes]
+    if desconhecidas:
+        raise ValueError("Coluna desconhecida: " + ", ".join(desconhecidas))
 
-        # -------- SALVAR PDF --------
-        file = request.files.get("file")
-        necessita_apa = request.form.get("apa")
+    return list(dict.fromkeys(pedidas))
 
-        arquivo_pdf = None
 
-        # Garante valor padrão
-        if necessita_apa not in ["SIM", "NAO"]:
-            necessita_apa = "NAO"
+def ler_aihs_exportacao(colunas, status=None, data_inicio=None, data_fim=None):
+    """Gera blocos de linhas (tuplas) com fetchmany, numa conexão própria.
 
-        if file and file.filename != "" and allowed_file(file.filename):
+    A ordem segue os índices de aih (data da solicitação, id), então o SQLite
+    não precisa ordenar nada em memória, com ou sem filtro.
+    """
 
-            os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    condicoes = []
+    valores = []
 
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    for condicao, valor in (
+        ("status = ?", status),
+        ("data_solicitacao >= ?", data_inicio),
+        ("data_solicitacao <= ?", data_fim),
+    ):
+        if valor:
+            condicoes.append(condicao)
+            valores.append(valor)
 
-            arquivo_pdf = f"aih_{timestamp}_APA_{necessita_apa}.pdf"
+    filtro_exportacao = ("WHERE " + " AND ".join(condicoes)) if condicoes else ""
+    colunas_sql = ", ".join(colunas)
 
-            caminho = os.path.join(UPLOAD_FOLDER, arquivo_pdf)
+    conn = conectar_db()
+    try:
+        cursor = conn.execute(f"""
+            SELECT {colunas_sql} FROM aih_completa
+            {filtro_exportacao}
+            ORDER BY data_solicitacao, id
+            -- auditoria: varredura intencional
+        """, valores)
+
+        while True:
+            bloco = cursor.fetchmany(TAMANHO_BLOCO_EXPORTACAO)
+            if not bloco:
+                break
+            yield [tuple(linha) for linha in bloco]
+    finally:
+        conn.close()
 
-            file.save(caminho)
 
-# -------- SALVAR BANCO --------
-        conn = conectar_db()
-        cursor = conn.cursor()
+def exportar_csv(colunas, blocos):
 
-        cursor.execute("""
-INSERT INTO aih (
-    nome_paciente, prontuario, cns, data_nascimento, sexo,
-    raca_cor, etnia, nome_mae, telefone1, telefone2,
-    responsavel, endereco, municipio, ibge, uf, cep,
+    saida = io.StringIO()
+    escritor = csv.writer(saida)
 
-    sinais, condicoes, provas, diagnostico,
-    cid_principal, cid_secundario, cid_associado,
+    # BOM para o Excel abrir os acentos direito
+    saida.write("\ufeff")
+    escritor.writerow(colunas)
 
-    descricao_procedimento, codigo_procedimento, clinica, carater,
-    doc_prof, numero_doc_prof, nome_prof, data_solicitacao,
+    for bloco in blocos:
+        escritor.writerows(bloco)
+        yield saida.getvalue().encode("utf-8")
+        saida.seek(0)
+        saida.truncate()
 
-    tipo_acidente, cnpj_seguradora, cnpj_empresa, numero_bilhete,
-    cnae, serie, cbor, vinculo_empresa,
+    if saida.tell():
+        yield saida.getvalue().encode("utf-8")
 
-    nome_autorizador, orgao_emissor, doc_autorizador,
-    numero_doc_autorizador, data_autorizacao, numero_autorizacao,
 
-    arquivo_pdf, necessita_apa
-)
-VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-""", (
+def exportar_jsonl(colunas, blocos):
+    for bloco in blocos:
+        yield "".join(
+            json.dumps(dict(zip(colunas, linha)), ensure_ascii=False) + "\n" for linha in bloco
+        ).encode("utf-8")
 
-    request.form.get("nome_paciente"),
-    request.form.get("prontuario"),
-    request.form.get("cns"),
-    request.form.get("data_nascimento"),
-    request.form.get("sexo"),
-
-    request.form.get("raca_cor"),
-    request.form.get("etnia"),
-    request.form.get("nome_mae"),
-    request.form.get("telefone1"),
-    request.form.get("telefone2"),
-
-    request.form.get("responsavel"),
-    request.form.get("endereco"),
-    request.form.get("municipio"),
-    request.form.get("ibge"),
-    request.form.get("uf"),
-    request.form.get("cep"),
 
-    request.form.get("sinais"),
-    request.form.get("condicoes"),
-    request.form.get("provas"),
-    request.form.get("diagnostico"),
+class SaidaEmPartes:
+    """Arquivo só de escrita cujo conteúdo é recolhido aos pedaços (para o ParquetWriter)."""
 
-    request.form.get("cid_principal"),
-    request.form.get("cid_secundario"),
-    request.form.get("cid_associado"),
+    def __init__(self):
+        self._partes = []
+        self._posicao = 0
+        self.closed = False
 
-    request.form.get("descricao_procedimento"),
-    request.form.get("codigo_procedimento"),
-    request.form.get("clinica"),
-    request.form.get("carater"),
+    def write(self, dados):
+        self._partes.append(bytes(dados))
+        self._posicao += len(dados)
+        return len(dados)
 
-    request.form.get("doc_prof"),
-    request.form.get("numero_doc_prof"),
-    request.form.get("nome_prof"),
-    request.form.get("data_solicitacao"),
+    def tell(self):
+        return self._posicao
 
-    request.form.get("tipo_acidente"),
-    request.form.get("cnpj_seguradora"),
-    request.form.get("cnpj_empresa"),
-    request.form.get("numero_bilhete"),
+    def flush(self):
+        pass
 
-    request.form.get("cnae"),
-    request.form.get("serie"),
-    request.form.get("cbor"),
-    request.form.get("vinculo_empresa"),
+    def close(self):
+        self.closed = True
 
-    request.form.get("nome_autorizador"),
-    request.form.get("orgao_emissor"),
-    request.form.get("doc_autorizador"),
-    request.form.get("numero_doc_autorizador"),
-    request.form.get("data_autorizacao"),
-    request.form.get("numero_autorizacao"),
+    def recolher(self):
+        dados = b"".join(self._partes)
+        self._partes.clear()
+        return dados
 
-    arquivo_pdf,
-    necessita_apa
-))
 
+def exportar_parquet(colunas, blocos):
 
-        conn.commit()
+    import pyarrow
+    import pyarrow.parquet
+
+    # tipo declarado em aih_completa: INTEGER (id, paciente_id) vira int64, o resto texto
+    conn = conectar_db()
+    try:
+        inteiras = {
+            linha["name"] for linha in conn.execute("PRAGMA table_info(aih_completa)")
+            if linha["type"].upper().startswith("INTEGER")
+        }
+    finally:
         conn.close()
 
-        flash("AIH salva com sucesso!")
-        return redirect("/lista")
+    esquema = pyarrow.schema([
+        (coluna, pyarrow.int64() if coluna in inteiras else pyarrow.string()) for coluna in colunas
+    ])
 
-    return render_template(
-    "nova_aih.html",
-    hoje=datetime.now().strftime("%Y-%m-%d")
-)
+    saida = SaidaEmPartes()
+    escritor = pyarrow.parquet.ParquetWriter(saida, esquema, compression="zstd")
 
+    pendentes = []
 
-#-------------------ROTA AIH----------------
+    def gravar_grupo():
+        escritor.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(valores, type=campo.type) for valores, campo in zip(zip(*pendentes), esquema)],
+            schema=esquema,
+        ))
+        pendentes.clear()
 
-@app.route("/aih")
-@login_required
-def listar_aih_completa():
+    for bloco in blocos:
+        pendentes.extend(bloco)
+        if len(pendentes) >= LINHAS_POR_GRUPO_PARQUET:
+            gravar_grupo()
+            yield saida.recolher()
 
-    conn = conectar_db()
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    if pendentes:
+        gravar_grupo()
 
-    cursor.execute("SELECT * FROM aih ORDER BY id DESC")
-    lista = cursor.fetchall()
+    escritor.close()
+    yield saida.recolher()
 
-    conn.close()
 
-    return render_template("aih_lista.html", lista=lista)
+def exportar_aihs(formato, colunas, status=None, data_inicio=None, data_fim=None):
+    """Bytes do arquivo exportado, gerados aos blocos."""
 
+    blocos = ler_aihs_exportacao(colunas, status, data_inicio, data_fim)
+    gerador = {"csv": exportar_csv, "jsonl": exportar_jsonl, "parquet": exportar_parquet}[formato]
+    return gerador(colunas, blocos)
 
 
+def validar_exportacao(conn, formato, colunas):
 
-# ---------------- UPLOAD PDF ----------------
+    if formato not in FORMATOS_EXPORTACAO:
+        raise ValueError("Formato deve ser csv, jsonl ou parquet")
 
-@app.route("/", methods=["GET", "POST"])
+    if formato == "parquet" and not parquet_disponivel():
+        raise ValueError("Exportação Parquet requer o pacote pyarrow")
+
+    pedidas = [coluna.strip() for coluna in (colunas or "").split(",") if coluna.strip()]
+    return colunas_exportacao(conn, pedidas)
+
+
+@app.route("/exportar")
 @login_required
-def upload_aih():
+def exportar():
 
-    if request.method == "POST":
+    formato = request.args.get("formato", "csv")
+    status = request.args.get("status") or None
+    data_inicio = request.args.get("data_inicio") or None
+    data_fim = request.args.get("data_fim") or None
 
-        file = request.files.get("file")
-        apa = request.form.get("apa")
+    try:
+        colunas = validar_exportacao(obter_db(), formato, request.args.get("colunas"))
+    except ValueError as exc:
+        return jsonify({"erro": str(exc)}), 400
 
-        if not file or file.filename == "":
-            flash("Selecione um arquivo")
-            return redirect(request.url)
+    auditar(
+        "exportacao", formato=formato, colunas=len(colunas),
+        status=status, data_inicio=data_inicio, data_fim=data_fim,
+    )
 
-        if not allowed_file(file.filename):
-            flash("Apenas PDF permitido")
-            return redirect(request.url)
+    tipo, extensao = FORMATOS_EXPORTACAO[formato]
+    nome = f"aih_exportacao_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extensao}"
 
-        if apa not in ["SIM", "NAO"]:
-            flash("Informe se necessita de APA")
-            return redirect(request.url)
+    return Response(
+        exportar_aihs(formato, colunas, status, data_inicio, data_fim),
+        mimetype=tipo,
+        headers={"Content-Disposition": f"attachment; filename={nome}"},
+    )
 
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        nome_arquivo = f"aih_{timestamp}_APA_{apa}.pdf"
+@app.cli.command("exportar-aihs")
+@click.option("--formato", type=click.Choice(list(FORMATOS_EXPORTACAO)), default="csv")
+@click.option("--colunas", default="", help="Colunas separadas por vírgula (padrão: todas).")
+@click.option("--status", default=None)
+@click.option("--data-inicio", default=None, help="AAAA-MM-DD")
+@click.option("--data-fim", default=None, help="AAAA-MM-DD")
+@click.option("--saida", required=True, type=click.Path(dir_okay=False))
+def exportar_aihs_cli(formato, colunas, status, data_inicio, data_fim, saida):
+    """Exporta AIHs para CSV, JSON lines ou Parquet."""
 
-        caminho = os.path.join(UPLOAD_FOLDER, nome_arquivo)
-        file.save(caminho)
+    conn = conectar_db()
+    try:
+        colunas = validar_exportacao(conn, formato, colunas)
+    except ValueError as exc:
+        raise click.UsageError(str(exc))
+    finally:
+        conn.close()
 
-        flash("AIH enviada com sucesso")
+    inicio = time.perf_counter()
+    total = 0
 
-    return render_template("upload.html")
+    with open(saida, "wb") as arquivo:
+        for parte in exportar_aihs(formato, colunas, status, data_inicio, data_fim):
+            arquivo.write(parte)
+            total += len(parte)
 
+    click.echo(f"{saida}: {total} bytes em {time.perf_counter() - inicio:.2f}s")
 
-# ---------------- LISTAGEM ----------------
 
-@app.route("/lista")
+# ---------------- SERVIR PDF ----------------
+
+@app.route("/uploads/<filename>")
 @login_required
-def listar_aih():
+def ver_pdf(filename):
 
-    conn = conectar_db()
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    caminho = armazenamento_pdf.localizar(obter_db(), filename)
 
-    cursor.execute("""
-        SELECT * FROM aih
-        ORDER BY id DESC
-    """)
+    # arquivos anteriores ao registro em arquivos_pdf continuam soltos na raiz
+    return send_from_directory(UPLOAD_FOLDER, caminho or filename)
 
-    dados = cursor.fetchall()
-    conn.close()
 
-    lista = []
+@app.route("/extracao/<arquivo>")
+@login_required
+def status_extracao(arquivo):
 
-    for item in dados:
+    conn = obter_db()
+    item = conn.execute("""
+        SELECT arquivo, status, tentativas, erro, paginas, criado_em, concluido_em
+        FROM arquivos_pdf WHERE arquivo = ?
+    """, (arquivo,)).fetchone()
 
-        # -------- APA --------
-        apa = "Sim" if item["necessita_apa"] == "SIM" else "Não"
+    if item is None:
+        return jsonify({"erro": "Arquivo não encontrado na fila"}), 404
 
-        # -------- STATUS --------
-        status = item["status"] or "Pendente"
+    return jsonify(dict(item))
 
-        # -------- DATA BASE (BANCO AGORA) --------
-        if item["data_solicitacao"]:
-                data_hora = datetime.strptime(
-                    item["data_solicitacao"],
-                    "%Y-%m-%d"
-                        ).strftime("%d/%m/%Y")
-        else:
-                data_hora = "-"
 
-        # -------- DIAS NO SISTEMA --------
-        dias_sistema = "-"
+@app.cli.command("processar-extracoes")
+def processar_extracoes_cli():
+    """Esvazia a fila de extração de texto dos PDFs enviados."""
 
-        if item["data_solicitacao"]:
+    recuperar_extracoes_travadas()
 
-            try:
-                data_envio = datetime.strptime(
-                    item["data_solicitacao"],
-                    "%Y-%m-%d"
-                )
+    total = 0
+    while processar_proxima_extracao(em_processo=False):
+        total += 1
 
-                dias = (datetime.now() - data_envio).days
+    click.echo(f"{total} PDF(s) processado(s)")
 
-                if status == "Pendente":
-                    dias_sistema = f"{dias} dia(s)"
-                else:
-                    dias_sistema = "✔ Finalizada"
 
-            except ValueError:
-                data_hora = "-"
+def sha256_arquivo(caminho):
 
-        lista.append({
-            "arquivo": item["arquivo_pdf"],
-            "paciente": item["nome_paciente"],
-            "id": item["id"],
-            "apa": apa,
-            "status": status,
-            "data_hora": data_hora,
-            "dias": dias_sistema
-        })
+    resumo = hashlib.sha256()
+    with open(caminho, "rb") as arquivo:
+        for bloco in iter(lambda: arquivo.read(1024 * 1024), b""):
+            resumo.update(bloco)
 
-    return render_template("lista.html", lista=lista)
+    return resumo.hexdigest()
 
 
-#----------------LISTA CADASTROS----------------
+@app.cli.command("organizar-uploads")
+def organizar_uploads_cli():
+    """Move os PDFs soltos na raiz de uploads/ para as pastas e os registra em arquivos_pdf.
 
-@app.route("/listar_cadastros")
-@login_required
-def listar_cadastros():
+    As impressões antigas (aih_impressa_*.pdf) ficam onde estão.
+    """
+
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
     conn = conectar_db()
-    cursor = conn.cursor()
+    movidos = 0
 
-    cursor.execute("SELECT id, nome_paciente, prontuario FROM aih ORDER BY id DESC")
-    dados = cursor.fetchall()
+    for nome in sorted(os.listdir(UPLOAD_FOLDER)):
+
+        origem = os.path.join(UPLOAD_FOLDER, nome)
+
+        if not os.path.isfile(origem) or not allowed_file(nome) or nome.startswith("aih_impressa_"):
+            continue
+
+        sha256 = sha256_arquivo(origem)
+        caminho = armazenamento_pdf.relativo(nome, sha256, datetime.fromtimestamp(os.path.getmtime(origem)))
+
+        try:
+            conn.execute("""
+                INSERT INTO arquivos_pdf (arquivo, criado_em, sha256, tamanho, caminho, necessita_apa)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (arquivo) DO UPDATE SET
+                    sha256 = excluded.sha256, tamanho = excluded.tamanho, caminho = excluded.caminho,
+                    necessita_apa = COALESCE(arquivos_pdf.necessita_apa, excluded.necessita_apa)
+            """, (
+                nome, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), sha256, os.path.getsize(origem), caminho,
+                apa_do_nome(nome),
+            ))
+
+            destino = armazenamento_pdf.absoluto(caminho)
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            os.replace(origem, destino)
+
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            click.echo(f"{nome}: mesmo conteúdo de um arquivo já registrado, mantido na raiz")
+            continue
+
+        except OSError:
+            conn.rollback()
+            raise
+
+        conn.commit()
+        movidos += 1
 
     conn.close()
+    click.echo(f"{movidos} arquivo(s) organizado(s)")
 
-    return render_template("listar_cadastros.html", dados=dados)
 
-#-----------------VER DETALHES DA AIH-----------------
+# ---------------- IMPRIMIR PDF ----------------
 
-@app.route("/ver_aih/<int:id>")
+@app.route("/imprimir/<int:id>")
 @login_required
-def ver_aih(id):
+def imprimir_aih(id):
 
-    conn = conectar_db()
-    conn.row_factory = sqlite3.Row
+    conn = obter_db()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM aih WHERE id = ?", (id,))
-    dados = cursor.fetchone()
+    projecao = projecao_aih("impressao")
+    cursor.execute(f"SELECT {projecao} FROM aih_completa AS aih WHERE id = ?", (id,))
+    dados = ler_aih(cursor)
 
-    conn.close()
 
-    return render_template("ver_aih.html", dados=dados)
+    if not dados:
+        return "AIH não encontrada"
 
+    chave = chave_impressao(dados.para_dict())
 
+    em_cache = cache_impressao.obter(id, chave)
 
-# ---------------- ACEITAR ----------------
+    if em_cache:
+        server_timing = "cache;desc=hit"
+    else:
+        pdf, tempos = gerar_pdf_aih(dados)
+        app.logger.debug("AIH %s impressa: %s", id, tempos)
 
-@app.route("/aceitar/<int:id>", methods=["POST"])
-@login_required
-def aceitar_aih(id):
+        em_cache = cache_impressao.guardar(id, chave, pdf.getvalue())
+        server_timing = ", ".join(
+            f"{etapa};dur={duracao:.2f}" for etapa, duracao in tempos.items()
+        )
 
-    if session.get("perfil") != "SECRETARIA":
-        return redirect(url_for("listar_aih"))
+    caminho, info = em_cache
+    auditar("impressao", id, cache=server_timing == "cache;desc=hit")
 
-    conn = conectar_db()
-    cursor = conn.cursor()
+    resposta = send_file(
+        os.path.abspath(caminho),
+        mimetype="application/pdf",
+        download_name=f"aih_impressa_{id}.pdf",
+        etag=chave,
+        last_modified=info.st_mtime,
+    )
+    resposta.cache_control.private = True
+    resposta.cache_control.no_cache = True
+    resposta.headers["Server-Timing"] = server_timing
+    return resposta
 
-    cursor.execute("""
-        UPDATE aih
-        SET status = 'Aceita',
-            usuario_aprovacao = ?,
-            data_aprovacao = ?
-        WHERE id = ?
-    """, (
-        session.get("usuario"),
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        id
-    ))
+# ---------------- IMPRIMIR LOTE ----------------
 
-    conn.commit()
-    conn.close()
+def ler_ids(valores):
+    ids = []
 
-    return redirect(url_for("listar_aih"))
+    for valor in valores:
+        for parte in valor.split(","):
+            parte = parte.strip()
+            if parte.isdigit():
+                ids.append(int(parte))
 
+    return list(dict.fromkeys(ids))
 
-# ---------------- REPROVAR ----------------
 
-@app.route("/reprovar/<int:id>", methods=["POST"])
+@app.route("/imprimir_lote", methods=["GET", "POST"])
 @login_required
-def reprovar_aih(id):
+def imprimir_lote():
 
-    if session.get("perfil") != "SECRETARIA":
-        return redirect(url_for("listar_aih"))
+    parametros = request.values
+    ids = ler_ids(parametros.getlist("ids"))
+    status = parametros.get("status") or None
+    data_inicio = parametros.get("data_inicio") or None
+    data_fim = parametros.get("data_fim") or None
 
-    conn = conectar_db()
-    cursor = conn.cursor()
+    if not ids:
 
-    cursor.execute("""
-        UPDATE aih
-        SET status = 'Reprovada',
-            usuario_reprovacao = ?,
-            data_reprovacao = ?
-        WHERE id = ?
-    """, (
-        session.get("usuario"),
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        id
-    ))
+        if not (status or data_inicio or data_fim):
+            return "Informe os ids ou um filtro (status, data_inicio, data_fim)", 400
 
-    conn.commit()
-    conn.close()
+        ids = selecionar_ids_lote(obter_db(), status, data_inicio, data_fim)
 
-    return redirect(url_for("listar_aih"))
+    if not ids:
+        return "Nenhuma AIH encontrada", 404
 
+    nome = f"aih_lote_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+    auditar("impressao_lote", quantidade=len(ids), ids=ids[:1000])
 
-# ---------------- SERVIR PDF ----------------
+    return Response(
+        gerar_lote_pdf(ids),
+        mimetype="application/pdf",
+        headers={"Content-Disposition": f"inline; filename={nome}"},
+    )
 
-@app.route("/uploads/<filename>")
-@login_required
-def ver_pdf(filename):
-    return send_from_directory(UPLOAD_FOLDER, filename)
 
+@app.cli.command("imprimir-lote")
+@click.option("--ids", default="", help="Ids separados por vírgula.")
+@click.option("--status", default=None)
+@click.option("--data-inicio", default=None, help="AAAA-MM-DD")
+@click.option("--data-fim", default=None, help="AAAA-MM-DD")
+@click.option("--processos", type=int, default=None, help="Processos para desenhar as camadas.")
+@click.option("--saida", required=True, type=click.Path(dir_okay=False))
+def imprimir_lote_cli(ids, status, data_inicio, data_fim, processos, saida):
+    """Gera um PDF único com várias AIHs."""
 
-# ---------------- IMPRIMIR PDF ----------------
+    lista_ids = ler_ids([ids])
 
-@app.route("/imprimir/<int:id>")
-@login_required
-def imprimir_aih(id):
+    if not lista_ids:
+        conn = conectar_db()
+        lista_ids = selecionar_ids_lote(conn, status, data_inicio, data_fim)
+        conn.close()
 
-    conn = conectar_db()
-    cursor = conn.cursor()
+    inicio = time.perf_counter()
 
-    cursor.execute("SELECT * FROM aih WHERE id = ?", (id,))
-    dados = cursor.fetchone()
+    with open(saida, "wb") as f:
+        for pedaco in gerar_lote_pdf(lista_ids, processos=processos):
+            f.write(pedaco)
 
-    conn.close()
+    duracao = time.perf_counter() - inicio
+    click.echo(f"{len(lista_ids)} AIH(s) em {saida} ({duracao:.1f}s)")
 
-    if not dados:
-        return "AIH não encontrada"
 
-    dados_dict = dict(dados)
+# ---------------- MIGRAÇÕES (CLI) ----------------
+
+@app.cli.command("migrar")
+@click.option("--simular", "--dry-run", "simular", is_flag=True,
+              help="Roda cada migração pendente (em lotes: só o primeiro) e desfaz, mostrando tempos.")
+@click.option("--status", "status", is_flag=True, help="Lista as migrações e o que foi registrado de cada uma.")
+@click.option("--tamanho-lote", type=int, default=None, help=f"Padrão: {TAMANHO_LOTE_MIGRACAO}")
+@click.option("--pausa-ms", type=int, default=None, help=f"Padrão: {int(PAUSA_LOTE_MIGRACAO * 1000)}")
+def migrar_cli(simular, status, tamanho_lote, pausa_ms):
+    """Aplica as migrações pendentes do banco, com progresso e tempos."""
+
+    conn = abrir_conexao()
+    versao_atual = versao_banco(conn)
+
+    if status:
+        registros = {}
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'migracoes'").fetchone():
+            registros = {linha["versao"]: linha for linha in conn.execute("SELECT * FROM migracoes")}
+
+        click.echo(f"versão do banco: {versao_atual} (código: {VERSAO_ESQUEMA})")
+        for versao, descricao, migracao in MIGRACOES:
+            registro = registros.get(versao)
+            tipo = "em lotes" if isinstance(migracao, MigracaoEmLotes) else "simples"
+
+            if registro and registro["concluida_em"]:
+                situacao = f"aplicada em {registro['concluida_em']} ({registro['duracao_ms']:.0f} ms, {registro['linhas']} linha(s))"
+            elif registro:
+                situacao = f"em andamento desde {registro['iniciada_em']} ({registro['linhas']} linha(s))"
+            elif versao <= versao_atual:
+                situacao = "aplicada (sem registro)"
+            else:
+                situacao = "pendente"
+
+            click.echo(f"  {versao:>3} {descricao} [{tipo}]: {situacao}")
+
+        conn.close()
+        return
+
+    pendentes = migracoes_pendentes(conn)
+
+    if not pendentes:
+        click.echo(f"Banco em dia (versão {versao_atual})")
+        conn.close()
+        return
+
+    if simular:
+        for versao, descricao, migracao in pendentes:
+            resultado = simular_migracao(conn, migracao, tamanho_lote)
+            linhas = f", {resultado['linhas']} linha(s)" if resultado["linhas"] is not None else ""
+            click.echo(
+                f"  {versao:>3} {descricao}: {resultado['ms']:.0f} ms no ensaio, "
+                f"~{resultado['estimado_ms'] / 1000:.1f} s estimado(s){linhas}"
+            )
+            # As próximas dependem desta, que foi desfeita
+            if len(pendentes) > 1:
+                click.echo("      (as seguintes dependem desta e não foram ensaiadas)")
+                break
 
-    saida = f"uploads/aih_impressa_{id}.pdf"
+        conn.close()
+        return
+
+    conn.close()
+
+    def avisar(versao, linhas, total, ms_lote):
+        percentual = f" {linhas * 100 / total:5.1f}%" if total else ""
+        click.echo(f"  {versao:>3}{percentual} {linhas} linha(s), último lote em {ms_lote:.0f} ms")
+
+    for versao, descricao, migracao in pendentes:
+        click.echo(f"Aplicando {versao} ({descricao})...")
+        conn = abrir_conexao()
+        try:
+            resultado = aplicar_migracao(conn, versao, descricao, migracao, avisar, tamanho_lote,
+                                         None if pausa_ms is None else pausa_ms / 1000)
+        finally:
+            conn.close()
+
+        if resultado:
+            click.echo(f"  {versao:>3} concluída em {resultado['ms']:.0f} ms ({resultado['linhas']} linha(s), {resultado['lotes']} lote(s))")
+        else:
+            click.echo(f"  {versao:>3} já aplicada por outro processo")
 
-    gerar_pdf_aih(dados_dict, saida)
+    esquema_pronto.set()
 
-    return send_from_directory("uploads", f"aih_impressa_{id}.pdf")
 
 # ---------------- START ----------------
 
 if __name__ == "__main__":
-    garantir_colunas_status()
+    multiprocessing.freeze_support()
+    migrar_banco()
     app.run(host="0.0.0.0", port=5000)
 
 
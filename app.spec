@@ -5,7 +5,7 @@ a = Analysis(
     ['app.py'],
     pathex=[],
     binaries=[],
-    datas=[('templates', 'templates'), ('uploads', 'uploads')],
+    datas=[('templates', 'templates'), ('uploads', 'uploads'), ('layouts', 'layouts'), ('referencias', 'referencias')],
     hiddenimports=[],
     hookspath=[],
     hooksconfig={},
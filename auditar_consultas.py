@@ -0,0 +1,210 @@
+"""Auditoria do plano de execução das consultas SQL de app.py.
+
+Extrai do código-fonte todo SELECT/INSERT/UPDATE/DELETE, roda EXPLAIN QUERY
+PLAN num banco temporário com o schema e os índices da aplicação e falha
+(código de saída 1) se alguma consulta varre a tabela aih (ou paciente)
+inteira.
+
+Uso:
+    python auditar_consultas.py [-v]
+
+Regras:
+  * "SCAN aih" e "SCAN paciente" só são aceitos com LIMIT e sem ordenação
+    em B-tree temporária completa (a varredura para depois da página pedida);
+  * consultas marcadas com o comentário "-- auditoria: varredura intencional"
+    são listadas, mas não reprovam;
+  * f-strings são auditadas em todas as combinações de variantes(); nomes
+    que são constantes str de app.py entram com o próprio valor, e
+    fragmentos sem valor conhecido são reportados como não auditados.
+"""
+
+import ast
+import itertools
+import os
+import re
+import sys
+import tempfile
+
+MARCADOR_INTENCIONAL = "auditoria: varredura intencional"
+
+RE_SQL = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\s", re.IGNORECASE)
+RE_LITERAIS = re.compile(r"'(?:[^']|'')*'|--[^\n]*")
+RE_NOMEADOS = re.compile(r"[:@$]([A-Za-z_]\w*)")
+RE_SCAN_AIH = re.compile(r"\bSCAN (aih|paciente)\b")
+
+
+def variantes(app):
+    """Valores possíveis de cada fragmento interpolado em f-strings de SQL."""
+
+    ordens = ["id DESC"]
+    for expressao in dict.fromkeys(app.COLUNAS_ORDENACAO_LISTA.values()):
+        for direcao in ("ASC", "DESC"):
+            ordens.append(f"{expressao} {direcao}, id DESC")
+
+    return {
+        "filtro_sql": ["", app.FILTRO_BUSCA_LISTA, app.FILTRO_BUSCA_LISTA_TRANSICAO],
+        "filtro_busca": [app.FILTRO_BUSCA_LISTA, app.FILTRO_BUSCA_LISTA_TRANSICAO],
+        "ordem_sql": ordens,
+        "coluna_usuario": [usuario for _, usuario, _, _ in app.AVALIACOES.values()],
+        "coluna_data": [data for _, _, data, _ in app.AVALIACOES.values()],
+        "coluna": ["clinica", "carater"],
+        "colunas_sql": ["id, nome_paciente"],
+        "projecao": [app.projecao_aih(nome) for nome in app.PROJECOES_AIH],
+        "filtro_exportacao": [
+            "",
+            "WHERE status = ?",
+            "WHERE status = ? AND data_solicitacao >= ? AND data_solicitacao <= ?",
+            "WHERE data_solicitacao >= ?",
+        ],
+        "condicoes_sql": [
+            "",
+            "WHERE aih_id = ?",
+            "WHERE usuario = ? AND momento >= ?",
+            "WHERE momento >= ? AND momento <= ?",
+        ],
+    }
+
+
+def extrair_consultas(caminho):
+    """Gera (linha, função, partes) para cada literal SQL do arquivo.
+
+    partes é uma lista de strings e nomes de variáveis (ast.Name), na ordem
+    em que aparecem na f-string.
+    """
+
+    arvore = ast.parse(open(caminho, encoding="utf-8").read())
+
+    funcoes = {}
+    partes_de_fstring = set()
+
+    for no in ast.walk(arvore):
+        if isinstance(no, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            for filho in ast.walk(no):
+                funcoes.setdefault(id(filho), no.name)
+        elif isinstance(no, ast.JoinedStr):
+            partes_de_fstring.update(id(valor) for valor in no.values)
+
+    for no in ast.walk(arvore):
+
+        if id(no) in partes_de_fstring:
+            continue
+
+        if isinstance(no, ast.Constant) and isinstance(no.value, str):
+            partes = [no.value]
+        elif isinstance(no, ast.JoinedStr):
+            partes = []
+            for valor in no.values:
+                if isinstance(valor, ast.Constant):
+                    partes.append(valor.value)
+                elif isinstance(valor.value, ast.Name):
+                    partes.append(valor.value)
+                else:
+                    partes.append(None)
+        else:
+            continue
+
+        if not partes or not isinstance(partes[0], str) or not RE_SQL.match(partes[0]):
+            continue
+
+        yield no.lineno, funcoes.get(id(no), "<módulo>"), partes
+
+
+def montar(partes, tabela_variantes, app):
+    """Expande as partes em todas as combinações conhecidas de SQL."""
+
+    opcoes = []
+    for parte in partes:
+        if isinstance(parte, str):
+            opcoes.append([parte])
+        elif isinstance(parte, ast.Name) and parte.id in tabela_variantes:
+            opcoes.append(tabela_variantes[parte.id])
+        elif isinstance(parte, ast.Name) and isinstance(getattr(app, parte.id, None), str):
+            opcoes.append([getattr(app, parte.id)])
+        else:
+            return None
+
+    return ["".join(combinacao) for combinacao in itertools.product(*opcoes)]
+
+
+def parametros(sql):
+    """Valores fictícios para os placeholders (prefixo, para o LIKE usar índice)."""
+
+    sem_literais = RE_LITERAIS.sub("", sql)
+    nomeados = RE_NOMEADOS.findall(sem_literais)
+
+    if nomeados:
+        return {nome: "a%" for nome in nomeados}
+
+    return ["a%"] * sem_literais.count("?")
+
+
+def avaliar(plano, sql):
+    """Retorna o motivo da reprovação, ou None se o plano é aceitável."""
+
+    detalhes = [linha[3] for linha in plano]
+
+    if not any(RE_SCAN_AIH.search(detalhe) for detalhe in detalhes):
+        return None
+
+    ordena_tudo = any("USE TEMP B-TREE FOR ORDER BY" in detalhe for detalhe in detalhes)
+    limitada = re.search(r"\bLIMIT\b", RE_LITERAIS.sub("", sql), re.IGNORECASE)
+
+    if limitada and not ordena_tudo:
+        return None
+
+    return "varredura completa de aih ou paciente"
+
+
+def main(argv):
+
+    verboso = "-v" in argv
+
+    with tempfile.TemporaryDirectory() as pasta:
+
+        os.environ["AIH_DB"] = os.path.join(pasta, "auditoria.db")
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+        import app
+
+        tabela_variantes = variantes(app)
+        conn = app.conectar_db()
+
+        falhas = 0
+        auditadas = 0
+
+        for linha, funcao, partes in extrair_consultas(app.__file__):
+
+            consultas = montar(partes, tabela_variantes, app)
+
+            if consultas is None:
+                print(f"[NÃO AUDITADA] app.py:{linha} ({funcao}): fragmento dinâmico sem variante")
+                continue
+
+            for sql in consultas:
+
+                auditadas += 1
+                plano = conn.execute("EXPLAIN QUERY PLAN " + sql, parametros(sql)).fetchall()
+                motivo = avaliar(plano, sql)
+                resumo = " ".join(sql.split())
+
+                if motivo and MARCADOR_INTENCIONAL in sql:
+                    print(f"[INTENCIONAL] app.py:{linha} ({funcao}): {resumo}")
+                elif motivo:
+                    falhas += 1
+                    print(f"[FALHA] app.py:{linha} ({funcao}): {motivo}")
+                    print(f"    {resumo}")
+                    for detalhe in plano:
+                        print(f"    -> {detalhe[3]}")
+                elif verboso:
+                    print(f"[OK] app.py:{linha} ({funcao}): {resumo}")
+                    for detalhe in plano:
+                        print(f"    -> {detalhe[3]}")
+
+        conn.close()
+
+    print(f"{auditadas} consulta(s) auditada(s), {falhas} falha(s)")
+    return 1 if falhas else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,460 @@
+"""Gerador de carga e benchmark das rotas principais do app.
+
+Popula um banco com N AIHs sintéticas (pacientes repetidos, CNS válidos,
+datas e justificativas de tamanho realista) e dispara login, /lista/dados,
+/ver_aih, /imprimir e /nova_aih com C clientes em paralelo, pelo test client
+do Flask ou por um servidor WSGI local. Informa vazão e latência p50/p95/p99
+por rota e grava o resultado em JSON para comparar versões.
+
+Uso:
+    python benchmark_carga.py [--linhas 10000] [--requisicoes 2000] [--concorrencia 4]
+                              [--modo teste|servidor] [--db caminho] [--json resultado.json]
+                              [--comparar anterior.json]
+
+Sem --db o banco é temporário; com --db as AIHs sintéticas são acrescentadas
+ao arquivo indicado (use uma cópia, nunca o aih.db de produção).
+"""
+
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+NOMES = (
+    "Maria", "José", "Ana", "João", "Antônio", "Francisca", "Carlos", "Paulo", "Adriana",
+    "Lucas", "Juliana", "Marcos", "Luiz", "Aline", "Pedro", "Sandra", "Rafael", "Camila",
+)
+SOBRENOMES = (
+    "Silva", "Santos", "Oliveira", "Souza", "Rodrigues", "Ferreira", "Alves", "Pereira",
+    "Lima", "Gomes", "Costa", "Ribeiro", "Martins", "Carvalho", "Almeida", "Lopes",
+)
+MUNICIPIOS = (
+    ("São Paulo", "3550308", "SP"), ("Campinas", "3509502", "SP"),
+    ("Belo Horizonte", "3106200", "MG"), ("Curitiba", "4106902", "PR"),
+    ("Salvador", "2927408", "BA"), ("Recife", "2611606", "PE"),
+)
+PROCEDIMENTOS = (
+    ("0407020039", "APENDICECTOMIA", "K358"),
+    ("0407030026", "COLECISTECTOMIA", "K802"),
+    ("0411010034", "PARTO CESARIANO", "O820"),
+    ("0408050896", "TRATAMENTO CIRURGICO DE FRATURA DO FEMUR", "S720"),
+    ("0303140151", "TRATAMENTO DE PNEUMONIAS OU INFLUENZA", "J189"),
+)
+PALAVRAS = (
+    "paciente refere dor abdominal intensa há três dias com piora progressiva febre "
+    "vômitos náuseas inapetência ao exame defesa localizada sinais de irritação "
+    "peritoneal leucocitose com desvio ultrassonografia compatível hemodinamicamente "
+    "estável indicado tratamento cirúrgico em caráter de urgência sem comorbidades"
+).split()
+
+# (rota, peso no sorteio das requisições)
+ROTAS = {
+    "login": 1,
+    "lista": 40,
+    "ver_aih": 30,
+    "imprimir": 15,
+    "nova_aih": 14,
+}
+
+
+# ---------------- DADOS SINTÉTICOS ----------------
+
+def gerar_cns(aleatorio):
+    """CNS definitivo (começa com 1 ou 2) com dígito verificador válido."""
+
+    pis = str(aleatorio.randint(1, 2)) + "".join(str(aleatorio.randint(0, 9)) for _ in range(10))
+    soma = sum(int(digito) * (15 - posicao) for posicao, digito in enumerate(pis))
+    dv = 11 - soma % 11
+
+    if dv == 11:
+        dv = 0
+
+    if dv == 10:
+        soma += 2
+        dv = 11 - soma % 11
+        return f"{pis}001{dv}"
+
+    return f"{pis}000{dv}"
+
+
+def texto(aleatorio, minimo, maximo):
+    return " ".join(aleatorio.choice(PALAVRAS) for _ in range(aleatorio.randint(minimo, maximo)))
+
+
+def gerar_paciente(aleatorio):
+
+    municipio, ibge, uf = aleatorio.choice(MUNICIPIOS)
+    nascimento = date(1940, 1, 1) + timedelta(days=aleatorio.randint(0, 30000))
+
+    return {
+        "nome_paciente": f"{aleatorio.choice(NOMES)} {aleatorio.choice(SOBRENOMES)} {aleatorio.choice(SOBRENOMES)}",
+        "prontuario": str(aleatorio.randint(100000, 999999)),
+        "cns": gerar_cns(aleatorio),
+        "data_nascimento": nascimento.isoformat(),
+        "sexo": aleatorio.choice("MF"),
+        "raca_cor": aleatorio.choice(["01", "02", "03", "04"]),
+        "nome_mae": f"{aleatorio.choice(NOMES[1::2])} {aleatorio.choice(SOBRENOMES)}",
+        "telefone1": f"(11) 9{aleatorio.randint(1000, 9999)}-{aleatorio.randint(1000, 9999)}",
+        "endereco": f"Rua {aleatorio.choice(SOBRENOMES)}, {aleatorio.randint(1, 2000)}",
+        "municipio": municipio,
+        "ibge": ibge,
+        "uf": uf,
+        "cep": f"{aleatorio.randint(1000000, 99999999):08d}",
+    }
+
+
+def gerar_aih(aleatorio, paciente, hoje):
+
+    codigo, descricao, cid = aleatorio.choice(PROCEDIMENTOS)
+
+    registro = dict(paciente)
+    registro.update({
+        "sinais": texto(aleatorio, 60, 180),
+        "condicoes": texto(aleatorio, 40, 120),
+        "provas": texto(aleatorio, 30, 100),
+        "diagnostico": texto(aleatorio, 5, 20),
+        "cid_principal": cid,
+        "descricao_procedimento": descricao,
+        "codigo_procedimento": codigo,
+        "clinica": aleatorio.choice(["Cirúrgica", "Clínica", "Obstétrica"]),
+        "carater": aleatorio.choice(["Eletivo", "Urgência"]),
+        "doc_prof": "CNS",
+        "numero_doc_prof": gerar_cns(aleatorio),
+        "nome_prof": f"Dr. {aleatorio.choice(NOMES)} {aleatorio.choice(SOBRENOMES)}",
+        "data_solicitacao": (hoje - timedelta(days=aleatorio.randint(0, 365))).isoformat(),
+        "necessita_apa": aleatorio.choice(["SIM", "NAO"]),
+    })
+
+    return registro
+
+
+def popular(app, linhas, pacientes, semente):
+    """Acrescenta `linhas` AIHs de `pacientes` pacientes distintos; devolve os ids."""
+
+    aleatorio = random.Random(semente)
+    hoje = date.today()
+    cadastro = [gerar_paciente(aleatorio) for _ in range(max(1, pacientes))]
+
+    conn = app.conectar_db()
+    colunas = app.colunas_importacao(conn)
+
+    for inicio in range(0, linhas, app.TAMANHO_LOTE_IMPORTACAO):
+        lote = []
+        for _ in range(min(app.TAMANHO_LOTE_IMPORTACAO, linhas - inicio)):
+            registro = gerar_aih(aleatorio, aleatorio.choice(cadastro), hoje)
+            registro["status"] = aleatorio.choice(["Pendente", "Pendente", "Aceita", "Reprovada"])
+            lote.append(tuple(registro.get(coluna) for coluna in colunas))
+
+        app.inserir_em_lote(conn, colunas, lote)
+        conn.commit()
+
+    conn.execute("ANALYZE")
+    ids = [linha[0] for linha in conn.execute("SELECT id FROM aih")]
+    conn.close()
+
+    return ids, cadastro
+
+
+# ---------------- CLIENTES ----------------
+
+class ClienteTeste:
+    """Requisições pelo test client do Flask (sem rede)."""
+
+    def __init__(self, app):
+        self.cliente = app.app.test_client()
+
+    def get(self, url):
+        resposta = self.cliente.get(url)
+        resposta.close()
+        return resposta.status_code
+
+    def post(self, url, dados):
+        resposta = self.cliente.post(url, data=dados)
+        resposta.close()
+        return resposta.status_code
+
+
+class SemRedirecionar(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class ClienteHttp:
+    """Requisições HTTP de verdade contra o servidor local, com cookies próprios."""
+
+    def __init__(self, base):
+        self.base = base
+        self.abridor = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            SemRedirecionar(),
+        )
+
+    def abrir(self, url, corpo=None):
+        try:
+            with self.abridor.open(self.base + url, corpo) as resposta:
+                resposta.read()
+                return resposta.status
+        except urllib.error.HTTPError as erro:
+            erro.read()
+            return erro.code
+
+    def get(self, url):
+        return self.abrir(url)
+
+    def post(self, url, dados):
+        return self.abrir(url, urllib.parse.urlencode(dados).encode())
+
+
+def iniciar_servidor(app):
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class SemLogDeAcesso(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    servidor = make_server("127.0.0.1", 0, app.app, threaded=True, request_handler=SemLogDeAcesso)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+
+    return servidor, f"http://127.0.0.1:{servidor.server_port}"
+
+
+# ---------------- CARGA ----------------
+
+def planejar(requisicoes, ids, cadastro, semente):
+    """Sequência fixa (pela semente) de (rota, método, url, dados)."""
+
+    aleatorio = random.Random(semente + 1)
+    hoje = date.today()
+    nomes, pesos = zip(*ROTAS.items())
+    plano = []
+
+    for rota in aleatorio.choices(nomes, pesos, k=requisicoes):
+
+        if rota == "login":
+            plano.append((rota, "POST", "/login", None))
+        elif rota == "lista":
+            inicio = aleatorio.randrange(0, max(1, len(ids) - 25))
+            plano.append((rota, "GET", f"/lista/dados?draw=1&start={inicio}&length=25", None))
+        elif rota == "ver_aih":
+            plano.append((rota, "GET", f"/ver_aih/{aleatorio.choice(ids)}", None))
+        elif rota == "imprimir":
+            plano.append((rota, "GET", f"/imprimir/{aleatorio.choice(ids)}", None))
+        else:
+            dados = gerar_aih(aleatorio, aleatorio.choice(cadastro), hoje)
+            dados["apa"] = dados.pop("necessita_apa")
+            plano.append((rota, "POST", "/nova_aih", dados))
+
+    return plano
+
+
+def percentil(valores, p):
+    """Percentil por posição mais próxima sobre valores já ordenados."""
+
+    if not valores:
+        return None
+
+    return valores[max(0, math.ceil(p / 100 * len(valores)) - 1)]
+
+
+def executar(criar_cliente, plano, concorrencia, credenciais):
+
+    tempos = {rota: [] for rota in ROTAS}
+    erros = dict.fromkeys(ROTAS, 0)
+    trava = threading.Lock()
+    proxima = iter(plano)
+
+    def trabalhador():
+
+        cliente = criar_cliente()
+        cliente.post("/login", credenciais)
+
+        while True:
+            with trava:
+                item = next(proxima, None)
+
+            if item is None:
+                return
+
+            rota, metodo, url, dados = item
+            inicio = time.perf_counter()
+
+            if metodo == "GET":
+                status = cliente.get(url)
+            else:
+                status = cliente.post(url, dados if dados is not None else credenciais)
+
+            duracao = (time.perf_counter() - inicio) * 1000
+
+            with trava:
+                tempos[rota].append(duracao)
+                if status >= 400:
+                    erros[rota] += 1
+
+    inicio = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concorrencia) as executor:
+        for futuro in [executor.submit(trabalhador) for _ in range(concorrencia)]:
+            futuro.result()
+
+    return tempos, erros, time.perf_counter() - inicio
+
+
+def resumir(tempos, erros, duracao):
+
+    rotas = {}
+
+    for rota, valores in tempos.items():
+        valores.sort()
+        rotas[rota] = {
+            "requisicoes": len(valores),
+            "erros": erros[rota],
+            "rps": round(len(valores) / duracao, 2),
+            "p50_ms": round(percentil(valores, 50), 2) if valores else None,
+            "p95_ms": round(percentil(valores, 95), 2) if valores else None,
+            "p99_ms": round(percentil(valores, 99), 2) if valores else None,
+            "max_ms": round(valores[-1], 2) if valores else None,
+        }
+
+    total = sum(len(valores) for valores in tempos.values())
+
+    return rotas, {
+        "requisicoes": total,
+        "erros": sum(erros.values()),
+        "duracao_s": round(duracao, 3),
+        "rps": round(total / duracao, 2),
+    }
+
+
+def versao_codigo():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def imprimir_tabela(resultado, anterior=None):
+
+    print(f"{'rota':<10} {'req':>6} {'erros':>6} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+
+    for rota, item in resultado["rotas"].items():
+        if not item["requisicoes"]:
+            continue
+
+        print(
+            f"{rota:<10} {item['requisicoes']:>6} {item['erros']:>6} {item['rps']:>8.1f} "
+            f"{item['p50_ms']:>9.2f} {item['p95_ms']:>9.2f} {item['p99_ms']:>9.2f}"
+        )
+
+        base = (anterior or {}).get("rotas", {}).get(rota)
+        if base and base.get("p95_ms"):
+            variacao = (item["p95_ms"] - base["p95_ms"]) / base["p95_ms"] * 100
+            print(f"{'':<10} p95 {variacao:+.1f}% em relação a {anterior.get('versao') or 'anterior'} ({base['p95_ms']:.2f} ms)")
+
+    total = resultado["total"]
+    print(f"total: {total['requisicoes']} requisições em {total['duracao_s']:.1f}s ({total['rps']:.1f} req/s), {total['erros']} erro(s)")
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--linhas", type=int, default=10000)
+    parser.add_argument("--pacientes", type=int, help="padrão: um terço das linhas")
+    parser.add_argument("--requisicoes", type=int, default=2000)
+    parser.add_argument("--concorrencia", type=int, default=4)
+    parser.add_argument("--modo", choices=["teste", "servidor"], default="teste")
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--db")
+    parser.add_argument("--json", dest="saida_json")
+    parser.add_argument("--comparar")
+    argumentos = parser.parse_args(argv)
+
+    pasta_script = os.path.dirname(os.path.abspath(__file__))
+    saida_json = argumentos.saida_json and os.path.abspath(argumentos.saida_json)
+    comparar = argumentos.comparar and os.path.abspath(argumentos.comparar)
+
+    with tempfile.TemporaryDirectory() as pasta:
+
+        os.environ["AIH_DB"] = os.path.abspath(argumentos.db) if argumentos.db else os.path.join(pasta, "benchmark.db")
+        os.environ["AIH_CACHE_IMPRESSAO"] = os.path.join(pasta, "cache_impressao")
+        os.environ["AIH_EXTRATOR"] = "0"
+
+        # layouts/ e o modelo do formulário são relativos à pasta do app
+        os.chdir(pasta_script)
+        sys.path.insert(0, pasta_script)
+
+        import app
+
+        inicio = time.perf_counter()
+        ids, cadastro = popular(app, argumentos.linhas, argumentos.pacientes or argumentos.linhas // 3, argumentos.semente)
+        print(f"{argumentos.linhas} AIHs geradas em {time.perf_counter() - inicio:.1f}s")
+
+        credenciais = {
+            "login": os.getenv("AIH_SECRETARIA_USER", "secretaria"),
+            "senha": os.getenv("AIH_SECRETARIA_PASS", "123456"),
+        }
+        plano = planejar(argumentos.requisicoes, ids, cadastro, argumentos.semente)
+
+        servidor = None
+        if argumentos.modo == "servidor":
+            servidor, base = iniciar_servidor(app)
+            criar_cliente = lambda: ClienteHttp(base)
+        else:
+            criar_cliente = lambda: ClienteTeste(app)
+
+        try:
+            tempos, erros, duracao = executar(criar_cliente, plano, argumentos.concorrencia, credenciais)
+        finally:
+            if servidor:
+                servidor.shutdown()
+
+        app.auditoria.descarregar()
+
+    rotas, total = resumir(tempos, erros, duracao)
+    resultado = {
+        "versao": versao_codigo(),
+        "momento": datetime.now().isoformat(timespec="seconds"),
+        "configuracao": {
+            "linhas": argumentos.linhas,
+            "requisicoes": argumentos.requisicoes,
+            "concorrencia": argumentos.concorrencia,
+            "modo": argumentos.modo,
+            "semente": argumentos.semente,
+            "cpus": os.cpu_count(),
+        },
+        "rotas": rotas,
+        "total": total,
+    }
+
+    anterior = None
+    if comparar:
+        with open(comparar, encoding="utf-8") as arquivo:
+            anterior = json.load(arquivo)
+
+    imprimir_tabela(resultado, anterior)
+
+    if saida_json:
+        with open(saida_json, "w", encoding="utf-8") as arquivo:
+            json.dump(resultado, arquivo, ensure_ascii=False, indent=2)
+
+    return 1 if total["erros"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
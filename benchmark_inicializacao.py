@@ -0,0 +1,145 @@
+"""Benchmark do tempo de inicialização de app.py.
+
+Cada medição é um processo Python novo (como um worker do gunicorn ou o exe
+do PyInstaller) que importa app e abre a primeira conexão. Mede o import, a
+primeira conexão (onde as migrações rodam) e quais bibliotecas de PDF foram
+carregadas, com o banco já em dia e com um banco vazio.
+
+Uso:
+    python benchmark_inicializacao.py [--repeticoes 10] [--comparar-com REV] [--json resultado.json]
+
+--comparar-com extrai outra revisão do git (ex.: HEAD~1) para uma pasta
+temporária e mede as duas nas mesmas condições.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SONDA = """
+import json, sys, time
+inicio = time.perf_counter()
+import app
+importado = time.perf_counter()
+conectar = getattr(app, "conectar_db", None)
+if conectar:
+    conectar().close()
+pronto = time.perf_counter()
+print(json.dumps({
+    "import_ms": (importado - inicio) * 1000,
+    "primeira_conexao_ms": (pronto - importado) * 1000,
+    "pdf_carregado": sorted(nome for nome in ("reportlab", "PyPDF2", "pdfplumber") if nome in sys.modules),
+}))
+"""
+
+
+def medir(pasta_app, caminho_db, ambiente):
+
+    saida = subprocess.run(
+        [sys.executable, "-c", SONDA],
+        cwd=pasta_app,
+        env=dict(ambiente, AIH_DB=caminho_db, PYTHONPATH=pasta_app),
+        capture_output=True, text=True, check=True,
+    ).stdout
+
+    return json.loads(saida.strip().splitlines()[-1])
+
+
+def rodar(pasta_app, pasta_tmp, repeticoes, ambiente):
+    """Medianas para banco em dia e banco vazio."""
+
+    resultados = {}
+    banco_em_dia = os.path.join(pasta_tmp, "em_dia.db")
+
+    # primeira execução cria e migra o banco reaproveitado abaixo
+    medir(pasta_app, banco_em_dia, ambiente)
+
+    for cenario in ("banco em dia", "banco vazio"):
+
+        amostras = []
+
+        for numero in range(repeticoes):
+            if cenario == "banco vazio":
+                caminho = os.path.join(pasta_tmp, f"vazio_{numero}.db")
+            else:
+                caminho = banco_em_dia
+            amostras.append(medir(pasta_app, caminho, ambiente))
+
+        import_ms = statistics.median(amostra["import_ms"] for amostra in amostras)
+        conexao_ms = statistics.median(amostra["primeira_conexao_ms"] for amostra in amostras)
+
+        resultados[cenario] = {
+            "import_ms": round(import_ms, 1),
+            "primeira_conexao_ms": round(conexao_ms, 1),
+            "pronto_ms": round(import_ms + conexao_ms, 1),
+            "pdf_carregado": amostras[-1]["pdf_carregado"],
+        }
+
+    return resultados
+
+
+def extrair_revisao(revisao, destino):
+
+    pasta_repo = os.path.dirname(os.path.abspath(__file__))
+    arquivo = subprocess.run(
+        ["git", "archive", "--format=tar", revisao],
+        cwd=pasta_repo, capture_output=True, check=True,
+    ).stdout
+
+    os.makedirs(destino)
+    subprocess.run(["tar", "xf", "-"], cwd=destino, input=arquivo, check=True)
+
+    # o aih.db versionado não entra na medição
+    for nome in os.listdir(destino):
+        if nome.startswith("aih.db"):
+            os.remove(os.path.join(destino, nome))
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeticoes", type=int, default=10)
+    parser.add_argument("--comparar-com", dest="revisao")
+    parser.add_argument("--json", dest="saida_json")
+    argumentos = parser.parse_args(argv)
+
+    ambiente = dict(os.environ, AIH_EXTRATOR="0")
+    versoes = {"atual": os.path.dirname(os.path.abspath(__file__))}
+
+    with tempfile.TemporaryDirectory() as pasta:
+
+        ambiente["AIH_CACHE_IMPRESSAO"] = os.path.join(pasta, "cache_impressao")
+
+        if argumentos.revisao:
+            versoes[argumentos.revisao] = os.path.join(pasta, "revisao")
+            extrair_revisao(argumentos.revisao, versoes[argumentos.revisao])
+
+        resultados = {}
+        for nome, pasta_app in versoes.items():
+            pasta_tmp = os.path.join(pasta, f"bancos_{len(resultados)}")
+            os.makedirs(pasta_tmp)
+            resultados[nome] = rodar(pasta_app, pasta_tmp, argumentos.repeticoes, ambiente)
+            shutil.rmtree(pasta_tmp)
+
+    print(f"{'versão':<12} {'cenário':<14} {'import ms':>10} {'1ª conexão ms':>14} {'pronto ms':>10}  PDF carregado")
+    for nome, cenarios in resultados.items():
+        for cenario, item in cenarios.items():
+            print(
+                f"{nome:<12} {cenario:<14} {item['import_ms']:>10.1f} {item['primeira_conexao_ms']:>14.1f} "
+                f"{item['pronto_ms']:>10.1f}  {', '.join(item['pdf_carregado']) or '-'}"
+            )
+
+    if argumentos.saida_json:
+        with open(argumentos.saida_json, "w", encoding="utf-8") as arquivo:
+            json.dump({"repeticoes": argumentos.repeticoes, "resultados": resultados}, arquivo, ensure_ascii=False, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
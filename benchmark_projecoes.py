@@ -0,0 +1,162 @@
+"""Benchmark das projeções de aih nas telas de listagem.
+
+Cria um banco temporário com N AIHs (100 mil por padrão, com justificativas
+de tamanho realista), e mede cada listagem duas vezes: com a projeção nomeada
+("depois") e com SELECT aih.* ("antes", como era). Para cada uma informa o
+tempo da requisição inteira (mediana) e os bytes que a consulta traz do SQLite.
+
+Uso:
+    python benchmark_projecoes.py [--linhas 100000] [--repeticoes 5] [--json resultado.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+PALAVRAS = (
+    "dor abdominal intensa febre vômitos náuseas há três dias sem melhora com analgesia "
+    "defesa localizada em fossa ilíaca direita leucocitose com desvio ultrassonografia "
+    "compatível apendicite aguda paciente hemodinamicamente estável indicado tratamento cirúrgico"
+).split()
+
+LISTAGENS = {
+    "lista (página de 25)": "/lista/dados?draw=1&start=0&length=25&order[0][column]=2&order[0][dir]=desc",
+    "lista (busca por nome)": "/lista/dados?draw=1&start=0&length=25&search[value]=Paciente 99",
+    "/aih (todas as AIHs)": "/aih",
+}
+
+
+def texto_longo(aleatorio, minimo, maximo):
+    return " ".join(aleatorio.choice(PALAVRAS) for _ in range(aleatorio.randint(minimo, maximo)))
+
+
+def popular(app, linhas):
+
+    aleatorio = random.Random(42)
+    conn = app.conectar_db()
+    colunas = app.colunas_importacao(conn)
+
+    for inicio in range(0, linhas, 10000):
+        lote = []
+        for numero in range(inicio, min(inicio + 10000, linhas)):
+            registro = dict.fromkeys(colunas)
+            registro.update(
+                nome_paciente=f"Paciente {numero}",
+                prontuario=str(100000 + numero),
+                cns=f"{numero:015d}",
+                clinica=aleatorio.choice(["Cirurgia", "Clínica", "Obstetrícia"]),
+                carater="Eletivo",
+                data_solicitacao=f"2026-{aleatorio.randint(1, 12):02d}-{aleatorio.randint(1, 28):02d}",
+                sinais=texto_longo(aleatorio, 80, 200),
+                condicoes=texto_longo(aleatorio, 60, 150),
+                provas=texto_longo(aleatorio, 60, 150),
+                diagnostico=texto_longo(aleatorio, 10, 40),
+                descricao_procedimento=texto_longo(aleatorio, 5, 15),
+                status=aleatorio.choice(["Pendente", "Aceita", "Reprovada"]),
+                necessita_apa="NAO",
+            )
+            lote.append(tuple(registro[coluna] for coluna in colunas))
+
+        app.inserir_em_lote(conn, colunas, lote)
+        conn.commit()
+
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def bytes_trazidos(app, projecao, limite):
+    """Bytes das colunas que a consulta da listagem devolve."""
+
+    conn = app.conectar_db()
+    sql = f"SELECT {projecao} FROM aih_completa AS aih ORDER BY id DESC"
+    if limite:
+        sql += f" LIMIT {limite}"
+
+    total = 0
+    for linha in conn.execute(sql):
+        for valor in linha:
+            if valor is not None:
+                total += len(str(valor).encode("utf-8"))
+
+    conn.close()
+    return total
+
+
+def medir(cliente, url, repeticoes):
+
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resposta = cliente.get(url)
+        tempos.append((time.perf_counter() - inicio) * 1000)
+        assert resposta.status_code == 200, (url, resposta.status_code)
+
+    return statistics.median(tempos), len(resposta.data)
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--linhas", type=int, default=100000)
+    parser.add_argument("--repeticoes", type=int, default=5)
+    parser.add_argument("--json", dest="saida_json")
+    argumentos = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as pasta:
+
+        os.environ["AIH_DB"] = os.path.join(pasta, "benchmark.db")
+        os.environ["AIH_EXTRATOR"] = "0"
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+        import app
+
+        inicio = time.perf_counter()
+        popular(app, argumentos.linhas)
+        print(f"{argumentos.linhas} AIHs geradas em {time.perf_counter() - inicio:.1f}s")
+
+        cliente = app.app.test_client()
+        with cliente.session_transaction() as sessao:
+            sessao["usuario"] = "benchmark"
+            sessao["perfil"] = "SECRETARIA"
+
+        projecao_nomeada = app.projecao_aih
+        resultados = []
+
+        for nome, url in LISTAGENS.items():
+
+            limite = None if url == "/aih" else 25
+
+            for versao, projecao in (("antes", lambda *args: "aih.*"), ("depois", projecao_nomeada)):
+                app.projecao_aih = projecao
+                milissegundos, tamanho_resposta = medir(cliente, url, argumentos.repeticoes)
+                resultados.append({
+                    "listagem": nome,
+                    "versao": versao,
+                    "ms": round(milissegundos, 2),
+                    "bytes_consulta": bytes_trazidos(app, projecao("lista"), limite),
+                    "bytes_resposta": tamanho_resposta,
+                })
+
+        app.projecao_aih = projecao_nomeada
+
+    print(f"{'listagem':<26} {'versão':<7} {'ms':>10} {'bytes da consulta':>18} {'bytes da resposta':>18}")
+    for item in resultados:
+        print(
+            f"{item['listagem']:<26} {item['versao']:<7} {item['ms']:>10.2f} "
+            f"{item['bytes_consulta']:>18,} {item['bytes_resposta']:>18,}"
+        )
+
+    if argumentos.saida_json:
+        with open(argumentos.saida_json, "w", encoding="utf-8") as arquivo:
+            json.dump({"linhas": argumentos.linhas, "resultados": resultados}, arquivo, ensure_ascii=False, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))